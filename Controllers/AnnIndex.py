@@ -0,0 +1,201 @@
+# Builtins
+from pathlib import Path
+from typing import List, Optional
+import os
+
+# External modules
+import numpy
+from numpy import ndarray
+
+# Custom code
+from Controllers.FaceRecognizer import KnownFaceIndex
+from Model.Person import Person
+
+
+class AnnIndex(KnownFaceIndex):
+    """
+    An inverted file (IVF) index over known faces, for known sets too big to compare every face against everyone.
+    Known encodings are split into lists by k-means, and a face is only compared with the encodings in the n_probe
+    lists whose centroids are closest to it. Distances that are computed are exact; people in lists that weren't
+    probed are left out (infinitely far), so a match can occasionally be missed. Small known sets, or n_probe
+    covering every list, are searched exhaustively instead, exactly like KnownFaceIndex.
+
+    Centroids and the list of every encoding are saved next to the database, so the index only has to be trained
+    once. Encodings added later are put in their closest list as the index is loaded, and the index is retrained
+    once the known set has doubled since it was trained.
+    """
+    min_size = 10000  # Below this many encodings, searching everything is fast enough
+    kmeans_iterations = 10
+    sample_per_list = 64  # Encodings k-means trains on, per list
+
+    def __init__(self, known_people: List[Person], n_probe: int = 8, centroids: Optional[ndarray] = None,
+                 trained_size: int = 0, saved_ids: Optional[ndarray] = None, saved_lists: Optional[ndarray] = None):
+        """
+        :param known_people: List of identified Person objects. People without encodings are ignored.
+        :param n_probe: Number of lists searched per face. More is slower but misses fewer matches.
+        :param centroids: Centroids from an earlier training. Trained from known_people if not given.
+        :param trained_size: Number of encodings the centroids were trained on
+        :param saved_ids: Encoding ids whose list is already known, to save finding it again
+        :param saved_lists: List of each of saved_ids
+        """
+        super().__init__(known_people)
+        self.n_probe = n_probe
+        self.encoding_ids = numpy.array([enc.dbid for p in self.people for enc in p.encodings], dtype="int64")
+        self.centroids = centroids
+        self.trained_size = trained_size
+        self.lists: Optional[ndarray] = None  # List of every row in self.matrix
+        self.newly_assigned = 0
+        if centroids is None:
+            if len(self) >= self.min_size:
+                self.train()
+            return
+
+        lists = numpy.full(len(self), -1, dtype="int64")
+        if saved_ids is not None and len(saved_ids) > 0:
+            order = numpy.argsort(saved_ids)
+            saved_ids, saved_lists = saved_ids[order], saved_lists[order]
+            positions = numpy.minimum(numpy.searchsorted(saved_ids, self.encoding_ids), len(saved_ids) - 1)
+            found = saved_ids[positions] == self.encoding_ids
+            lists[found] = saved_lists[positions[found]]
+        self.assign(lists)
+
+    def train(self) -> None:
+        n_lists = max(1, int(numpy.sqrt(len(self))))
+        self.centroids = kmeans(self.matrix, n_lists, self.kmeans_iterations, self.sample_per_list)
+        self.trained_size = len(self)
+        self.assign(numpy.full(len(self), -1, dtype="int64"))
+
+    def assign(self, lists: ndarray) -> None:
+        """
+        Puts every row in a list, and sorts rows by list so each list is one slice.
+        :param lists: Known list of each row, -1 for rows that still need one
+        """
+        unassigned = numpy.flatnonzero(lists < 0)
+        self.newly_assigned = len(unassigned)
+        if len(unassigned) > 0:
+            lists[unassigned] = nearest_centroids(self.matrix[unassigned], self.centroids, 1)[:, 0]
+        self.lists = lists
+        self.rows_by_list = numpy.argsort(lists, kind="stable")
+        self.list_starts = numpy.searchsorted(lists[self.rows_by_list], numpy.arange(len(self.centroids) + 1))
+
+    def is_exhaustive(self) -> bool:
+        return self.centroids is None or self.n_probe >= len(self.centroids)
+
+    def person_distances(self, unknown: ndarray, tolerance: Optional[float] = None,
+                         k: Optional[int] = None) -> ndarray:
+        """
+        Distance from every unknown encoding to the closest encoding of each known person among the encodings in the
+        probed lists. A person with encodings in other lists too may really be closer.
+        :param unknown: unknown encodings, one per row
+        :param tolerance: Passed on when searching exhaustively
+        :param k: Passed on when searching exhaustively
+        :return: Matrix of shape (unknown, people), columns in the same order as self.people. People who weren't
+            in a probed list are numpy.inf.
+        """
+        if self.is_exhaustive():
+            return super().person_distances(unknown, tolerance, k)
+
+        unknown = numpy.atleast_2d(unknown)
+        unknown_squared_norms = numpy.einsum("ij,ij->i", unknown, unknown)
+        output = numpy.full((len(unknown), len(self.people)), numpy.inf)
+        for face, probed in enumerate(nearest_centroids(unknown, self.centroids, self.n_probe)):
+            # Sorted, so each person's rows are next to each other
+            rows = numpy.sort(numpy.concatenate([self.rows_by_list[self.list_starts[l]:self.list_starts[l + 1]]
+                                                 for l in probed]))
+            if len(rows) == 0:
+                continue
+            squared = unknown_squared_norms[face] + self.squared_norms[rows] \
+                - 2 * (self.matrix[rows].astype("float64", copy=False) @ unknown[face])
+            people, starts = numpy.unique(self.row_person[rows], return_index=True)
+            output[face, people] = numpy.minimum.reduceat(numpy.sqrt(numpy.maximum(squared, 0)), starts)
+        return output
+
+    @staticmethod
+    def path_for(db_file_path: str) -> str:
+        db_path = Path(db_file_path)
+        return str(db_path.with_name(f"{db_path.stem}.ann.npz"))
+
+    @classmethod
+    def discard(cls, db_file_path: str) -> None:
+        """
+        Deletes the index saved next to a database, if there is one, so it's trained afresh the next time it's
+        loaded. For when known encodings change values but keep their ids, which would keep them in their old lists.
+        """
+        filepath = cls.path_for(db_file_path)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+    def save(self, filepath: str) -> None:
+        """
+        Saves the centroids and every encoding's list. Written alongside and then swapped in.
+        """
+        temp_path = filepath + ".tmp"
+        with open(temp_path, "wb") as file:
+            numpy.savez(file, centroids=self.centroids, encoding_ids=self.encoding_ids, lists=self.lists,
+                        trained_size=self.trained_size)
+        os.replace(temp_path, filepath)
+
+    @classmethod
+    def load(cls, db_file_path: str, known_people: List[Person], n_probe: int = 8) -> "AnnIndex":
+        """
+        Loads the index saved next to a database, bringing it up to date with known_people: encodings that are
+        new since it was saved are put in their closest list, and the index is retrained (or trained for the
+        first time) if the known set has doubled. Saves the result if anything changed.
+        :param db_file_path: Path to the database the index belongs to
+        :param known_people: Everybody in the database, as returned by Database.get_all_people
+        :param n_probe: Number of lists searched per face
+        """
+        filepath = cls.path_for(db_file_path)
+        if not os.path.exists(filepath):
+            index = cls(known_people, n_probe)
+            if index.centroids is not None:
+                index.save(filepath)
+            return index
+
+        with numpy.load(filepath) as saved:
+            saved_ids = saved["encoding_ids"]
+            index = cls(known_people, n_probe, saved["centroids"], int(saved["trained_size"]), saved_ids,
+                        saved["lists"])
+        if len(index) >= 2 * index.trained_size:
+            index.train()
+        # Encodings no longer associated with anybody are dropped from the file the next time it's saved
+        if index.newly_assigned > 0 or len(saved_ids) != len(index):
+            index.save(filepath)
+        return index
+
+
+def nearest_centroids(vectors: ndarray, centroids: ndarray, n: int, chunk_size: int = 4096) -> ndarray:
+    """
+    :return: For each vector, the indices of its n nearest centroids, closest first
+    """
+    n = min(n, len(centroids))
+    centroid_squared_norms = numpy.einsum("ij,ij->i", centroids, centroids)
+    output = numpy.empty((len(vectors), n), dtype="int64")
+    for start in range(0, len(vectors), chunk_size):
+        # |v|^2 is the same for every centroid, so it doesn't change the order. Done in float32 if both are float32.
+        chunk = numpy.asarray(vectors[start:start + chunk_size])
+        squared = centroid_squared_norms[None, :] - 2 * (chunk @ centroids.T)
+        nearest = numpy.argpartition(squared, n - 1, axis=1)[:, :n]
+        order = numpy.argsort(numpy.take_along_axis(squared, nearest, axis=1), axis=1)
+        output[start:start + len(chunk)] = numpy.take_along_axis(nearest, order, axis=1)
+    return output
+
+
+def kmeans(matrix: ndarray, k: int, iterations: int, sample_per_list: int, seed: int = 0) -> ndarray:
+    """
+    Lloyd's k-means on a random sample of the rows. Lists that end up empty are restarted from a random row.
+    :return: k centroids, one per row
+    """
+    rng = numpy.random.default_rng(seed)
+    sample_size = min(len(matrix), k * sample_per_list)
+    sample = numpy.asarray(matrix[numpy.sort(rng.choice(len(matrix), sample_size, replace=False))], dtype="float64")
+    centroids = sample[rng.choice(len(sample), k, replace=False)]
+    for i in range(iterations):
+        labels = nearest_centroids(sample, centroids, 1)[:, 0]
+        counts = numpy.bincount(labels, minlength=k)
+        sums = numpy.zeros_like(centroids)
+        numpy.add.at(sums, labels, sample)
+        empty = counts == 0
+        centroids = numpy.where(empty[:, None], sample[rng.integers(0, len(sample), k)],
+                                sums / numpy.maximum(counts, 1)[:, None])
+    return centroids
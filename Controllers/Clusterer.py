@@ -0,0 +1,100 @@
+# External modules
+import numpy
+from numpy import ndarray
+
+# Custom code
+from Controllers.AnnIndex import kmeans, nearest_centroids
+
+
+def cluster_encodings(matrix: ndarray, threshold: float = 0.5, block_size: int = 2048, n_probe: int = 8,
+                      exhaustive_size: int = 20000) -> ndarray:
+    """
+    Groups encodings into candidate identities: two encodings are in the same cluster if they're within threshold
+    of each other, directly or through a chain of other encodings (single linkage, with union-find).
+
+    Distances are computed in float32 a block of rows at a time, and only the pairs under threshold are kept, so
+    memory use is the matrix plus one block of distances. Up to exhaustive_size encodings, every pair is compared.
+    Beyond that, encodings are split into k-means lists like AnnIndex does, and each encoding is only compared with
+    the encodings in the n_probe lists whose centroids are closest to it, so a close pair can occasionally be missed.
+    :param matrix: Encodings, one per row
+    :param threshold: Largest distance between two faces of the same person
+    :param block_size: Rows compared at a time
+    :param n_probe: Lists each encoding is compared with, for large sets
+    :param exhaustive_size: Largest number of encodings for which every pair is compared
+    :return: Cluster of each row, identified by its lowest row number
+    """
+    matrix = numpy.asarray(matrix, dtype="float32")
+    parent = numpy.arange(len(matrix))
+    squared_norms = numpy.einsum("ij,ij->i", matrix, matrix)
+    width = matrix.shape[1]
+    half_cutoffs = (squared_norms - numpy.float32(threshold ** 2)) / 2
+
+    def join_close(rows: ndarray, candidates: ndarray) -> None:
+        """ Unions every pair from rows x candidates that's within threshold, a block of rows at a time. """
+        # |a - b|^2 < t^2 is a.b - |b|^2/2 > (|a|^2 - t^2)/2, and the left side is one matrix product with an
+        # extra column, so each block of distances only needs a single pass to compare
+        candidate_columns = numpy.empty((width + 1, len(candidates)), dtype="float32")
+        candidate_columns[:width] = matrix[candidates].T
+        candidate_columns[width] = squared_norms[candidates] * -0.5
+        for start in range(0, len(rows), block_size):
+            block = rows[start:start + block_size]
+            block_rows = numpy.empty((len(block), width + 1), dtype="float32")
+            block_rows[:, :width] = matrix[block]
+            block_rows[:, width] = 1
+            # flatnonzero is much quicker than a 2D nonzero on a mostly-False matrix
+            a, b = numpy.divmod(numpy.flatnonzero(block_rows @ candidate_columns > half_cutoffs[block, None]),
+                                len(candidates))
+            a, b = block[a], candidates[b]
+            keep = a != b  # Nothing with itself
+            union(parent, a[keep], b[keep])
+
+    if len(matrix) <= exhaustive_size:
+        every_row = numpy.arange(len(matrix))
+        for start in range(0, len(matrix), block_size):
+            join_close(every_row[start:start + block_size], every_row[start:])
+    else:
+        centroids = kmeans(matrix, int(numpy.sqrt(len(matrix))), 10, 64).astype("float32")
+        probed = nearest_centroids(matrix, centroids, n_probe)  # The first is the encoding's own list
+        list_bounds = numpy.arange(len(centroids) + 1)
+        rows_by_list = numpy.argsort(probed[:, 0], kind="stable")
+        list_starts = numpy.searchsorted(probed[rows_by_list, 0], list_bounds)
+        # Every encoding that probes each list, grouped the same way
+        probes = numpy.argsort(probed.ravel(), kind="stable")
+        probe_starts = numpy.searchsorted(probed.ravel()[probes], list_bounds)
+        probes //= probed.shape[1]
+        for l in range(len(centroids)):
+            join_close(probes[probe_starts[l]:probe_starts[l + 1]], rows_by_list[list_starts[l]:list_starts[l + 1]])
+
+    while True:  # Point every row straight at its root
+        grandparent = parent[parent]
+        if numpy.array_equal(grandparent, parent):
+            return parent
+        parent = grandparent
+
+
+def find(parent: ndarray, rows: ndarray) -> ndarray:
+    """
+    :return: Root of each row. The rows are then pointed straight at their roots, so the next find is quicker.
+    """
+    roots = parent[rows]
+    while True:
+        up = parent[roots]
+        if numpy.array_equal(up, roots):
+            break
+        roots = up
+    parent[rows] = roots
+    return roots
+
+
+def union(parent: ndarray, a: ndarray, b: ndarray) -> None:
+    """
+    Joins the clusters of a[i] and b[i] for every i. Roots are always pointed at a lower row, so the root of a
+    cluster is its lowest row. When several pairs want to point the same root somewhere, the lowest wins and the
+    others are retried from their new roots.
+    """
+    while len(a) > 0:
+        root_a, root_b = find(parent, a), find(parent, b)
+        different = root_a != root_b
+        a, b = root_a[different], root_b[different]
+        numpy.minimum.at(parent, numpy.maximum(a, b), numpy.minimum(a, b))
+
@@ -1,7 +1,12 @@
 import sqlite3
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Optional
+from pathlib import Path
+from queue import Queue, Empty
+from threading import Lock
+from typing import List, Optional, Dict, Tuple, Set, Iterator
 import logging
+from time import monotonic
 import numpy
 from numpy.core.multiarray import ndarray
 
@@ -11,6 +16,9 @@ import os
 from Model.ImageFile import ImageFile
 from Model.Person import Person
 from Model.FaceEncoding import FaceEncoding
+from Model.FaceRegion import FaceRegion
+from Controllers.EncodingStore import EncodingStore
+from Controllers.Quantizer import quantize, dequantize, decode_blobs, precisions
 
 
 class Database:
@@ -21,32 +29,219 @@ class Database:
     """
     open_connections = []
     datetime_format_string = "%Y%m%d-%H%M"  # Should result in 20200804-0934, etc.
+
+    # WAL lets readers (the dashboard, ad-hoc queries) work while a scan is writing. NORMAL sync is safe with WAL:
+    # a power cut can lose the last commits, but never corrupts the database.
+    pragmas = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64 * 1024,  # Negative is KiB, so 64MB
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    }
+    read_pragmas = ["cache_size", "mmap_size", "temp_store"]
+    store_generation_setting = "encoding_store_generation"  # Which EncodingStore file is current
+    store_rows_setting = "encoding_store_rows"  # Rows in use in the EncodingStore
+    precision_setting = "encoding_precision"  # How new encodings are stored, one of Quantizer.precisions
     logger = logging.getLogger(__name__)
 
     # TODO: Refactor to put metadata fields (exposure, etc.) on their own table
     # TODO: Use exif.date_taken instead of date_modified to identify files. Needs to be hhmmss instead of hhmm though.
 
-    def __init__(self, db_file_path: str):
+    def __init__(self, db_file_path: str, batch_size: int = 1, batch_seconds: float = 10, read_connections: int = 2,
+                 packed_store: bool = False):
+        """
+        :param db_file_path: Path to the database file. Created if it doesn't exist.
+        :param batch_size: Commit writes every batch_size images instead of after every statement. 1 disables batching.
+        :param batch_seconds: In batched mode, also commit once the open batch is this many seconds old.
+        :param read_connections: Maximum number of read-only connections handed out by reader()
+        :param packed_store: Store new encodings in an EncodingStore file next to the database instead of as BLOBs.
+            Once a database has a store, it's always used.
+        """
         self.db_file_path = db_file_path
         self.connection = sqlite3.connect(db_file_path, detect_types=sqlite3.PARSE_COLNAMES, isolation_level=None)
+        for pragma, value in self.pragmas.items():
+            self.connection.execute(f"PRAGMA {pragma} = {value}")
         self.open_connections.append(self)
 
+        # Read-only connections, created as they're needed
+        self.read_connections = read_connections
+        self.read_pool: Queue = Queue()
+        self.readers_created = 0
+        self.read_pool_lock = Lock()
+
+        # Batched writes: one transaction spans many images, with a savepoint around the image being written
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.batch_images = 0
+        self.batch_started = 0.0
+        self.image_open = False
+
         # Create tables if they don't already exist: Image, Person, PersonInImage
         self.create_schema()
 
         # Enables accessing results by name
         self.connection.row_factory = sqlite3.Row
 
+        self.precision: str = self.get_setting(self.precision_setting, "float64")
+        self.store: Optional[EncodingStore] = None
+        generation = self.get_setting(self.store_generation_setting)
+        if generation is not None or packed_store:
+            self.store = EncodingStore(db_file_path, int(generation or 0), self.store_rows_in_use(), self.precision)
+            if generation is None:
+                self.set_setting(self.store_generation_setting, 0)
+                self.set_setting(self.store_rows_setting, 0)
+                self.flush()
+
     def close(self):
+        """
+        Commits every finished image and closes all connections. Writes for an unfinished image are discarded.
+        """
+        self.discard_unfinished_image()
+        self.flush()
+        if self.store:
+            self.store.close()
+        while self.readers_created > 0:
+            self.read_pool.get().close()
+            self.readers_created -= 1
         self.connection.close()
         self.open_connections.remove(self)
         print(f"Successfully closed database at {self.db_file_path}")
 
     @classmethod
     def close_all(cls):
-        for c in cls.open_connections:
+        for c in list(cls.open_connections):
             c.close()
 
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """
+        Borrows a read-only connection from the pool. Thanks to WAL, reads never wait for the writer (and vice versa);
+        they see the database as of the writer's last commit. Blocks if every pooled connection is in use.
+        Usage: `with db.reader() as connection: connection.execute(...)`
+        """
+        connection = None
+        try:
+            connection = self.read_pool.get_nowait()
+        except Empty:
+            with self.read_pool_lock:
+                if self.readers_created < self.read_connections:
+                    connection = self.connect_reader()
+                    self.readers_created += 1
+        if connection is None:
+            connection = self.read_pool.get()
+        try:
+            yield connection
+        finally:
+            self.read_pool.put(connection)
+
+    def connect_reader(self) -> sqlite3.Connection:
+        uri = Path(self.db_file_path).absolute().as_uri() + "?mode=ro"
+        connection = sqlite3.connect(uri, uri=True, detect_types=sqlite3.PARSE_COLNAMES, isolation_level=None,
+                                     check_same_thread=False)
+        for pragma in self.read_pragmas:
+            connection.execute(f"PRAGMA {pragma} = {self.pragmas[pragma]}")
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def is_batching(self) -> bool:
+        return self.batch_size > 1
+
+    def open_batch(self) -> None:
+        """
+        In batched mode, opens the batch transaction and the current image's savepoint if they aren't already open.
+        """
+        if not self.is_batching():
+            return
+        if not self.connection.in_transaction:
+            self.connection.execute("BEGIN")
+            self.batch_started = monotonic()
+        if not self.image_open:
+            self.connection.execute("SAVEPOINT image")
+            self.image_open = True
+
+    def write(self, sql: str, params=()) -> sqlite3.Cursor:
+        """
+        Runs a statement that changes the database.
+        """
+        self.open_batch()
+        return self.connection.execute(sql, params)
+
+    def write_many(self, sql: str, param_rows) -> sqlite3.Cursor:
+        """
+        Runs a statement that changes the database once per row of parameters.
+        """
+        self.open_batch()
+        return self.connection.executemany(sql, param_rows)
+
+    def end_image(self) -> None:
+        """
+        Marks everything written since the last call as one complete image. In batched mode, commits the batch if
+        it's full or old enough.
+        """
+        if not self.is_batching() or not self.image_open:
+            return
+        self.connection.execute("RELEASE SAVEPOINT image")
+        self.image_open = False
+        self.batch_images += 1
+        if self.batch_images >= self.batch_size or monotonic() - self.batch_started >= self.batch_seconds:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Commits everything written so far, including an image that hasn't been ended yet.
+        """
+        if self.image_open:
+            self.connection.execute("RELEASE SAVEPOINT image")
+            self.image_open = False
+        if self.connection.in_transaction:
+            if self.store:  # Encodings must be on disk before the rows pointing at them are committed
+                self.store.flush()
+            self.connection.commit()
+        self.batch_images = 0
+
+    @contextmanager
+    def store_transaction(self) -> Iterator[None]:
+        """
+        Commits writes that point at newly appended EncodingStore rows together with the store's row count, so
+        neither is ever committed without the other. The store is flushed first, since rows have to be on disk
+        before anything referencing them is committed. In batched mode the batch's own transaction does both.
+        Without a store, it just makes the writes one transaction.
+        """
+        if self.is_batching():
+            yield
+            return
+        if self.store:
+            self.store.flush()
+        self.connection.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self.connection.rollback()
+            raise
+        self.connection.commit()
+
+    def store_rows_in_use(self) -> int:
+        """
+        :return: Rows of the EncodingStore in use as committed: the recorded count, or one past the last row an
+            encoding points at if that's further, so rows the database references are never written over.
+        """
+        recorded = int(self.get_setting(self.store_rows_setting, 0))
+        last_row = self.connection.execute("SELECT MAX(store_row) FROM Encoding").fetchone()[0]
+        return recorded if last_row is None else max(recorded, last_row + 1)
+
+    def discard_unfinished_image(self) -> None:
+        """
+        Rolls back anything written since the last end_image, so stopping part way through an image never leaves
+        it half-stored.
+        """
+        if self.image_open:
+            self.connection.execute("ROLLBACK TO SAVEPOINT image")
+            self.connection.execute("RELEASE SAVEPOINT image")
+            self.image_open = False
+            if self.store:  # Rows appended for the image will be written over
+                self.store.rows = self.store_rows_in_use()
+
     def create_schema(self):
         # TODO: Benchmark each index
 
@@ -62,6 +257,11 @@ class Database:
             date_modified DATETIME NOT NULL, 
             size_bytes INT NOT NULL,
             aperture REAL, shutter_speed REAL, iso INT, date_taken TEXT,
+            mtime_ns INT,
+            faces_scanned INT DEFAULT 1,    --0 for images only indexed for metadata, still to be scanned for faces
+            detect_size INT,    --Longest side of the copy faces were looked for in, 0 if the face gate skipped it
+            phash INT,          --Perceptual hash, NULL unless scanned with near-duplicate detection on
+            width INT, height INT,  --Size in pixels, kept with the hash since only images the same size can match
             UNIQUE(filename, date_modified, size_bytes)
             );
 
@@ -70,7 +270,9 @@ class Database:
 
         CREATE TABLE IF NOT EXISTS Encoding --Encoded version of a face found in an image
             (id INTEGER PRIMARY KEY, 
-            encoding BLOB);
+            encoding BLOB,      --float64, float32 or int8, told apart by size
+            store_row INT,      --Row in the EncodingStore instead of a BLOB, if the database has a store
+            scale REAL);        --Scale of an int8 encoding, NULL otherwise
 
         CREATE TABLE IF NOT EXISTS ImageEncoding    --A relationship between an image and an encoding
             (id INTEGER PRIMARY KEY, 
@@ -94,8 +296,56 @@ class Database:
         CREATE INDEX IF NOT EXISTS idx_image_in_db ON Image (filename, date_modified, size_bytes); 
                 
         CREATE INDEX IF NOT EXISTS idx_encodings_from_image ON ImageEncoding (image_id); 
+
+        CREATE INDEX IF NOT EXISTS idx_people_from_encoding ON PersonEncoding (encoding_id);
+
+        CREATE TABLE IF NOT EXISTS FaceMatch    --The closest known people to a face, at any distance
+            (id INTEGER PRIMARY KEY,
+            encoding_id INT,
+            person_id INT,
+            distance REAL,
+            FOREIGN KEY (encoding_id) REFERENCES Encoding (id),
+            FOREIGN KEY (person_id) REFERENCES Person (id),
+            UNIQUE(encoding_id, person_id)
+            );
+
+        CREATE INDEX IF NOT EXISTS idx_face_match_distance ON FaceMatch (distance);
+
+        CREATE TABLE IF NOT EXISTS KeywordJournal   --Keyword changes waiting to be written to image files
+            (id INTEGER PRIMARY KEY,
+            image_id INT NOT NULL,
+            keyword TEXT NOT NULL,
+            action TEXT NOT NULL,   --'add' or 'remove'
+            created DATETIME DEFAULT CURRENT_TIMESTAMP,
+            applied DATETIME,       --Always NULL, entries are deleted once written. Set by older versions.
+            FOREIGN KEY (image_id) REFERENCES Image (id)
+            );
+
+        CREATE INDEX IF NOT EXISTS idx_keyword_journal_pending ON KeywordJournal (image_id) WHERE applied IS NULL;
+
+        CREATE TABLE IF NOT EXISTS FaceCluster  --Likely identity of a face that didn't match anybody, from clustering
+            (encoding_id INTEGER PRIMARY KEY,
+            cluster_id INT NOT NULL,    --Id of one of the cluster's encodings
+            FOREIGN KEY (encoding_id) REFERENCES Encoding (id)
+            );
+
+        CREATE INDEX IF NOT EXISTS idx_face_cluster ON FaceCluster (cluster_id);
+
+        CREATE TABLE IF NOT EXISTS FaceRegion   --Where a face was found, in pixels of the full-size image
+            (encoding_id INTEGER PRIMARY KEY,
+            box_top INT NOT NULL, box_right INT NOT NULL, box_bottom INT NOT NULL, box_left INT NOT NULL,
+            landmarks BLOB,     --68 (x, y) points as int32, NULL if not kept
+            detector TEXT,      --'hog' or 'cnn'
+            source_scale REAL,  --Full-size pixels per pixel of the image the face was found in
+            FOREIGN KEY (encoding_id) REFERENCES Encoding (id)
+            );
+
+        CREATE TABLE IF NOT EXISTS Setting  --Named values that need to survive between runs, like watermarks
+            (name TEXT PRIMARY KEY,
+            value);
         """
         self.connection.executescript(create_tables)
+        self.upgrade_schema()
 
         # DEBUG
         if False:
@@ -103,35 +353,105 @@ class Database:
                 "SELECT name FROM sqlite_master WHERE type IN ('table','view','index') AND name NOT LIKE 'sqlite_%'").fetchall()
             pp(all_tables)
 
-    def add_image(self, image: ImageFile, encodings: List[ndarray]) -> int:
+    def upgrade_schema(self):
+        """
+        Adds columns that were introduced after a database may have been created, and clears out what older versions
+        left behind.
+        """
+        added_columns = {
+            "Image": [("mtime_ns", "INT"), ("faces_scanned", "INT DEFAULT 1"), ("detect_size", "INT"), ("phash", "INT"),
+                      ("width", "INT"), ("height", "INT")],
+            "Encoding": [("store_row", "INT"), ("scale", "REAL")],
+            "FaceRegion": [("landmarks", "BLOB"), ("detector", "TEXT"), ("source_scale", "REAL")],
+        }
+        for table, columns in added_columns.items():
+            existing = [row[1] for row in self.connection.execute(f"PRAGMA table_info({table})").fetchall()]
+            for name, declaration in columns:
+                if name not in existing:
+                    self.connection.execute(f"ALTER TABLE {table} ADD COLUMN {name} {declaration}")
+        # Older versions kept entries after writing them to the file
+        self.connection.execute("DELETE FROM KeywordJournal WHERE applied IS NOT NULL")
+        # Indexes on added columns, which can only be made once the columns exist
+        self.connection.execute("CREATE INDEX IF NOT EXISTS idx_image_phash ON Image (width, height, phash) "
+                                "WHERE phash IS NOT NULL")
+
+    def add_image(self, image: ImageFile, encodings: List[ndarray], regions: Optional[List[FaceRegion]] = None,
+                  detect_size: Optional[int] = None) -> int:
         """
         Adds one image entry to the database.
         :param image: ImageFile to add
-        :return: Id of the created image record
+        :param encodings: Faces found in the image
+        :param regions: Where and how each face was found in the full-size image, if known
+        :param detect_size: Longest side of the copy faces were looked for in, if known
+        :return: Id of the created image record. The image's perceptual hash and size are stored too, if it has them.
         """
-        # Check for existence
-        exist_check = self.get_image_id_by_attributes(image)
-        if exist_check:
-            return exist_check
-
-        # Insert images
+        # Insert images, unless it's already there
         insert_image = """
-        INSERT INTO Image 
-        (filename, date_modified, size_bytes, aperture, shutter_speed, iso, date_taken, path) 
-        values (?, ?, ?, ?, ?, ?, ?, ?)
-        --      0  1  2  3  4  5  6  7  
+        INSERT OR IGNORE INTO Image 
+        (filename, date_modified, size_bytes, aperture, shutter_speed, iso, date_taken, path, mtime_ns, detect_size,
+        phash, width, height) 
+        values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        --      0  1  2  3  4  5  6  7  8  9  10 11 12
         """
-        dbresponse = self.connection.execute(insert_image, self.adapt_ImageFile(image))
-        image.dbid = dbresponse.lastrowid
+        width, height = image.dimensions or (None, None)
+        params = self.adapt_ImageFile(image) + [os.stat(image.filepath).st_mtime_ns, detect_size, image.phash, width,
+                                                height]
+        dbresponse = self.write(insert_image, params)
+        if dbresponse.rowcount == 0:
+            # Already there. Only an image indexed for metadata alone still needs its encodings.
+            image.dbid = self.get_image_id_by_attributes(image)
+            sql = "UPDATE Image SET faces_scanned = 1, detect_size = ?, phash = ?, width = ?, height = ? " \
+                  "WHERE id = ? AND faces_scanned = 0"
+            if self.write(sql, [detect_size, image.phash, width, height, image.dbid]).rowcount == 0:
+                return image.dbid
+        else:
+            image.dbid = dbresponse.lastrowid
 
         # Insert associated encodings
-        for enc in encodings:
-            self.add_encoding(enc, image.dbid, image=True)
+        encoding_ids = self.add_encodings(encodings, image.dbid, image=True)
+        if regions:
+            self.add_face_regions(encoding_ids, regions)
 
-        self.connection.commit()
         image.in_database = True
         return image.dbid
 
+    def add_near_duplicate(self, image: ImageFile, source_id: int) -> int:
+        """
+        Adds an image with copies of the faces found in another, instead of looking for them. For near duplicates,
+        whose faces are in the same places.
+        :param image: ImageFile to add
+        :param source_id: Id of the already scanned image it's a near duplicate of
+        :return: Id of the created image record
+        """
+        encodings = self.get_encodings_by_image_id(source_id)
+        regions = self.get_face_regions(source_id)
+        detect_size = self.connection.execute("SELECT detect_size FROM Image WHERE id = ?", [source_id]).fetchone()[0]
+        return self.add_image(image, [enc.encoding for enc in encodings],
+                              [regions[enc.dbid] for enc in encodings] if len(regions) == len(encodings) else None,
+                              detect_size)
+
+    def get_perceptual_hashes(self) -> List[Tuple[int, int, int, int]]:
+        """
+        :return: (id, perceptual hash, width, height) of every image scanned for faces that has a hash
+        """
+        sql = "SELECT id, phash, width, height FROM Image WHERE phash IS NOT NULL AND faces_scanned = 1"
+        return [tuple(row) for row in self.connection.execute(sql)]
+
+    def add_indexed_image(self, filepath: str, exif_data: Dict) -> None:
+        """
+        Adds an image from its EXIF header alone. It's marked as not yet scanned for faces, so the next scan
+        encodes it.
+        :param filepath: Path to the image
+        :param exif_data: Parsed salient EXIF data, as returned by ImageFile.parse_salient_exif
+        """
+        sql = """
+        INSERT OR IGNORE INTO Image
+        (filename, date_modified, size_bytes, aperture, shutter_speed, iso, date_taken, path, mtime_ns, faces_scanned)
+        values (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+        """
+        stat = os.stat(filepath)
+        self.write(sql, self.file_attributes(filepath) + self.adapt_exif(exif_data) + [filepath, stat.st_mtime_ns])
+
     def update_image_attributes(self, image: ImageFile) -> None:
         sql = """
             UPDATE Image
@@ -141,16 +461,37 @@ class Database:
                 aperture = ?,
                 shutter_speed = ?,
                 iso = ?,
-                date_taken = ?
+                date_taken = ?,
+                mtime_ns = ?
             WHERE
                 id = ?
         """
-        params = self.adapt_ImageFile(image)[1:7] + [image.dbid]
-        dbresponse = self.connection.execute(sql, params)
+        params = self.adapt_ImageFile(image)[1:7] + [os.stat(image.filepath).st_mtime_ns, image.dbid]
+        dbresponse = self.write(sql, params)
         result = dbresponse.fetchall()
         if dbresponse.rowcount != 1:
             raise Exception(f"Unexpected behavior: wrong number of rows modified: {dbresponse.rowcount}")
 
+    def update_image_stat(self, image_id: int, filepath: str) -> None:
+        """
+        Refreshes the file-system attributes of an image without touching its metadata.
+        :param image_id: Id of the image record to update
+        :param filepath: Where the file is now
+        """
+        sql = """
+            UPDATE Image
+            SET
+                path = ?,
+                date_modified = ?,
+                size_bytes = ?,
+                mtime_ns = ?
+            WHERE
+                id = ?
+        """
+        stat = os.stat(filepath)
+        params = [filepath, self.get_formatted_date_modified(filepath), stat.st_size, stat.st_mtime_ns, image_id]
+        self.write(sql, params)
+
     def add_person(self, name) -> int:
         """
         Adds a person to the database.
@@ -160,7 +501,7 @@ class Database:
         sql = """
         INSERT INTO Person (name) VALUES (?)
         """
-        dbresponse = self.connection.execute(sql, [name])
+        dbresponse = self.write(sql, [name])
         dbid = dbresponse.lastrowid
         return dbid
 
@@ -173,14 +514,102 @@ class Database:
         :param image: Is this associated to an image?
         :return: Id of the newly-created encoding
         """
-        # Insert
-        sql = "INSERT INTO Encoding (encoding) VALUES (?)"
-        encoding_bytes = encoding.tobytes()
-        dbresponse = self.connection.execute(sql, [encoding_bytes])
-        dbid = dbresponse.lastrowid
+        return self.add_encodings([encoding], associate_id, person, image)[0]
 
-        self.get_or_associate_encoding(dbid, associate_id, person, image)
-        return dbid
+    def add_encodings(self, encodings: List[ndarray], associate_id: int,
+                      person: bool = False, image: bool = False) -> List[int]:
+        """
+        Adds several encodings that all belong to the same person or image, inserting each table's rows in one go.
+        :param encodings: The encodings' payloads
+        :param associate_id: The id of the image or person these are associated with
+        :param person: Are these associated to a person?
+        :param image: Are these associated to an image?
+        :return: Ids of the newly-created encodings, in the same order
+        """
+        if person + image < 1:
+            raise Exception("Must specify a person or image to associate an encoding to.")
+        if len(encodings) == 0:
+            return []
+        # Rows without an explicit id get max(id) + 1, and this connection is the only writer, so the new ids are
+        # consecutive. That lets us insert with executemany and still know every id.
+        first_id = self.get_max_id("Encoding") + 1
+        values, scales = quantize(encodings, self.precision)
+        scales = scales.tolist() if scales is not None else [None] * len(values)
+        if self.store:
+            store_rows = self.store.append(values)
+            with self.store_transaction():
+                self.write_many("INSERT INTO Encoding (store_row, scale) VALUES (?, ?)", zip(store_rows, scales))
+                self.set_setting(self.store_rows_setting, self.store.rows)
+        else:
+            self.write_many("INSERT INTO Encoding (encoding, scale) VALUES (?, ?)",
+                            [(value.tobytes(), scale) for value, scale in zip(values, scales)])
+        dbids = list(range(first_id, first_id + len(encodings)))
+
+        table, column = self.association_table(person, image)
+        self.write_many(f"INSERT OR IGNORE INTO {table} (encoding_id, {column}) VALUES (?,?)",
+                        [(dbid, associate_id) for dbid in dbids])
+        return dbids
+
+    def add_face_regions(self, encoding_ids: List[int], regions: List[FaceRegion]) -> None:
+        """
+        Records where and how faces were found, replacing anything already recorded for them.
+        :param encoding_ids: Encodings of the faces
+        :param regions: Region of each face in the full-size image, in the same order
+        """
+        sql = "INSERT OR REPLACE INTO FaceRegion (encoding_id, box_top, box_right, box_bottom, box_left, landmarks, " \
+              "detector, source_scale) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+        self.write_many(sql, [(encoding_id, *map(int, region.box),
+                               None if region.landmarks is None else region.landmarks.astype("int32").tobytes(),
+                               region.detector, region.source_scale)
+                              for encoding_id, region in zip(encoding_ids, regions)])
+
+    def get_face_regions(self, image_id: int) -> Dict[int, FaceRegion]:
+        """
+        :return: Region of each face found in an image, keyed by encoding id. Faces stored before regions were kept
+            are left out, and so are landmarks, detector and scale for faces stored before those were kept.
+        """
+        sql = """
+            SELECT FR.*
+            FROM ImageEncoding IE
+            INNER JOIN FaceRegion FR ON IE.encoding_id = FR.encoding_id
+            WHERE IE.image_id = ?
+        """
+        return {row["encoding_id"]: self.adapt_face_region(row) for row in self.connection.execute(sql, [image_id])}
+
+    def count_faces_without_regions(self) -> int:
+        """
+        :return: Number of faces in images that were stored before regions were kept
+        """
+        sql = """
+            SELECT COUNT(*) FROM ImageEncoding IE
+            WHERE NOT EXISTS (SELECT 1 FROM FaceRegion FR WHERE FR.encoding_id = IE.encoding_id)
+        """
+        return self.connection.execute(sql).fetchone()[0]
+
+    def replace_encodings(self, encoding_ids: List[int], encodings: List[ndarray]) -> None:
+        """
+        Changes the values of encodings that are already stored, keeping their ids and so everything associated with
+        them, except recorded distances to people: those were to the old values, so they're deleted with the change.
+        Stored at the database's precision. In an EncodingStore, the new values are appended and the old rows are
+        left for compact_encoding_store to drop.
+        :param encoding_ids: Encodings to change
+        :param encodings: New value of each, in the same order
+        """
+        if len(encoding_ids) == 0:
+            return
+        values, scales = quantize(encodings, self.precision)
+        scales = scales.tolist() if scales is not None else [None] * len(values)
+        store_rows = self.store.append(values) if self.store else None
+        with self.store_transaction():
+            if self.store:
+                self.write_many("UPDATE Encoding SET store_row = ?, scale = ? WHERE id = ?",
+                                zip(store_rows, scales, encoding_ids))
+                self.set_setting(self.store_rows_setting, self.store.rows)
+            else:
+                self.write_many("UPDATE Encoding SET encoding = ?, scale = ? WHERE id = ?",
+                                [(value.tobytes(), scale, encoding_id)
+                                 for value, scale, encoding_id in zip(values, scales, encoding_ids)])
+            self.write_many("DELETE FROM FaceMatch WHERE encoding_id = ?", [[eid] for eid in encoding_ids])
 
     def get_or_associate_encoding(self, encoding_id: int, associate_id: int, person: bool = False, image: bool = False):
         """
@@ -191,40 +620,43 @@ class Database:
         :param image: Is this associated to an image?
         :return: Id of new association
         """
-        # Check for pre-existing
         if person + image < 1:
             raise Exception("Must specify a person or image to associate an encoding to.")
+        table, column = self.association_table(person, image)
 
-        if person:
-            sql = "SELECT id FROM PersonEncoding WHERE encoding_id = ? AND person_id = ?"
-        if image:
-            sql = "SELECT id FROM PersonEncoding WHERE encoding_id = ? AND person_id = ?"
-        dbresponse = self.connection.execute(sql, [encoding_id, associate_id])
-        result = dbresponse.fetchall()
-        if len(result) == 1:
-            return result[0]["id"]
+        # Insert, letting the UNIQUE constraint skip pre-existing associations
+        sql = f"INSERT OR IGNORE INTO {table} (encoding_id, {column}) VALUES (?,?)"
+        dbresponse = self.write(sql, [encoding_id, associate_id])
+        if dbresponse.rowcount == 1:
+            return dbresponse.lastrowid
+
+        sql = f"SELECT id FROM {table} WHERE encoding_id = ? AND {column} = ?"
+        return self.connection.execute(sql, [encoding_id, associate_id]).fetchone()["id"]
 
-        # Insert
+    @staticmethod
+    def association_table(person: bool = False, image: bool = False) -> Tuple[str, str]:
+        """
+        :return: Name of the table linking encodings to people or images, and the name of its non-encoding column
+        """
         if person:
-            sql = "INSERT INTO PersonEncoding (encoding_id, person_id) VALUES (?,?)"
+            return "PersonEncoding", "person_id"
         elif image:
-            sql = "INSERT INTO ImageEncoding (encoding_id, image_id) VALUES (?,?)"
-        else:
-            raise ValueError("Must specify a type of encoding association.")
-        dbresponse = self.connection.execute(sql, [encoding_id, associate_id])
-        dbid = dbresponse.lastrowid
-        return dbid
+            return "ImageEncoding", "image_id"
+        raise ValueError("Must specify a type of encoding association.")
 
-    def get_image_id_by_attributes(self, image: ImageFile) -> Optional[int]:
+    def get_image_id_by_attributes(self, image: ImageFile, scanned_only: bool = False) -> Optional[int]:
         """
         Searches the database for an image with a given filename/date-modified/filesize combination.
         :param image: The image to check the database for
+        :param scanned_only: Ignore images that haven't been scanned for faces yet
         :return: Whether the image was found or not
         """
         # Get image
         sql = "SELECT * FROM Image WHERE filename = ? AND date_modified = ? AND size_bytes = ?"
-        params = self.adapt_ImageFile(image, include_path=False)
-        dbresponse = self.connection.execute(sql, params[0:3])  # Don't use exposure values
+        if scanned_only:
+            sql += " AND faces_scanned = 1"
+        params = self.file_attributes(image.filepath)  # File system only, so the file isn't opened
+        dbresponse = self.connection.execute(sql, params)
         result = dbresponse.fetchall()
 
         if len(result) > 1:
@@ -237,37 +669,380 @@ class Database:
 
         return dbid
 
+    def get_unmatched_encodings(self, first_image_id: int, last_image_id: int) -> Dict[int, List[FaceEncoding]]:
+        """
+        Loads the encodings that aren't associated with anybody, for a range of images.
+        :param first_image_id: Lowest image id to include
+        :param last_image_id: Highest image id to include
+        :return: Encodings keyed by image id
+        """
+        sql = """
+            SELECT IE.image_id, E.id, E.encoding, E.store_row, E.scale
+            FROM ImageEncoding IE
+            INNER JOIN Encoding E ON IE.encoding_id = E.id
+            WHERE IE.image_id BETWEEN ? AND ?
+                AND NOT EXISTS (SELECT 1 FROM PersonEncoding PE WHERE PE.encoding_id = E.id)
+            ORDER BY IE.image_id, E.id
+        """
+        rows = self.connection.execute(sql, [first_image_id, last_image_id]).fetchall()
+        output: Dict[int, List[FaceEncoding]] = {}
+        for row, encoding in zip(rows, self.adapt_encoding_rows(rows)):
+            output.setdefault(row["image_id"], []).append(encoding)
+        return output
+
+    def add_face_matches(self, matches: List[Tuple[int, int, float]]) -> None:
+        """
+        Records how close faces are to known people. If a face/person pair is already recorded, the smaller
+        distance is kept.
+        :param matches: (encoding id, person id, distance) for each pair
+        """
+        sql = """
+            INSERT INTO FaceMatch (encoding_id, person_id, distance) VALUES (?, ?, ?)
+            ON CONFLICT (encoding_id, person_id) DO UPDATE SET distance = MIN(distance, excluded.distance)
+        """
+        self.write_many(sql, matches)
+
+    def get_encoding_ids_with_face_matches(self, encoding_ids: List[int]) -> Set[int]:
+        """
+        :return: Those of encoding_ids that have distances to people recorded
+        """
+        sql = f"SELECT DISTINCT encoding_id FROM FaceMatch WHERE encoding_id IN ({','.join('?' * len(encoding_ids))})"
+        return {row["encoding_id"] for row in self.connection.execute(sql, encoding_ids)}
+
+    def get_face_matches(self, first_image_id: int, last_image_id: int, tolerance: float) \
+            -> Dict[int, List[Tuple[int, int, float]]]:
+        """
+        Loads recorded face/person pairs closer than a tolerance, for a range of images.
+        :return: (encoding id, person id, distance) keyed by image id, closest first
+        """
+        sql = """
+            SELECT IE.image_id, FM.encoding_id, FM.person_id, FM.distance
+            FROM FaceMatch FM
+            INNER JOIN ImageEncoding IE ON FM.encoding_id = IE.encoding_id
+            WHERE IE.image_id BETWEEN ? AND ?
+                AND FM.distance < ?
+            ORDER BY IE.image_id, FM.distance
+        """
+        output: Dict[int, List[Tuple[int, int, float]]] = {}
+        for row in self.connection.execute(sql, [first_image_id, last_image_id, tolerance]):
+            output.setdefault(row["image_id"], []).append((row["encoding_id"], row["person_id"], row["distance"]))
+        return output
+
+    def get_matched_associations(self, first_image_id: int, last_image_id: int) -> Dict[int, Set[Tuple[int, int]]]:
+        """
+        Loads the face/person associations that came from matching, for a range of images. Associations made any other
+        way, like the known folder or naming a cluster, have no recorded distance to that person and aren't included.
+        :return: (encoding id, person id) pairs keyed by image id
+        """
+        sql = """
+            SELECT IE.image_id, PE.encoding_id, PE.person_id
+            FROM ImageEncoding IE
+            INNER JOIN PersonEncoding PE ON IE.encoding_id = PE.encoding_id
+            WHERE IE.image_id BETWEEN ? AND ?
+                AND EXISTS (SELECT 1 FROM FaceMatch FM
+                            WHERE FM.encoding_id = PE.encoding_id AND FM.person_id = PE.person_id)
+        """
+        output: Dict[int, Set[Tuple[int, int]]] = {}
+        for row in self.connection.execute(sql, [first_image_id, last_image_id]):
+            output.setdefault(row["image_id"], set()).add((row["encoding_id"], row["person_id"]))
+        return output
+
+    def remove_person_encoding(self, encoding_id: int, person_id: int) -> None:
+        self.write("DELETE FROM PersonEncoding WHERE encoding_id = ? AND person_id = ?", [encoding_id, person_id])
+
+    def queue_keywords(self, image_id: int, to_append: List[str] = (), to_remove: List[str] = ()) -> None:
+        """
+        Records keyword changes for an image in the journal, to be written to the file later by the keyword writer.
+        They're part of the image's savepoint, so the journal always agrees with the associations stored with it.
+        """
+        rows = [(image_id, keyword, "add") for keyword in to_append] + \
+               [(image_id, keyword, "remove") for keyword in to_remove]
+        if not rows:
+            return
+        self.write_many("INSERT INTO KeywordJournal (image_id, keyword, action) VALUES (?, ?, ?)", rows)
+
+    def get_pending_keywords(self, after_image_id: int, max_images: int) \
+            -> Dict[int, Tuple[str, List[Tuple[int, str, str]]]]:
+        """
+        Loads journalled keyword changes that haven't been written to their files yet, for the next few images.
+        :param after_image_id: Only include images with a higher id
+        :param max_images: Maximum number of images to include
+        :return: Path and (journal id, keyword, action) in journal order, keyed by image id, in image id order
+        """
+        sql = """
+            SELECT KJ.image_id, I.path, KJ.id, KJ.keyword, KJ.action
+            FROM KeywordJournal KJ
+            INNER JOIN Image I ON KJ.image_id = I.id
+            WHERE KJ.applied IS NULL
+                AND KJ.image_id IN (
+                    SELECT DISTINCT image_id FROM KeywordJournal
+                    WHERE applied IS NULL AND image_id > ?
+                    ORDER BY image_id
+                    LIMIT ?)
+            ORDER BY KJ.image_id, KJ.id
+        """
+        output: Dict[int, Tuple[str, List[Tuple[int, str, str]]]] = {}
+        for row in self.connection.execute(sql, [after_image_id, max_images]):
+            output.setdefault(row["image_id"], (row["path"], []))[1].append((row["id"], row["keyword"], row["action"]))
+        return output
+
+    def remove_applied_keywords(self, journal_ids: List[int]) -> None:
+        """
+        Takes keyword changes that have been written to their files out of the journal, so it only ever holds
+        what's still to be written.
+        """
+        self.write_many("DELETE FROM KeywordJournal WHERE id = ?", [(journal_id,) for journal_id in journal_ids])
+
+    def count_pending_keywords(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM KeywordJournal WHERE applied IS NULL").fetchone()[0]
+
+    def get_encoding_matrix(self, unmatched_only: bool = False) -> Tuple[ndarray, ndarray]:
+        """
+        Loads every encoding as one matrix, for bulk work like clustering, without creating an object per encoding.
+        With a compacted EncodingStore this is a view of the file itself, so nothing is copied unless it's int8.
+        :param unmatched_only: Only load encodings that aren't associated with anybody
+        :return: Encoding ids, and an N x 128 matrix whose rows are those encodings in the same order. float32 for
+            an EncodingStore at a lower precision, float64 otherwise.
+        """
+        unmatched = " AND NOT EXISTS (SELECT 1 FROM PersonEncoding PE WHERE PE.encoding_id = Encoding.id)" \
+            if unmatched_only else ""
+        cursor = self.connection.cursor()
+        cursor.row_factory = None  # Plain tuples, straight into an array
+        if self.store:
+            cursor.execute(f"SELECT id, store_row FROM Encoding WHERE store_row IS NOT NULL{unmatched} ORDER BY id")
+            id_rows = numpy.array(cursor.fetchall(), dtype="int64").reshape(-1, 2)
+            ids, store_rows = id_rows[:, 0], id_rows[:, 1]
+            if len(store_rows) == self.store.rows and numpy.array_equal(store_rows, numpy.arange(len(store_rows))):
+                matrix = self.store.matrix()  # Every row in use, in order: no need to copy
+            else:
+                matrix = self.store.get(store_rows)
+            if self.store.dtype == "int8":
+                cursor.execute(f"SELECT scale FROM Encoding WHERE store_row IS NOT NULL{unmatched} ORDER BY id")
+                matrix = dequantize(matrix, [row[0] for row in cursor], "float32")
+            blob_rows = self.connection.execute(
+                f"SELECT id, encoding, scale FROM Encoding WHERE store_row IS NULL{unmatched} ORDER BY id").fetchall()
+            if not blob_rows:
+                return ids, matrix
+            blob_encodings = self.adapt_encoding_rows(blob_rows)
+            return (numpy.concatenate([ids, [e.dbid for e in blob_encodings]]),
+                    numpy.concatenate([matrix, [e.encoding for e in blob_encodings]]))
+
+        rows = cursor.execute(
+            f"SELECT id, encoding, scale FROM Encoding WHERE encoding IS NOT NULL{unmatched} ORDER BY id").fetchall()
+        if not rows:
+            return numpy.empty(0, dtype="int64"), numpy.empty((0, EncodingStore.width))
+        ids = numpy.array([row[0] for row in rows], dtype="int64")
+        return ids, decode_blobs([row[1] for row in rows], [row[2] for row in rows])
+
+    def pack_encodings(self, chunk_size: int = 10000) -> int:
+        """
+        Moves encodings stored as BLOBs into the EncodingStore, creating it if needed. Each chunk is committed as it
+        goes, so this can be stopped and restarted.
+        :return: Number of encodings moved
+        """
+        if not self.store:
+            self.store = EncodingStore(self.db_file_path, 0, 0, self.precision)
+            self.set_setting(self.store_generation_setting, 0)
+            self.set_setting(self.store_rows_setting, 0)
+        moved = 0
+        while True:
+            rows = self.connection.execute(
+                "SELECT id, encoding, scale FROM Encoding WHERE store_row IS NULL AND encoding IS NOT NULL "
+                "ORDER BY id LIMIT ?", [chunk_size]).fetchall()
+            if not rows:
+                break
+            values, scales = quantize(decode_blobs([row["encoding"] for row in rows], [row["scale"] for row in rows]),
+                                      self.store.dtype)
+            scales = scales.tolist() if scales is not None else [None] * len(rows)
+            store_rows = self.store.append(values)
+            with self.store_transaction():
+                self.write_many("UPDATE Encoding SET store_row = ?, scale = ?, encoding = NULL WHERE id = ?",
+                                [(store_row, scale, row["id"])
+                                 for store_row, scale, row in zip(store_rows, scales, rows)])
+                self.set_setting(self.store_rows_setting, self.store.rows)
+            self.flush()
+            moved += len(rows)
+        self.flush()
+        return moved
+
+    def compact_encoding_store(self, precision: Optional[str] = None) -> int:
+        """
+        Rewrites the EncodingStore without rows nothing points at (left by rolled-back writes) and without spare
+        capacity, in encoding id order. The new file is switched to in the same commit that renumbers the rows, so
+        stopping part way leaves the old file in use.
+        :param precision: Also convert the store to this precision. Keeps the current one if not specified.
+        :return: Number of rows in the compacted store
+        """
+        if not self.store:
+            return 0
+        self.flush()
+        rows = self.connection.execute(
+            "SELECT id, store_row, scale FROM Encoding WHERE store_row IS NOT NULL ORDER BY id").fetchall()
+        encodings = self.store.get([row["store_row"] for row in rows])
+        scales = [row["scale"] for row in rows]
+        if precision and precision != self.store.dtype:
+            encodings, new_scales = quantize(dequantize(encodings, scales), precision)
+            scales = new_scales.tolist() if new_scales is not None else [None] * len(rows)
+        compacted = self.store.write_next_generation(encodings)
+
+        self.connection.execute("BEGIN")
+        self.connection.executemany("UPDATE Encoding SET store_row = ?, scale = ? WHERE id = ?",
+                                    [(new_row, scale, row["id"])
+                                     for new_row, (scale, row) in enumerate(zip(scales, rows))])
+        self.connection.execute("INSERT OR REPLACE INTO Setting (name, value) VALUES (?, ?)",
+                                [self.store_generation_setting, compacted.generation])
+        self.connection.execute("INSERT OR REPLACE INTO Setting (name, value) VALUES (?, ?)",
+                                [self.store_rows_setting, compacted.rows])
+        self.connection.commit()
+
+        self.store.delete()
+        self.store = compacted
+        return compacted.rows
+
+    def set_precision(self, precision: str, chunk_size: int = 10000) -> int:
+        """
+        Changes how encodings are stored, and converts the ones already stored. BLOBs are converted a chunk at a
+        time, each committed as it goes, so this can be stopped and restarted; an EncodingStore is rewritten like
+        compact_encoding_store does. Going to a lower precision is permanent: converting back doesn't restore
+        what was rounded off.
+        :param precision: One of Quantizer.precisions
+        :return: Number of encodings converted
+        """
+        if precision not in precisions:
+            raise ValueError(f"Unknown encoding precision '{precision}', expected one of {precisions}")
+        self.set_setting(self.precision_setting, precision)
+        self.flush()
+        self.precision = precision
+
+        converted = 0
+        if self.store and self.store.dtype != precision:
+            converted += self.compact_encoding_store(precision)
+        blob_size = EncodingStore.width * numpy.dtype(precision).itemsize
+        while True:
+            rows = self.connection.execute(
+                "SELECT id, encoding, scale FROM Encoding WHERE encoding IS NOT NULL AND length(encoding) != ? "
+                "ORDER BY id LIMIT ?", [blob_size, chunk_size]).fetchall()
+            if not rows:
+                break
+            values, scales = quantize(decode_blobs([row["encoding"] for row in rows], [row["scale"] for row in rows]),
+                                      precision)
+            scales = scales.tolist() if scales is not None else [None] * len(rows)
+            self.write_many("UPDATE Encoding SET encoding = ?, scale = ? WHERE id = ?",
+                            [(value.tobytes(), scale, row["id"]) for value, scale, row in zip(values, scales, rows)])
+            self.flush()
+            converted += len(rows)
+        return converted
+
+    def replace_face_clusters(self, encoding_ids: List[int], cluster_ids: List[int]) -> None:
+        """
+        Replaces every recorded cluster with new ones.
+        :param encoding_ids: Encodings in a cluster
+        :param cluster_ids: Cluster of each encoding, in the same order
+        """
+        self.write("DELETE FROM FaceCluster")
+        self.write_many("INSERT INTO FaceCluster (encoding_id, cluster_id) VALUES (?, ?)",
+                        zip(map(int, encoding_ids), map(int, cluster_ids)))
+
+    def get_face_clusters(self, limit: int) -> List[Tuple[int, int, str]]:
+        """
+        :return: (cluster id, number of faces, path of one picture with a face in it) of the biggest clusters,
+            biggest first
+        """
+        sql = """
+            SELECT FC.cluster_id, COUNT(*) AS faces, MIN(I.path) AS example
+            FROM FaceCluster FC
+            INNER JOIN ImageEncoding IE ON FC.encoding_id = IE.encoding_id
+            INNER JOIN Image I ON IE.image_id = I.id
+            GROUP BY FC.cluster_id
+            ORDER BY faces DESC, FC.cluster_id
+            LIMIT ?
+        """
+        return [(row["cluster_id"], row["faces"], row["example"]) for row in self.connection.execute(sql, [limit])]
+
+    def get_face_cluster(self, cluster_id: int) -> Dict[int, List[int]]:
+        """
+        :return: Ids of the cluster's encodings, keyed by the id of the image they're in
+        """
+        sql = """
+            SELECT IE.image_id, FC.encoding_id
+            FROM FaceCluster FC
+            INNER JOIN ImageEncoding IE ON FC.encoding_id = IE.encoding_id
+            WHERE FC.cluster_id = ?
+            ORDER BY IE.image_id, FC.encoding_id
+        """
+        output: Dict[int, List[int]] = {}
+        for row in self.connection.execute(sql, [cluster_id]):
+            output.setdefault(row["image_id"], []).append(row["encoding_id"])
+        return output
+
+    def delete_face_cluster(self, cluster_id: int) -> None:
+        self.write("DELETE FROM FaceCluster WHERE cluster_id = ?", [cluster_id])
+
+    def get_person_names(self) -> Dict[int, str]:
+        return {row["id"]: row["name"] for row in self.connection.execute("SELECT id, name FROM Person")}
+
+    def get_image_path(self, image_id: int) -> str:
+        return self.connection.execute("SELECT path FROM Image WHERE id = ?", [image_id]).fetchone()["path"]
+
+    def get_max_id(self, table: str) -> int:
+        """
+        :return: Highest id in a table, or 0 if it's empty
+        """
+        return self.connection.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+
+    def get_setting(self, name: str, default=None):
+        row = self.connection.execute("SELECT value FROM Setting WHERE name = ?", [name]).fetchone()
+        return row["value"] if row else default
+
+    def set_setting(self, name: str, value) -> None:
+        self.write("INSERT OR REPLACE INTO Setting (name, value) VALUES (?, ?)", [name, value])
+
+    def get_image_ids_by_stat(self, scanned_only: bool = True) -> Dict[Tuple[str, int, int], int]:
+        """
+        Loads the path/modified-time/size key of every image in one query, so unchanged files can be recognized
+        with nothing more than os.stat. Images indexed before mtime_ns was tracked aren't included.
+        :param scanned_only: Leave out images that haven't been scanned for faces yet
+        :return: Image ids keyed by (path, st_mtime_ns, st_size), matching ImageFile.stat_key()
+        """
+        sql = "SELECT id, path, mtime_ns, size_bytes FROM Image WHERE mtime_ns IS NOT NULL"
+        if scanned_only:
+            sql += " AND faces_scanned = 1"
+        dbresponse = self.connection.execute(sql)
+        return {(row["path"], row["mtime_ns"], row["size_bytes"]): row["id"] for row in dbresponse}
+
+    def get_person_ids_by_image_id(self, image_id: int) -> Set[int]:
+        """
+        :return: Ids of the people already associated with faces in an image
+        """
+        sql = """
+            SELECT DISTINCT PE.person_id
+            FROM ImageEncoding IE
+            INNER JOIN PersonEncoding PE ON IE.encoding_id = PE.encoding_id
+            WHERE IE.image_id = ?
+        """
+        dbresponse = self.connection.execute(sql, [image_id])
+        return {row["person_id"] for row in dbresponse}
+
     def get_encodings_by_image_id(self, image_id: int) -> List[FaceEncoding]:
         sql = """
-        SELECT E.id, E.encoding
+        SELECT E.id, E.encoding, E.store_row, E.scale
         FROM ImageEncoding IE
         INNER JOIN Encoding E ON IE.encoding_id = E.id
         WHERE IE.image_id = ?
+        ORDER BY E.id  -- The order faces are matched in, which re-tagging follows
         """
         dbresponse = self.connection.execute(sql, [image_id])
-        encoding_rows = dbresponse.fetchall()
-        output = []
-        for row in encoding_rows:
-            encoding = numpy.frombuffer(row["encoding"], dtype="float64")
-            output.append(FaceEncoding(row["id"], encoding))
-        return output
+        return self.adapt_encoding_rows(dbresponse.fetchall())
 
     def get_encodings_by_person_id(self, person_id: int) -> List[FaceEncoding]:
         sql = """
-            SELECT E.id, E.encoding
+            SELECT E.id, E.encoding, E.store_row, E.scale
             FROM PersonEncoding PE
             INNER JOIN Encoding E ON PE.encoding_id = E.id
             WHERE PE.person_id = ?
         """
         dbresponse = self.connection.execute(sql, [person_id])
-        encoding_rows = dbresponse.fetchall()
-        output = []
-
-        # TODO: Code duplication, add adapter/converter
-        for row in encoding_rows:
-            encoding = numpy.frombuffer(row["encoding"], dtype="float64")
-            output.append(FaceEncoding(row["id"], encoding))
-        return output
+        return self.adapt_encoding_rows(dbresponse.fetchall())
 
     def get_images_by_person_id(self, person_id: int) -> List[str]:
         sql = """
@@ -282,58 +1057,139 @@ class Database:
         results = dbresponse.fetchall()
         return [row["path"] for row in results]
 
-    def get_all_people(self):
-        sql = "SELECT * from Person"
-        dbresponse = self.connection.execute(sql)
-        results = dbresponse.fetchall()
-
-        output = []
-        for p_row in results:
-            person_id = p_row["id"]
-            found_encodings = self.get_encodings_by_person_id(person_id)
-            output.append(Person(person_id, p_row["name"], found_encodings))
-
-        return output
+    def get_all_people(self) -> List[Person]:
+        return self.get_people()
 
     def get_person_by_name(self, name: str) -> Optional[Person]:
-        sql = "SELECT * FROM Person WHERE name = ?"
-        dbresponse = self.connection.execute(sql, [name])
-        results = dbresponse.fetchall()
+        results = self.get_people(name)
 
         if len(results) < 1:
             return None
         if len(results) > 1:
             raise Exception(f"Multiple people found with name {name}")
-        row = results[0]
-        person_id = row["id"]
-        encodings = self.get_encodings_by_person_id(person_id)
+        return results[0]
+
+    def get_people(self, name: Optional[str] = None, associated_after: Optional[int] = None) -> List[Person]:
+        """
+        Loads people and all of their encodings with a single query, instead of one query per person.
+        :param name: Only load people with this name. Loads everyone if not specified.
+        :param associated_after: Only load encodings whose PersonEncoding id is above this, and only people with
+            at least one such encoding.
+        :return: People in id order
+        """
+        conditions, params = [], []
+        if name is not None:
+            conditions.append("P.name = ?")
+            params.append(name)
+        if associated_after is not None:
+            conditions.append("PE.id > ?")
+            params.append(associated_after)
+        sql = f"""
+            SELECT P.id, P.name, E.id, E.encoding, E.store_row, E.scale
+            FROM Person P
+            LEFT JOIN PersonEncoding PE ON P.id = PE.person_id
+            LEFT JOIN Encoding E ON PE.encoding_id = E.id
+            {"WHERE " + " AND ".join(conditions) if conditions else ""}
+            ORDER BY P.id
+        """
+        cursor = self.connection.cursor()
+        cursor.row_factory = None  # Plain tuples, this can be a lot of rows
+        cursor.execute(sql, params)
+
+        # One pass over the rows, streaming from SQLite. Encodings are decoded together at the end.
+        people: List[Person] = []
+        encoding_ids: List[int] = []
+        blobs: List[bytes] = []
+        store_rows: List[int] = []
+        scales: List[float] = []
+        owners: List[Person] = []
+        for person_id, person_name, encoding_id, blob, store_row, scale in cursor:
+            if len(people) == 0 or people[-1].dbid != person_id:
+                people.append(Person(person_id, person_name, []))
+            if encoding_id is not None:
+                encoding_ids.append(encoding_id)
+                blobs.append(blob)
+                store_rows.append(store_row)
+                scales.append(scale)
+                owners.append(people[-1])
 
-        return Person(person_id, row["name"], encodings)
+        for owner, encoding in zip(owners, self.adapt_encoding_blobs(encoding_ids, blobs, store_rows, scales)):
+            owner.encodings.append(encoding)
+        return people
 
     # Pseudo-adapters - Don't always want every parameter, so not using the real "adapters" functionality
-    @classmethod
-    def adapt_ImageFile(cls, image: ImageFile, include_path: bool = True):
-        # Date and time stamp of the last time the file was modified
-        mtime = cls.get_formatted_date_modified(image.filepath)
+    @staticmethod
+    def adapt_face_region(row) -> FaceRegion:
+        landmarks = None if row["landmarks"] is None \
+            else numpy.frombuffer(row["landmarks"], dtype="int32").reshape(-1, 2).astype("int64")
+        return FaceRegion((row["box_top"], row["box_right"], row["box_bottom"], row["box_left"]), landmarks,
+                          row["detector"], row["source_scale"])
 
-        exif_data = image.get_salient_exif_data()
-        date_taken = exif_data.get("date_taken")
-        date_taken = date_taken and date_taken.strftime(cls.datetime_format_string)  # Null conditional
+    def adapt_encoding_rows(self, rows) -> List[FaceEncoding]:
+        """
+        :param rows: Rows with "id", "encoding", "store_row" and "scale" columns
+        :return: One FaceEncoding per row, in the same order
+        """
+        return self.adapt_encoding_blobs([row["id"] for row in rows], [row["encoding"] for row in rows],
+                                         [row["store_row"] for row in rows], [row["scale"] for row in rows])
+
+    def adapt_encoding_blobs(self, encoding_ids: List[int], blobs: List[Optional[bytes]],
+                             store_rows: Optional[List[Optional[int]]] = None,
+                             scales: Optional[List[Optional[float]]] = None) -> List[FaceEncoding]:
+        """
+        Decodes encodings in bulk: BLOBs are joined into one buffer and viewed as a single matrix, and packed
+        encodings are read from the EncodingStore with one fancy index, so every returned encoding is a row of the
+        same array rather than its own allocation. Encodings stored at a lower precision come back as float64.
+        :param encoding_ids: Database id of each encoding
+        :param blobs: Raw bytes of each encoding, in the same order. None for encodings in the store.
+        :param store_rows: EncodingStore row of each encoding, in the same order. None for encodings in BLOBs.
+        :param scales: Scale of each int8 encoding, in the same order. None for other precisions.
+        :return: One FaceEncoding per encoding, in the same order
+        """
+        if len(blobs) == 0:
+            return []
+        if store_rows is None or all(row is None for row in store_rows):
+            matrix = decode_blobs(blobs, scales)
+        else:
+            matrix = numpy.empty((len(blobs), EncodingStore.width), dtype="float64")
+            in_store = [i for i, row in enumerate(store_rows) if row is not None]
+            matrix[in_store] = dequantize(self.store.get([store_rows[i] for i in in_store]),
+                                          [scales[i] for i in in_store] if self.store.dtype == "int8" else None)
+            in_blobs = [i for i, row in enumerate(store_rows) if row is None]
+            if in_blobs:
+                matrix[in_blobs] = decode_blobs([blobs[i] for i in in_blobs],
+                                                [scales[i] for i in in_blobs] if scales is not None else None)
+        return [FaceEncoding(encoding_id, encoding) for encoding_id, encoding in zip(encoding_ids, matrix)]
 
+    @classmethod
+    def adapt_ImageFile(cls, image: ImageFile, include_path: bool = True):
         # Relative path is last because we won't always use it
-        output = [os.path.basename(image.filepath),  # 0
-                  mtime,                             # 1
-                  os.path.getsize(image.filepath),   # 2
-                  exif_data.get("aperture"),         # 3
-                  exif_data.get("shutter_speed"),    # 4
-                  exif_data.get("iso"),              # 5
-                  date_taken                         # 6
-                  ]
+        output = cls.file_attributes(image.filepath)  # 0-2
+        output += cls.adapt_exif(image.get_salient_exif_data())  # 3-6
         if include_path:
-            output.append(image.filepath)            # 7
+            output.append(image.filepath)  # 7
 
         return output
 
+    @classmethod
+    def adapt_exif(cls, exif_data: Dict) -> list:
+        """
+        :return: Aperture, shutter speed, ISO and formatted date taken, as stored in the Image table
+        """
+        date_taken = exif_data.get("date_taken")
+        date_taken = date_taken and date_taken.strftime(cls.datetime_format_string)  # Null conditional
+        return [exif_data.get("aperture"), exif_data.get("shutter_speed"), exif_data.get("iso"), date_taken]
+
+    @classmethod
+    def file_attributes(cls, filepath: str) -> list:
+        """
+        :return: Filename, formatted date modified and size in bytes: what identifies an image in the Image table
+        """
+        stat = os.stat(filepath)
+        return [os.path.basename(filepath),
+                datetime.fromtimestamp(stat.st_mtime).strftime(cls.datetime_format_string),
+                stat.st_size]
+
     @classmethod
     def get_formatted_date_modified(cls, filepath: str):
         return datetime.fromtimestamp(os.path.getmtime(filepath)).strftime(cls.datetime_format_string)
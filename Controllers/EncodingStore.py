@@ -0,0 +1,128 @@
+# Builtins
+from pathlib import Path
+from typing import List
+import os
+
+# External modules
+import numpy
+from numpy import ndarray
+from numpy.lib.format import open_memmap
+
+
+class EncodingStore:
+    """
+    Every face encoding packed into one memory-mapped N x 128 .npy file next to the database, instead of one
+    BLOB per row. The file's dtype is the database's storage precision (see Quantizer). The database keeps each
+    encoding's row number (Encoding.store_row) and how many rows are in use, so the store commits and rolls back
+    along with the database: rows written by a transaction that never committed are simply written over by the next
+    append.
+
+    The file has spare capacity at the end and doubles in size when it fills up. Compacting writes a new generation
+    of the file, so the database can switch to it in the same transaction that renumbers the rows. Changing
+    precision works the same way.
+    """
+    width = 128  # Values per encoding
+    initial_capacity = 1024
+
+    def __init__(self, db_file_path: str, generation: int, rows: int, dtype: str = "float64"):
+        """
+        :param db_file_path: Path to the database the store belongs to
+        :param generation: Which generation of the file to open. Created if it doesn't exist.
+        :param rows: Number of rows in use, as last committed to the database
+        :param dtype: dtype of a new file. An existing file keeps its own.
+        """
+        self.db_file_path = db_file_path
+        self.generation = generation
+        self.rows = rows
+        self.filepath = self.path_for(db_file_path, generation)
+        if os.path.exists(self.filepath):
+            self.memmap: ndarray = numpy.load(self.filepath, mmap_mode="r+")
+        else:
+            self.memmap = open_memmap(self.filepath, mode="w+", dtype=dtype,
+                                      shape=(max(self.initial_capacity, rows), self.width))
+        self.dtype = str(self.memmap.dtype)
+
+    @staticmethod
+    def path_for(db_file_path: str, generation: int) -> str:
+        db_path = Path(db_file_path)
+        suffix = f".{generation}" if generation else ""
+        return str(db_path.with_name(f"{db_path.stem}.encodings{suffix}.npy"))
+
+    def capacity(self) -> int:
+        return self.memmap.shape[0]
+
+    def matrix(self) -> ndarray:
+        """
+        :return: Every row in use, as a view of the file. Nothing is copied or read until it's used.
+        """
+        return self.memmap[:self.rows]
+
+    def get(self, store_rows) -> ndarray:
+        """
+        :return: The given rows, copied into a new array
+        """
+        return self.memmap[numpy.asarray(store_rows, dtype="int64")]
+
+    def append(self, encodings: List[ndarray]) -> List[int]:
+        """
+        Writes encodings after the last row in use, growing the file if needed. The new row count only becomes
+        permanent once the caller has committed it to the database.
+        :return: Row number of each encoding, in the same order
+        """
+        first_row = self.rows
+        needed = first_row + len(encodings)
+        if needed > self.capacity():
+            self.grow(max(needed, self.capacity() * 2))
+        self.memmap[first_row:needed] = encodings
+        self.rows = needed
+        return list(range(first_row, needed))
+
+    def grow(self, capacity: int) -> None:
+        """
+        Copies the store into a bigger file and swaps it in. The old file stays in place until the copy is complete.
+        """
+        temp_path = self.filepath + ".tmp"
+        bigger = open_memmap(temp_path, mode="w+", dtype=self.dtype, shape=(capacity, self.width))
+        bigger[:self.rows] = self.memmap[:self.rows]
+        bigger.flush()
+        del bigger
+        self.close()
+        os.replace(temp_path, self.filepath)
+        self.memmap = numpy.load(self.filepath, mmap_mode="r+")
+
+    def write_next_generation(self, encodings: ndarray) -> "EncodingStore":
+        """
+        Writes the next generation of the store holding just the given encodings, in their dtype and order. This
+        store isn't changed; once the database has been renumbered to match, switch to the new generation and delete
+        this one's file.
+        :param encodings: Contents of the new file, one encoding per row. Row i becomes row i.
+        :return: The new generation, already flushed to disk
+        """
+        next_path = self.path_for(self.db_file_path, self.generation + 1)
+        if os.path.exists(next_path):  # Left behind by a compaction that was interrupted before it was committed
+            os.remove(next_path)
+        next_store = EncodingStore(self.db_file_path, self.generation + 1, 0, str(encodings.dtype))
+        if len(encodings) > 0:
+            next_store.append(encodings)
+        next_store.flush()
+        return next_store
+
+    def flush(self) -> None:
+        """
+        Makes sure everything appended so far is on disk. Must happen before the row count is committed.
+        """
+        self.memmap.flush()
+
+    def close(self) -> None:
+        self.memmap.flush()
+        mmap = getattr(self.memmap, "_mmap", None)
+        del self.memmap
+        if mmap is not None:
+            try:
+                mmap.close()
+            except BufferError:
+                pass  # Views from matrix() are still in use. The file is unmapped once they're gone.
+
+    def delete(self) -> None:
+        self.close()
+        os.remove(self.filepath)
@@ -1,108 +1,607 @@
 # Builtins
-from collections import namedtuple
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple, Set, Union, BinaryIO
 import face_recognition as fr
+import dlib
 import numpy
 from numpy import ndarray  # Encoded faces
 
 # External modules
 from PIL import Image as pilmage
+try:
+    import cv2  # Optional, only the face-presence gate uses OpenCV
+except ImportError:
+    cv2 = None
 
 # Custom code
 from Model.FaceEncoding import FaceEncoding
+from Model.FaceRegion import FaceRegion
 from Model.Person import Person
+from Controllers.Quantizer import exact_in_float32
 
 
 GOAL_SIZE = 1250  # Determined by testing as a good compromise between speed and accuracy
+DETECT_SIZE = 500  # Two-stage detection finds faces in an image this size...
+ENCODE_SIZE = 2500  # ...then encodes them from crops of a decode at least this size
+MAX_FACE_SIZE = 250  # Crops are shrunk so faces are no bigger than this, since encodings are made at 150px anyway
+CROP_MARGIN = 0.5  # Space left around a face in its crop, as a fraction of its size, for landmarks outside the box
+# Sizes adaptive detection looks for faces at, smallest first. Faces in crowds are too small at 500px for HOG to
+# find even a near miss, so it starts higher.
+ADAPTIVE_LEVELS = (800, 1250, 2000)
+ESCALATE_FACE_SIZE = 50  # A face this close to the ~40px smallest HOG finds suggests smaller ones were missed...
+WEAK_SCORE = -0.5  # ...and so does HOG finding something that scores between this and 0, not quite a face
+detection_modes = ["standard", "two-stage", "adaptive"]
+# A face's bounding box as (top, right, bottom, left), like face_recognition's, but in pixels of the full-size image
+Location = Tuple[int, int, int, int]
+# Face-presence gate settings, from the most faces let through to the fewest: longest side of the grayscale copy
+# searched, Haar scale factor and Haar minimum neighbours. Chosen with test-scripts/bench-face-gate.py.
+gate_presets = {
+    "high-recall": (800, 1.2, 3),
+    "balanced": (640, 1.2, 3),
+    "fast": (480, 1.2, 5),
+}
+# Detectors FindFaces can use. Only cnn is run on a whole batch in one call; see FindFaces.
+batch_models = ["hog", "cnn"]
+BUCKET_STEP = 32  # Batched frames are padded up to a multiple of this, so near-identical sizes share a batch
+GATE_MIN_FACE = 20  # Smallest face the gate looks for, in pixels of its copy
+GATE_CASCADE = "haarcascade_frontalface_default.xml"
+_cascade = None  # Loaded the first time it's used in each process, since it can't be sent to workers
 
 
-def encode_faces(filepath: str, jitter: int = 1, resize_to: int = 1500) -> List[ndarray]:
+def encode_faces(filepath: Union[str, BinaryIO], jitter: int = 1, resize_to: int = GOAL_SIZE,
+                 draft: bool = True) -> List[ndarray]:
     """
     Populates the encodings_in_image field of an Image
 
-    :param filepath: Path to a readable image with zero or more faces.
+    :param filepath: Path to a readable image with zero or more faces, or the image's contents as a file object.
     :param jitter: How many times to transform a face. Higher number is slower but more accurate.
     :param resize_to: Size to resize to. Lower number is faster but less accurate.
+    :param draft: Let the JPEG decoder scale down while decoding instead of decoding every pixel.
     :return: The input list of images.
     """
+    return encode_faces_with_regions(filepath, jitter, draft=draft, detect_size=resize_to)[0]
+
+
+def encode_faces_with_locations(filepath: Union[str, BinaryIO], jitter: int = 1, detection: str = "standard",
+                                draft: bool = True, detect_size: Optional[int] = None, gate: Optional[str] = None) \
+        -> Tuple[List[ndarray], List[Location]]:
+    """
+    As encode_faces_with_regions, keeping only where each face is.
+    :return: Encodings found, and the location of each in the full-size image
+    """
+    encodings, regions = encode_faces_with_regions(filepath, jitter, detection, draft, detect_size, gate)
+    return encodings, [region.box for region in regions]
+
+
+def encode_faces_with_regions(filepath: Union[str, BinaryIO], jitter: int = 1, detection: str = "standard",
+                              draft: bool = True, detect_size: Optional[int] = None, gate: Optional[str] = None) \
+        -> Tuple[List[ndarray], List[FaceRegion]]:
+    """
+    As find_and_encode, without the size faces were looked for at.
+    :return: Encodings found, and the region of each in the full-size image
+    """
+    return find_and_encode(filepath, jitter, detection, draft, detect_size, gate)[:2]
+
+
+def find_and_encode(filepath: Union[str, BinaryIO], jitter: int = 1, detection: str = "standard",
+                    draft: bool = True, detect_size: Optional[int] = None, gate: Optional[str] = None) \
+        -> Tuple[List[ndarray], List[FaceRegion], int]:
+    """
+    Finds and encodes every face in an image, keeping where each face was found and the landmarks it was encoded
+    from.
+
+    standard finds and encodes faces in one GOAL_SIZE image. two-stage finds faces in a smaller DETECT_SIZE image,
+    which is quicker, then encodes each face from a crop of a decode at least ENCODE_SIZE, so faces are encoded from
+    at least as many pixels as before. An image with no faces is only ever decoded small. The smallest face that can
+    be found is about 40px in the image faces are looked for in, so at the default DETECT_SIZE, faces smaller than
+    about a twelfth of the image's longest side are missed. adaptive is two-stage with the size picked per image by
+    find_faces_adaptive: small for portraits and pictures of nobody, larger for crowds.
+    :param filepath: Path to a readable image with zero or more faces, or the image's contents as a file object.
+    :param jitter: How many times to transform a face. Higher number is slower but more accurate.
+    :param detection: One of detection_modes
+    :param draft: Let the JPEG decoder scale down while decoding instead of decoding every pixel.
+    :param detect_size: Size of the image faces are looked for in, GOAL_SIZE for standard detection and DETECT_SIZE
+        for two-stage if not given. For adaptive, the largest size it goes up to.
+    :param gate: One of gate_presets to check for faces with might_have_faces first, or None to always look
+    :return: Encodings found, the region of each in the full-size image, and the size faces were looked for at (0
+        if the gate turned the image away)
+    """
     # TODO: EXIF rotate images prior to encoding them
+    if detection not in detection_modes:
+        raise ValueError(f"Unknown detection mode '{detection}', expected one of {detection_modes}")
+    if gate and not gate_available():
+        raise ImportError("The face-presence gate needs OpenCV: pip install opencv-python-headless")
+
+    if detection == "adaptive":
+        levels = ADAPTIVE_LEVELS
+        if detect_size:  # Goes up to detect_size itself, even when it's between levels
+            levels = tuple(level for level in ADAPTIVE_LEVELS if level < detect_size) + (detect_size,)
+        locations, source_scale, searched_size = find_faces_adaptive(filepath, levels, draft, gate)
+    else:
+        content = open_image(filepath)
+        full_size = content.size
+        searched_size = detect_size or (DETECT_SIZE if detection == "two-stage" else GOAL_SIZE)
+        resized = resize_longest(content, searched_size, draft)
+        as_numpy_arr = numpy.array(resized)
+        if gate and not might_have_faces(as_numpy_arr, gate):
+            return [], [], 0
+        found_locations = fr.face_locations(as_numpy_arr)
+        source_scale = full_size[0] / resized.size[0]
+        if detection == "standard":
+            found_encodings, landmarks = encode_with_landmarks(as_numpy_arr, found_locations, jitter)
+            return found_encodings, [FaceRegion(location, points, "hog", 1.0).scaled(source_scale)
+                                     for location, points in zip(found_locations, landmarks)], searched_size
+        locations = scale_locations(found_locations, source_scale)
+
+    if not locations:
+        return [], [], searched_size
+    found_encodings, landmarks = encode_crops(filepath, locations, jitter, draft)
+    return found_encodings, [FaceRegion(location, points, "hog", source_scale)
+                             for location, points in zip(locations, landmarks)], searched_size
+
+
+def find_faces_adaptive(filepath: Union[str, BinaryIO], levels: Tuple[int, ...] = ADAPTIVE_LEVELS, draft: bool = True,
+                        gate: Optional[str] = None) -> Tuple[List[Location], float, int]:
+    """
+    Looks for faces at the smallest of levels first, and only goes up a level when what it found suggests faces are
+    being missed: a face under ESCALATE_FACE_SIZE, so near the smallest that can be found at that level, or
+    something away from the faces found that almost passed for one (scoring between WEAK_SCORE and 0). Textures
+    like grass and gravel make near misses at every size, so they only send it up one level. Faces are taken from
+    the last level looked at. Levels past the image's own size (or GOAL_SIZE if that's bigger) are cut down to it,
+    and the gate only sees the first level.
+    :param filepath: Path to a readable image, or its contents as a file object
+    :param levels: Longest sides to look for faces at, smallest first
+    :param draft: Let the JPEG decoder scale down while decoding instead of decoding every pixel.
+    :param gate: One of gate_presets to check the first level with might_have_faces, or None to always look
+    :return: Where faces are in the full-size image, full-size pixels per pixel of the level they were found at, and
+        that level's size (0 if the gate turned the image away)
+    """
+    locations, source_scale = [], 1.0
+    went_up_for_near_misses = False
+    for i, level in enumerate(levels):
+        content = open_image(filepath)
+        full_width, longest_side = content.size[0], max(content.size)
+        if i > 0:
+            # Small images are enlarged to GOAL_SIZE like standard detection does, but no further
+            largest = max(longest_side, GOAL_SIZE)
+            if searched_size >= largest:
+                break
+            level = min(level, largest)
+        resized = resize_longest(content, level, draft)
+        pixels = numpy.array(resized)
+        if i == 0 and gate and not might_have_faces(pixels, gate):
+            return [], 1.0, 0
+        found, weak = detect_with_scores(pixels)
+        locations, source_scale, searched_size = found, full_width / resized.size[0], level
+        if any(bottom - top < ESCALATE_FACE_SIZE for top, right, bottom, left in found):
+            continue
+        if weak == 0 or went_up_for_near_misses:
+            break
+        went_up_for_near_misses = True
+    return scale_locations(locations, source_scale), source_scale, searched_size
+
+
+def detect_with_scores(pixels: ndarray) -> Tuple[List[Location], int]:
+    """
+    face_recognition.face_locations with the hog model, also counting near misses.
+    :param pixels: Image to look for faces in
+    :return: Where faces are in pixels, and how many things away from them scored between WEAK_SCORE and 0
+    """
+    rectangles, scores, _ = fr.api.face_detector.run(pixels, 1, WEAK_SCORE)
+    height, width = pixels.shape[:2]
+    faces = [rect for rect, score in zip(rectangles, scores) if score >= 0]
+    # Near misses around a face that was found are the same face again
+    weak = sum(score < 0 and not any(rect.intersect(face).area() > 0 for face in faces)
+               for rect, score in zip(rectangles, scores))
+    locations = [(max(rect.top(), 0), min(rect.right(), width), min(rect.bottom(), height), max(rect.left(), 0))
+                 for rect in faces]
+    return locations, weak
+
+
+def encode_with_landmarks(pixels: ndarray, locations: List[Location], jitter: int = 1) \
+        -> Tuple[List[ndarray], List[ndarray]]:
+    """
+    face_recognition.face_encodings with the large model, also keeping the 68 landmark points it finds in each face
+    on the way to encoding it.
+    :param pixels: Image the faces are in
+    :param locations: Where the faces are in pixels
+    :param jitter: How many times to transform a face. Higher number is slower but more accurate.
+    :return: Encoding of each face, and its landmarks as 68 (x, y) rows, in the same order
+    """
+    encodings, landmarks = [], []
+    for top, right, bottom, left in locations:
+        shape = fr.api.pose_predictor_68_point(pixels, dlib.rectangle(left, top, right, bottom))
+        encodings.append(numpy.array(fr.api.face_encoder.compute_face_descriptor(pixels, shape, jitter)))
+        landmarks.append(numpy.array([(point.x, point.y) for point in shape.parts()], dtype="int64"))
+    return encodings, landmarks
+
+
+def gate_available() -> bool:
+    return cv2 is not None
+
+
+def might_have_faces(pixels: ndarray, gate: str) -> bool:
+    """
+    Face-presence gate: a quick look for anything face-like with OpenCV's Haar cascades on a small grayscale copy,
+    so pictures without people can skip dlib's much slower detector. Anything it lets through is still checked by
+    dlib, but a face it misses is never encoded, so it trades recall for speed. Only frontal faces are looked for:
+    searching for faces in profile as well made the gate slower than dlib itself.
+    :param pixels: Image as decoded for detection
+    :param gate: One of gate_presets
+    :return: Whether dlib should look for faces
+    """
+    global _cascade
+    if _cascade is None:
+        _cascade = cv2.CascadeClassifier(cv2.data.haarcascades + GATE_CASCADE)
+
+    size, scale_factor, min_neighbors = gate_presets[gate]
+    gray = pixels if pixels.ndim == 2 else cv2.cvtColor(pixels, cv2.COLOR_RGB2GRAY)
+    shrink = size / max(gray.shape)
+    if shrink < 1:
+        gray = cv2.resize(gray, None, fx=shrink, fy=shrink, interpolation=cv2.INTER_AREA)
+    found = _cascade.detectMultiScale(gray, scale_factor, min_neighbors, minSize=(GATE_MIN_FACE, GATE_MIN_FACE))
+    return len(found) > 0
+
+
+def encode_crops(filepath: Union[str, BinaryIO], locations: List[Location], jitter: int = 1,
+                 draft: bool = True) -> Tuple[List[ndarray], List[ndarray]]:
+    """
+    Encodes faces whose locations are already known from crops of a decode at least ENCODE_SIZE, without looking
+    for faces again.
+    :param filepath: Path to a readable image, or its contents as a file object
+    :param locations: Where the faces are in the full-size image
+    :param jitter: How many times to transform a face. Higher number is slower but more accurate.
+    :return: Encoding of each face, in the same order, and the landmarks it was encoded from in the full-size image
+    """
+    content = open_image(filepath)
+    full_width = content.size[0]
+    if draft:
+        content.draft("RGB", scaled_size(content.size, ENCODE_SIZE))  # No-op for anything that isn't a JPEG
+    width, height = content.size
+    encodings, landmarks = [], []
+    for top, right, bottom, left in scale_locations(locations, width / full_width):
+        margin = int((bottom - top) * CROP_MARGIN)
+        box = (max(0, left - margin), max(0, top - margin), min(width, right + margin), min(height, bottom + margin))
+        crop = content.crop(box)
+        shrink = min(1.0, MAX_FACE_SIZE / max(1, bottom - top))
+        if shrink < 1:
+            crop = crop.resize((max(1, round(crop.size[0] * shrink)), max(1, round(crop.size[1] * shrink))))
+        face = scale_locations([(top - box[1], right - box[0], bottom - box[1], left - box[0])], shrink)[0]
+        face_encodings, face_landmarks = encode_with_landmarks(numpy.array(crop), [face], jitter)
+        encodings.extend(face_encodings)
+        # Back from the crop to the full-size image
+        landmarks.append(numpy.round((face_landmarks[0] / shrink + box[:2]) * full_width / width).astype("int64"))
+    return encodings, landmarks
+
+
+def scale_locations(locations: List[Tuple[int, int, int, int]], factor: float) -> List[Location]:
+    """
+    :return: Locations in an image factor times the size of the one they were found in
+    """
+    return [tuple(int(round(side * factor)) for side in location) for location in locations]
+
+
+def open_image(filepath: Union[str, BinaryIO]) -> pilmage.Image:
+    """
+    Opens an image without decoding it. A file object is rewound first, so the same one can be opened again.
+    """
+    if not isinstance(filepath, str):
+        filepath.seek(0)
+    return pilmage.open(filepath)
+
+
+def scaled_size(size: Tuple[int, int], longest_side: int) -> Tuple[int, int]:
+    """
+    :return: size scaled so its longest side is longest_side
+    """
+    scale_factor = longest_side / max(size[0], size[1])
+    return int(round(size[0] * scale_factor)), int(round(size[1] * scale_factor))
+
+
+def load_resized(filepath: Union[str, BinaryIO], longest_side: int, draft: bool = True) -> pilmage.Image:
+    """
+    Decodes an image and resizes it so its longest side is longest_side pixels.
+    :param filepath: Path to a readable image, or its contents as a file object
+    :param longest_side: Goal size of the longest side in pixels
+    :param draft: Use reduced-resolution decoding where the format supports it
+    :return: The resized image
+    """
+    return resize_longest(open_image(filepath), longest_side, draft)
+
+
+def resize_longest(content: pilmage.Image, longest_side: int, draft: bool = True) -> pilmage.Image:
+    """
+    Decodes an opened image and resizes it so its longest side is longest_side pixels.
+
+    With draft on, JPEGs are decoded straight to the smallest power-of-two scale (1/2, 1/4 or 1/8) that's still
+    at least the goal size, so a 40MP photo never gets fully decoded just to be shrunk to 1250px. The final resize
+    then only has to cover the remaining factor of two or less.
+    :param content: Image that hasn't been decoded yet
+    :param longest_side: Goal size of the longest side in pixels
+    :param draft: Use reduced-resolution decoding where the format supports it
+    :return: The resized image
+    """
+    new_x, new_y = scaled_size(content.size, longest_side)
+    if draft:
+        content.draft("RGB", (new_x, new_y))  # No-op for anything that isn't a JPEG
+    return content.resize((new_x, new_y))
+
+
+class KnownFaceIndex:
+    """
+    All known people's encodings packed into one matrix so that matching a whole picture is a single NumPy
+    operation. Build it once per run (or whenever the known people change) instead of once per image.
+
+    Encodings stored at float32 or int8 precision fit in float32 exactly, so for those the matrix is kept in float32,
+    which halves its size and lets distances be computed at float32 speed first. Only distances that could decide
+    the outcome, being within float32's rounding error of the tolerance or of the k-th closest person, are then
+    recomputed in float64, so results are the same as with a float64 matrix.
+    """
+    # Largest float32 rounding error of a squared distance, as a fraction of (|unknown| + |known|)^2. Twice the
+    # textbook bound for a 128-long dot product, so any summation order is covered.
+    coarse_error = 4 * 128 * float(numpy.finfo("float32").eps)
+
+    def __init__(self, known_people: List[Person]):
+        """
+        :param known_people: List of identified Person objects. People without encodings are ignored.
+        """
+        people = [kp for kp in known_people if len(kp.encodings) > 0]
+        self.people: List[Person] = people
+        self.person_ids = numpy.array([p.dbid for p in people], dtype="int64")
+
+        # Encodings are grouped by person, so person_starts[i] is the first row belonging to people[i]
+        counts = [len(p.encodings) for p in people]
+        self.person_starts = numpy.cumsum([0] + counts[:-1]).astype("int64")
+        self.row_person = numpy.repeat(numpy.arange(len(people)), counts)  # Index into people of every row
+        if people:
+            matrix = numpy.ascontiguousarray([enc.encoding for p in people for enc in p.encodings], dtype="float64")
+        else:
+            matrix = numpy.empty((0, 128), dtype="float64")
+        self.squared_norms = numpy.einsum("ij,ij->i", matrix, matrix)
+        self.compact = len(matrix) > 0 and exact_in_float32(matrix)
+        self.matrix = matrix.astype("float32") if self.compact else matrix
+        if self.compact:
+            self.coarse_squared_norms = self.squared_norms.astype("float32")
+            self.person_max_norms = numpy.maximum.reduceat(numpy.sqrt(self.squared_norms), self.person_starts)
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def distances(self, unknown: ndarray) -> ndarray:
+        """
+        Euclidean distance from every unknown encoding to every known encoding, in float64.
+        :param unknown: unknown encodings, one per row
+        :return: Matrix of shape (unknown, known)
+        """
+        unknown = numpy.atleast_2d(unknown)
+        squared = numpy.einsum("ij,ij->i", unknown, unknown)[:, None] + self.squared_norms[None, :] \
+            - 2 * (unknown @ self.matrix.astype("float64", copy=False).T)
+        return numpy.sqrt(numpy.maximum(squared, 0))
+
+    def person_distances(self, unknown: ndarray, tolerance: Optional[float] = None,
+                         k: Optional[int] = None) -> ndarray:
+        """
+        Distance from every unknown encoding to the closest encoding of each known person.
 
-    content = pilmage.open(filepath)
+        Every distance is exact unless tolerance or k is given and the index is in float32. Then only distances
+        that could be under tolerance or among a face's k closest people are exact. The rest are float32
+        approximations, but are certain to be neither.
+        :param unknown: unknown encodings, one per row
+        :param tolerance: Tolerance the distances will be matched at
+        :param k: Number of closest people per face that will be used
+        :return: Matrix of shape (unknown, people), columns in the same order as self.people
+        """
+        unknown = numpy.atleast_2d(unknown)
+        if not self.compact or (tolerance is None and k is None):
+            return numpy.minimum.reduceat(self.distances(unknown), self.person_starts, axis=1)
 
-    # Resize image to around 1k pixels
+        # Coarse pass in float32, in place. |unknown|^2 is the same for every column, so it's added per person.
+        coarse = unknown.astype("float32") @ self.matrix.T
+        coarse *= -2
+        coarse += self.coarse_squared_norms
+        unknown_squared_norms = numpy.einsum("ij,ij->i", unknown, unknown)
+        nearest = numpy.minimum.reduceat(coarse, self.person_starts, axis=1) + unknown_squared_norms[:, None]
+        # How far off each person's squared distance can be
+        error = self.coarse_error * (numpy.sqrt(unknown_squared_norms)[:, None] + self.person_max_norms[None, :]) ** 2
+        lowest, highest = nearest - error, nearest + error
 
-    scale_factor = GOAL_SIZE / max(content.size[0], content.size[1])
-    new_x, new_y = int(round(content.size[0] * scale_factor)), \
-                   int(round(content.size[1] * scale_factor))
-    resized = content.resize((new_x, new_y))
-    as_numpy_arr = numpy.array(resized)
+        # Anybody whose distance could be below the cutoff gets re-ranked
+        cutoff = numpy.full(len(unknown), -numpy.inf)
+        if tolerance is not None:
+            cutoff[:] = tolerance ** 2
+        if k:
+            k = min(k, len(self.people))
+            cutoff = numpy.maximum(cutoff, numpy.partition(highest, k - 1, axis=1)[:, k - 1])
+        borderline = lowest <= cutoff[:, None]
 
-    found_encodings = fr.face_encodings(as_numpy_arr, num_jitters=jitter, model="large")
-    return found_encodings
+        output = numpy.sqrt(numpy.maximum(nearest, 0))
+        for face in numpy.flatnonzero(borderline.any(axis=1)):
+            rows = numpy.flatnonzero(borderline[face][self.row_person])
+            exact = numpy.linalg.norm(self.matrix[rows].astype("float64") - unknown[face], axis=1)
+            face_output = numpy.full(len(self.people), numpy.inf)
+            numpy.minimum.at(face_output, self.row_person[rows], exact)
+            output[face, borderline[face]] = face_output[borderline[face]]
+        return output
 
+    def match(self, unknown_encodings: List[FaceEncoding], tolerance: float = 0.6,
+              person_distances: Optional[ndarray] = None) -> Dict[Person, FaceEncoding]:
+        """
+        Same contract as match_best: faces are matched in order, each to the closest person within tolerance
+        who hasn't already been matched to an earlier face in the same picture. Pairs are picked by assign_in_order,
+        as re-tagging from recorded distances does.
+        :param unknown_encodings: List of encoded representations of faces.
+        :param tolerance: Maximum distance for a face to match at. Lower values result in stricter matches.
+        :param person_distances: Result of person_distances for these faces at this tolerance, if it's already been
+            computed.
+        :return: People objects that are the best matches for faces in unknown_encodings
+        """
+        encoding_person_tracker = {}
+        if len(self.people) == 0 or len(unknown_encodings) == 0:
+            return encoding_person_tracker
 
-# Named tuple to make matching code easier to read
-ComparedFace = namedtuple("ComparedFace", "Person Distance")
-ComparedFace.__str__ = lambda self: f"{self.Person.Name} ({self.Distance:.3f})"
+        if person_distances is None:
+            person_distances = self.person_distances(numpy.array([face.encoding for face in unknown_encodings]),
+                                                     tolerance=tolerance)
+        faces, columns = numpy.nonzero(person_distances < tolerance)
+        candidates = [(int(face), int(column), float(person_distances[face, column]))
+                      for face, column in zip(faces, columns)]
+        for face, column in assign_in_order(candidates):
+            encoding_person_tracker[self.people[column]] = unknown_encodings[face]
+        return encoding_person_tracker
 
+    def closest_people(self, unknown_encodings: List[FaceEncoding], k: int = 3,
+                       person_distances: Optional[ndarray] = None) -> List[List[Tuple[Person, float]]]:
+        """
+        The k closest known people to each face, regardless of tolerance.
+        :param unknown_encodings: List of encoded representations of faces.
+        :param k: Number of people to return per face
+        :param person_distances: Result of person_distances for these faces for at least k people, if it's already
+            been computed.
+        :return: For each face, (person, distance) pairs with the closest first
+        """
+        if len(self.people) == 0 or len(unknown_encodings) == 0:
+            return [[] for face in unknown_encodings]
 
-def match_best(known_people: List[Person], unknown_encodings: List[FaceEncoding], tolerance: float = 0.6) \
+        if person_distances is None:
+            person_distances = self.person_distances(numpy.array([face.encoding for face in unknown_encodings]), k=k)
+        k = min(k, len(self.people))
+        nearest = numpy.argpartition(person_distances, k - 1, axis=1)[:, :k]
+        output = []
+        for face_distances, columns in zip(person_distances, nearest):
+            columns = columns[numpy.argsort(face_distances[columns])]
+            output.append([(self.people[c], float(face_distances[c])) for c in columns
+                           if face_distances[c] < numpy.inf])  # An approximate index can leave people out
+        return output
+
+
+def assign_in_order(candidates: List[Tuple[int, int, float]]) -> Set[Tuple[int, int]]:
+    """
+    Picks face/person pairs for one picture from distances, as matching does: faces in order, each to the closest
+    person who isn't already in the picture, so that each face is one person and each person is in the picture at
+    most once. Ties go to the person first in order.
+    :param candidates: (face, person, distance) for every pair within tolerance. Faces and people can be anything
+        that sorts, like their ids.
+    :return: (face, person) pairs that were chosen
+    """
+    by_face = {}
+    for face, person, distance in candidates:
+        by_face.setdefault(face, []).append((distance, person))
+    chosen = set()
+    used_people = set()
+    for face in sorted(by_face):
+        for distance, person in sorted(by_face[face]):
+            if person not in used_people:
+                chosen.add((face, person))
+                used_people.add(person)
+                break
+    return chosen
+
+
+def match_best(known_people, unknown_encodings: List[FaceEncoding], tolerance: float = 0.6) \
         -> Dict[Person, FaceEncoding]:
     """
     Compares encoded versions of faces found in a picture to a set of known people and returns the best matches.
-    :param known_people: List of identified Person objects.
+    :param known_people: List of identified Person objects, or a KnownFaceIndex built from them.
     :param unknown_encodings: List of encoded representations of faces.
     :param tolerance: Maximum distance for a face to match at. Lower values result in stricter matches.
     :return: People objects that are the best matches for faces in unknown_encodings
     """
-    if len(known_people) == 0:
-        raise ValueError("match_best requires that at least one known person be specified")
-    if type(known_people[0]) != Person:
-        raise TypeError(f"known_people must be of type List[Person], but detected {type(known_people[0])}")
     if len(unknown_encodings) == 0:
         raise ValueError("match_best requires that at least one unknown image be specified")
     if type(unknown_encodings[0]) != FaceEncoding:
         raise TypeError(f"unknown_encodings must be of type List[FaceEncoding], but detected {type(unknown_encodings[0])}")
+    if isinstance(known_people, KnownFaceIndex):
+        return known_people.match(unknown_encodings, tolerance)
+
+    if len(known_people) == 0:
+        raise ValueError("match_best requires that at least one known person be specified")
+    if type(known_people[0]) != Person:
+        raise TypeError(f"known_people must be of type List[Person], but detected {type(known_people[0])}")
 
-    # Flatten list of known people's encodings
-    flat_known_encodings = []
-    flat_known_people = []
-    for kpers in known_people:
-        flat_known_encodings.extend(kpers.encodings)
-        flat_known_people.extend([kpers] * len(kpers.encodings))
-    flat_known_encodings = [x.encoding for x in flat_known_encodings]
+    return KnownFaceIndex(known_people).match(unknown_encodings, tolerance)
 
-    # Track actual results
-    encoding_person_tracker = {}
 
-    # Actual facial recognition logic
-    for face in unknown_encodings:
-        compare_results = fr.face_distance(flat_known_encodings, face.encoding)
+def FindFaces(frames: ndarray, jitter: int = 1, model: str = "hog", upsample: int = 1) \
+        -> List[Tuple[List[ndarray], List[FaceRegion]]]:
+    """
+    Batched face detection: finds faces in every frame of a stack of same-size images, then encodes each face.
+
+    cnn runs dlib's CNN detector over the whole stack in one call, like face_recognition's find_faces_in_batches
+    example, which is the only detector dlib can run on several images at once. On a GPU that's much quicker than one
+    image at a time, but on a CPU the CNN detector is tens of times slower than hog, batched or not. hog has no
+    batched form, so its frames are searched one after another; what a batch saves is the per-image overhead around
+    detection, such as handing work to and from worker processes.
+    :param frames: Images stacked into one array of shape (images, height, width, 3), as made by stack_frames
+    :param jitter: How many times to transform a face. Higher number is slower but more accurate.
+    :param model: One of batch_models
+    :param upsample: How many times to upsample each frame while looking for faces. Higher finds smaller faces.
+    :return: Encodings and regions found in each frame, in pixels of the frame
+    """
+    if model not in batch_models:
+        raise ValueError(f"Unknown detection model '{model}', expected one of {batch_models}")
+    if len(frames) == 0:
+        return []
+    if model == "cnn":
+        found = fr.batch_face_locations(list(frames), upsample, batch_size=len(frames))
+    else:
+        found = [fr.face_locations(frame, upsample) for frame in frames]
+    results = []
+    for frame, locations in zip(frames, found):
+        encodings, landmarks = encode_with_landmarks(frame, locations, jitter)
+        results.append((encodings, [FaceRegion(location, points, model, 1.0)
+                                    for location, points in zip(locations, landmarks)]))
+    return results
 
-        # Filter list step by step. I broke this into multiple lines for debugging.
-        possible_matches = [ComparedFace(flat_known_people[i], compare_results[i]) for i in range(len(compare_results))]
 
-        # Remove faces that too unlike the face we're checking.
-        possible_matches: List[ComparedFace] = [x for x in possible_matches if x.Distance < tolerance]
+def encode_batch(files: List[Union[str, BinaryIO]], jitter: int = 1, model: str = "hog", gate: Optional[str] = None,
+                 draft: bool = True) -> List[Tuple[List[ndarray], List[FaceRegion], int]]:
+    """
+    Decodes images to GOAL_SIZE, like standard detection, and finds and encodes their faces with FindFaces in one
+    batch. Images are padded to a common size, so they should all have the same bucket_size for the least padding.
+    :param files: Paths to readable images, or their contents as file objects
+    :param jitter: How many times to transform a face. Higher number is slower but more accurate.
+    :param model: One of batch_models
+    :param gate: One of gate_presets to check each image with might_have_faces first, or None to always look
+    :param draft: Let the JPEG decoder scale down while decoding instead of decoding every pixel.
+    :return: Encodings found in each image, the region of each in the full-size image, and the size faces were looked
+        for at, as find_and_encode
+    """
+    if gate and not gate_available():
+        raise ImportError("The face-presence gate needs OpenCV: pip install opencv-python-headless")
 
-        # Remove people who have already matched in this picture
-        possible_matches = [x for x in possible_matches if x.Person not in encoding_person_tracker.keys()]
+    scales, decoded = [], []
+    for file in files:
+        content = open_image(file)
+        full_width = content.size[0]
+        resized = resize_longest(content, GOAL_SIZE, draft)
+        scales.append(full_width / resized.size[0])
+        decoded.append(numpy.array(resized))
+    searched = [i for i, pixels in enumerate(decoded) if not gate or might_have_faces(pixels, gate)]
+    results: List[Tuple[List[ndarray], List[FaceRegion], int]] = [([], [], 0) for _ in files]
+    for i, (encodings, regions) in zip(searched, FindFaces(stack_frames([decoded[i] for i in searched]), jitter,
+                                                           model)):
+        # Frames are padded on the right and bottom, so regions in a frame are regions in its image
+        results[i] = encodings, [region.scaled(scales[i]) for region in regions], GOAL_SIZE
+    return results
 
-        # Sort by chance of facial distance ascending (best matches first)
-        possible_matches = sorted(possible_matches, key=lambda x: x.Distance)
 
-        if len(possible_matches) > 0:
-            best_match = possible_matches[0].Person
-            encoding_person_tracker[best_match] = face
-    return encoding_person_tracker
+def bucket_size(size: Tuple[int, int]) -> Tuple[int, int]:
+    """
+    :param size: Full size of an image
+    :return: Size of the frame encode_batch puts it in: its GOAL_SIZE copy rounded up to a multiple of BUCKET_STEP
+    """
+    width, height = scaled_size(size, GOAL_SIZE)
+    return -(-width // BUCKET_STEP) * BUCKET_STEP, -(-height // BUCKET_STEP) * BUCKET_STEP
 
 
-# https://github.com/ageitgey/face_recognition/blob/master/examples/find_faces_in_batches.py
-def FindFaces(images: List[str]):
+def stack_frames(images: List[ndarray]) -> ndarray:
     """
-    NOT YET IMPLEMENTED. Detect faces in batches using the GPU, which should be 3x faster according to the docs.
-    :param images:
-    :return:
+    Stacks images into one array, padding each with black on the right and bottom to the size of the largest.
+    :param images: RGB images, one array of shape (height, width, 3) each
+    :return: Array of shape (images, height, width, 3)
     """
-    raise NotImplementedError("Batch face detection not yet implemented")
-    pass
+    height = max((pixels.shape[0] for pixels in images), default=0)
+    width = max((pixels.shape[1] for pixels in images), default=0)
+    frames = numpy.zeros((len(images), height, width, 3), dtype="uint8")
+    for frame, pixels in zip(frames, images):
+        frame[:pixels.shape[0], :pixels.shape[1]] = pixels
+    return frames
@@ -0,0 +1,98 @@
+# Builtins
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os import path
+from time import monotonic, sleep, perf_counter as pc
+from typing import List, Tuple, Optional
+import logging
+
+# Custom code
+from Controllers.Database import Database
+from Model.ImageFile import ImageFile
+
+# A journalled keyword change: (journal id, keyword, 'add' or 'remove')
+JournalEntry = Tuple[int, str, str]
+
+
+def net_changes(entries: List[JournalEntry]) -> Tuple[List[str], List[str]]:
+    """
+    Collapses an image's journal entries into the keywords to append and remove. When a keyword was changed more
+    than once, the latest change wins.
+    :return: Keywords to append and keywords to remove
+    """
+    final = {}
+    for journal_id, keyword, action in entries:
+        final[keyword] = action
+    return ([keyword for keyword, action in final.items() if action == "add"],
+            [keyword for keyword, action in final.items() if action == "remove"])
+
+
+def apply_to_file(filepath: str, entries: List[JournalEntry]) -> int:
+    """
+    Worker-side entry point. Brings one file's keywords in line with its journal entries. Safe to repeat: keywords
+    already present aren't appended twice, and keywords already gone aren't an error.
+    :return: Number of keywords appended or removed
+    """
+    if not path.exists(filepath):
+        raise FileNotFoundError(filepath)
+    to_append, to_remove = net_changes(entries)
+    return ImageFile(filepath).update_keywords(to_append, to_remove)
+
+
+def write_pending_keywords(db: Database, threads: int = 4, max_per_second: Optional[float] = None,
+                           chunk_size: int = 1000) -> Tuple[int, int]:
+    """
+    Writes journalled keyword changes to image files, a chunk of images at a time. Threads only touch files;
+    the journal is updated from the calling thread as each file finishes, and committed after each chunk.
+    Stopping part way is safe: entries are removed from the journal only after their file is written, and applying an entry
+    twice changes nothing, so the next run carries on where this one stopped.
+
+    :param db: Database holding the journal
+    :param threads: Number of files written at the same time
+    :param max_per_second: Maximum number of files to start writing per second, to leave I/O for everything
+        else using the disk. Unlimited if not specified.
+    :param chunk_size: Number of images loaded from the journal at a time
+    :return: Number of files written and number that couldn't be written. Those stay in the journal for next time.
+    """
+    pending_count = db.count_pending_keywords()
+    if pending_count == 0:
+        return 0, 0
+    print(f"Writing {pending_count:,} keyword changes to files with {threads} thread(s)")
+
+    start_time = pc()
+    written, failed = 0, 0
+    last_image_id = 0
+    interval = 1 / max_per_second if max_per_second else 0
+    next_start = monotonic()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while True:
+            pending = db.get_pending_keywords(last_image_id, chunk_size)
+            if not pending:
+                break
+            last_image_id = max(pending)  # Failed images are skipped until the next run instead of retried forever
+
+            futures = {}
+            for image_id, (filepath, entries) in pending.items():
+                if interval:  # Throttle by spacing out when each file starts
+                    next_start = max(next_start + interval, monotonic())
+                    sleep(max(0.0, next_start - monotonic()))
+                futures[pool.submit(apply_to_file, filepath, entries)] = image_id
+
+            for future in as_completed(futures):
+                image_id = futures[future]
+                filepath, entries = pending[image_id]
+                try:
+                    changed = future.result()
+                except Exception as e:
+                    logging.warning(f"Couldn't write keywords to '{filepath}', will retry next run: {e}")
+                    failed += 1
+                    continue
+                if changed > 0:  # Keep the stored stat current so incremental scans still recognize the file
+                    db.update_image_stat(image_id, filepath)
+                db.remove_applied_keywords([journal_id for journal_id, keyword, action in entries])
+                db.end_image()
+                written += 1
+
+            db.flush()
+            print(f"{written:,} files written, {failed:,} failed ({pc() - start_time:.1f}s)")
+
+    return written, failed
@@ -0,0 +1,89 @@
+# Builtins
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple, Union, Hashable
+
+# External modules
+import numpy
+from numpy import ndarray
+from PIL import Image as pilmage
+
+# Custom code
+from Controllers.FaceRecognizer import open_image
+
+HASH_SIZE = 8  # Hashes are HASH_SIZE x HASH_SIZE bits, 64 of them
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+
+def perceptual_hash(filepath: Union[str, BinaryIO]) -> Tuple[int, Tuple[int, int]]:
+    """
+    Difference hash (dHash) of an image: it's shrunk to 9x8 in greyscale, and each bit is whether a pixel is brighter
+    than the one to its right. Re-saved copies and frames of a burst taken without moving differ in a few bits at
+    most, while different pictures differ in about half. JPEGs are decoded at 1/8 scale, so hashing takes a small
+    fraction of the time finding faces does.
+    :param filepath: Path to a readable image, or its contents as a file object
+    :return: The hash, as a signed 64 bit integer so SQLite can store it, and the image's (width, height)
+    """
+    content = open_image(filepath)
+    size = content.size
+    content.draft("L", (HASH_SIZE + 1, HASH_SIZE))  # Smallest DCT scale, 1/8, for anything big enough to hash
+    pixels = numpy.asarray(content.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), pilmage.BOX), dtype="int16")
+    bits = numpy.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return int.from_bytes(bits.tobytes(), "big", signed=True), size
+
+
+def hamming_distances(phash: int, hashes: ndarray) -> ndarray:
+    """
+    :param phash: Hash to compare, as perceptual_hash returns it
+    :param hashes: int64 array of hashes to compare it with
+    :return: Number of bits phash differs from each of hashes in
+    """
+    differences = numpy.bitwise_xor(hashes, numpy.int64(phash))
+    if hasattr(numpy, "bitwise_count"):  # NumPy 2.0 and later. Unsigned, since it counts a signed value's magnitude.
+        return numpy.bitwise_count(differences.view("uint64"))
+    return numpy.unpackbits(differences.view("uint8")).reshape(-1, HASH_BITS).sum(axis=1)
+
+
+class NearDuplicateIndex:
+    """
+    Perceptual hashes of scanned images, grouped by image size, so the closest hash to a new image's can be found
+    among the images it could be a copy of. Images of different sizes are never near duplicates, since where faces
+    are would be in different pixels. Images are told apart by any key, like their id in the database or, for
+    images that aren't stored yet, their path.
+    """
+    def __init__(self, entries: Iterable[Tuple[Hashable, int, int, int]] = ()):
+        """
+        :param entries: (key, hash, width, height) of each image already scanned
+        """
+        self.ids: Dict[Tuple[int, int], List[Hashable]] = {}
+        # Hashes of each size, in an array that doubles when it's full so adding one doesn't copy the others.
+        # Only the first len(self.ids[size]) are in use.
+        self.hashes: Dict[Tuple[int, int], ndarray] = {}
+        for image_id, phash, width, height in entries:
+            self.add(image_id, phash, (width, height))
+
+    def __len__(self):
+        return sum(len(ids) for ids in self.ids.values())
+
+    def add(self, image_id: Hashable, phash: int, size: Tuple[int, int]) -> None:
+        """
+        Adds a newly scanned image, so images after it can be found to be its near duplicates.
+        """
+        ids = self.ids.setdefault(size, [])
+        hashes = self.hashes.setdefault(size, numpy.empty(1, dtype="int64"))
+        if len(ids) == len(hashes):
+            hashes = self.hashes[size] = numpy.concatenate([hashes, numpy.empty(len(hashes), dtype="int64")])
+        hashes[len(ids)] = phash
+        ids.append(image_id)
+
+    def find(self, phash: int, size: Tuple[int, int], max_distance: int) -> Optional[Hashable]:
+        """
+        :param phash: Hash of the new image
+        :param size: (width, height) of the new image
+        :param max_distance: Most bits the hashes can differ in
+        :return: Key of the image of the same size whose hash is closest to phash, if it's within max_distance
+        """
+        if size not in self.ids:
+            return None
+        ids = self.ids[size]
+        distances = hamming_distances(phash, self.hashes[size][:len(ids)])
+        closest = int(numpy.argmin(distances))
+        return ids[closest] if distances[closest] <= max_distance else None
@@ -0,0 +1,261 @@
+# Builtins
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+from io import BytesIO
+from time import perf_counter as pc
+from typing import Iterable, Iterator, Callable, Tuple, Optional, List, Dict, Hashable
+
+# External modules
+from numpy import ndarray
+
+# Custom code
+from Controllers.FaceRecognizer import find_and_encode, encode_batch, bucket_size, open_image
+from Controllers.NearDuplicates import NearDuplicateIndex, perceptual_hash
+from Model.FaceRegion import FaceRegion
+from Model.ImageFile import ImageFile
+
+# What the writer gets back for every image: the image, its new encodings, where they are and the size faces were
+# looked for at (all None if it didn't need encoding) and how long encoding took in seconds.
+EncodedImage = Tuple[ImageFile, Optional[List[ndarray]], Optional[List[FaceRegion]], Optional[int], float]
+# What a worker sends back for every image: encodings, regions and size faces were looked for at (all None for a near
+# duplicate), perceptual hash, (width, height) and what it's a near duplicate of (all None unless near duplicates are
+# looked for), IPTC, EXIF and seconds
+WorkerResult = Tuple[Optional[List[ndarray]], Optional[List[FaceRegion]], Optional[int], Optional[int],
+                     Optional[Tuple[int, int]], Optional[Hashable], Dict, Dict, float]
+
+# Each worker's own near-duplicate index: images scanned before, plus the ones the worker has hashed itself since.
+# None unless near duplicates are looked for.
+near_duplicates: Optional[NearDuplicateIndex] = None
+max_distance = 0
+
+
+def init_near_duplicates(entries: List[Tuple[int, int, int, int]], distance: Optional[int]) -> None:
+    """
+    Worker-side setup, as the process starts: loads the hashes of images already scanned.
+    :param entries: As Database.get_perceptual_hashes returns them
+    :param distance: Most bits a near duplicate's hash can differ in, or None to not look for near duplicates
+    """
+    global near_duplicates, max_distance
+    near_duplicates = NearDuplicateIndex(entries) if distance is not None else None
+    max_distance = distance or 0
+
+
+def find_near_duplicate(filepath: str, file: BytesIO) -> Tuple[Optional[int], Optional[Tuple[int, int]],
+                                                                 Optional[Hashable]]:
+    """
+    Hashes an image from the bytes already read and looks it up in this worker's near-duplicate index. It's then
+    added to the index, so later images can be near duplicates of it.
+    :return: The image's hash, its (width, height) and the id of the image it's a near duplicate of, or the path if
+        that was hashed by this worker during this scan. All None if near duplicates aren't looked for.
+    """
+    if near_duplicates is None:
+        return None, None, None
+    phash, size = perceptual_hash(file)
+    source = near_duplicates.find(phash, size, max_distance)
+    near_duplicates.add(filepath, phash, size)
+    return phash, size, source
+
+
+def read_image(image: ImageFile) -> BytesIO:
+    """
+    Reads an image file once and loads its metadata from the bytes, so the same bytes can be decoded for pixels
+    instead of pyexiv2 and PIL each reading the file from disk.
+    :return: The file's contents. BytesIO shares the bytes object's buffer until it's written to.
+    """
+    with open(image.filepath, "rb") as file:
+        data = file.read()
+    image.init_metadata(data)
+    return BytesIO(data)
+
+
+def load_and_encode(image: ImageFile, detection: str = "standard", detect_size: Optional[int] = None,
+                    gate: Optional[str] = None) -> Tuple[List[ndarray], List[FaceRegion], int]:
+    """
+    Reads an image file once with read_image, and encodes it from the same bytes.
+    :param image: Image to encode. Its metadata is loaded as a side effect.
+    :param detection: One of FaceRecognizer.detection_modes
+    :param detect_size: Size faces are looked for at, or None for the detection mode's own
+    :param gate: Face-presence gate preset, one of FaceRecognizer.gate_presets, or None for no gate
+    :return: Encodings found, the region of each, and the size faces were looked for at
+    """
+    return find_and_encode(read_image(image), detection=detection, detect_size=detect_size, gate=gate)
+
+
+def timed_encode(filepath: str, detection: str = "standard", detect_size: Optional[int] = None,
+                 gate: Optional[str] = None) -> WorkerResult:
+    """
+    Worker-side entry point. Encodes one file, unless it's a near duplicate, and reports how long it took.
+    :param filepath: Path to a readable image with zero or more faces.
+    :param detection: One of FaceRecognizer.detection_modes
+    :param detect_size: Size faces are looked for at, or None for the detection mode's own
+    :param gate: Face-presence gate preset, or None for no gate
+    :return: A WorkerResult
+    """
+    start = pc()
+    image = ImageFile(filepath)
+    file = read_image(image)
+    phash, size, source = find_near_duplicate(filepath, file)
+    if source is not None:
+        return None, None, None, phash, size, source, image.iptc, image.exif, pc() - start
+    encodings, regions, searched_size = find_and_encode(file, detection=detection, detect_size=detect_size, gate=gate)
+    return encodings, regions, searched_size, phash, size, None, image.iptc, image.exif, pc() - start
+
+
+def timed_encode_each(filepaths: List[str], detection: str = "standard", detect_size: Optional[int] = None,
+                      gate: Optional[str] = None) -> List[WorkerResult]:
+    """
+    Worker-side entry point for a group of images encoded one at a time, as timed_encode.
+    """
+    return [timed_encode(filepath, detection, detect_size, gate) for filepath in filepaths]
+
+
+def timed_encode_batch(filepaths: List[str], model: str = "hog", gate: Optional[str] = None) -> List[WorkerResult]:
+    """
+    Worker-side entry point for a group of images whose faces are found together with FaceRecognizer.encode_batch,
+    in batches of the same bucket_size so frames are padded as little as possible. Each file is still only read
+    once, for its metadata, its size, its hash and its pixels. Near duplicates are left out of the batches.
+    :param filepaths: Paths to readable images
+    :param model: One of FaceRecognizer.batch_models
+    :param gate: Face-presence gate preset, or None for no gate
+    :return: For each image, as timed_encode. The time is the batch's, shared evenly between its images.
+    """
+    start = pc()
+    images = [ImageFile(filepath) for filepath in filepaths]
+    files = [read_image(image) for image in images]
+    hashes = [find_near_duplicate(filepath, file) for filepath, file in zip(filepaths, files)]
+    buckets: Dict[Tuple[int, int], List[int]] = {}  # Indexes of the images to encode, by bucket_size
+    for i, (file, (phash, size, source)) in enumerate(zip(files, hashes)):
+        if source is None:
+            buckets.setdefault(bucket_size(size or open_image(file).size), []).append(i)  # Header only
+    encoded = {}
+    for indexes in buckets.values():
+        encoded.update(zip(indexes, encode_batch([files[i] for i in indexes], model=model, gate=gate)))
+    seconds = (pc() - start) / len(images)
+    results = []
+    for i, (image, (phash, size, source)) in enumerate(zip(images, hashes)):
+        encodings, regions, searched_size = encoded.get(i, (None, None, None))
+        results.append((encodings, regions, searched_size, phash, size, source, image.iptc, image.exif, seconds))
+    return results
+
+
+def received(image: ImageFile, encodings: Optional[List[ndarray]], regions: Optional[List[FaceRegion]],
+             searched_size: Optional[int], phash: Optional[int], size: Optional[Tuple[int, int]],
+             source: Optional[Hashable], iptc: Dict, exif: Dict, seconds: float) -> EncodedImage:
+    """
+    Writer-side counterpart to timed_encode. The metadata and hash worked out along with the pixels are kept on the
+    image, so the writer never has to open the file itself.
+    """
+    image.iptc, image.exif = iptc, exif
+    image.phash, image.dimensions, image.duplicate_of = phash, size, source
+    image.md_init_complete = True
+    return image, encodings, regions, searched_size, seconds
+
+
+def group_images(images: Iterable[ImageFile], needs_encoding: Callable[[ImageFile], bool],
+                 detect_batch: int = 1) -> Iterator[Tuple[List[ImageFile], bool]]:
+    """
+    Groups the images that need encoding into the units workers encode: one image each, or with detect_batch over 1,
+    up to detect_batch images in the order they come. Images aren't opened here: the worker sorts its group into
+    batches of the same size from the bytes it reads anyway, see timed_encode_batch.
+    :return: Generator of (images, whether they need encoding). Images that don't need encoding come one at a time, as
+        soon as they're seen.
+    """
+    group: List[ImageFile] = []
+    for image in images:
+        if not needs_encoding(image):
+            yield [image], False
+        elif detect_batch <= 1:
+            yield [image], True
+        else:
+            group.append(image)
+            if len(group) >= detect_batch:
+                yield group, True
+                group = []
+    if group:
+        yield group, True
+
+
+def encode_images(images: Iterable[ImageFile], needs_encoding: Callable[[ImageFile], bool],
+                  workers: int = 1, max_pending: Optional[int] = None,
+                  detection: str = "standard", detect_size: Optional[int] = None,
+                  gate: Optional[str] = None, detect_batch: int = 1,
+                  batch_model: str = "hog", near_duplicate_distance: Optional[int] = None,
+                  scanned_hashes: List[Tuple[int, int, int, int]] = ()) -> Iterator[EncodedImage]:
+    """
+    Two-stage pipeline: a pool of worker processes encodes faces while the caller, as the single writer,
+    consumes results and does everything that touches the database.
+    Images that don't need encoding are passed straight through to the writer.
+
+    :param images: Images to process. Consumed lazily, so this can be a generator.
+    :param needs_encoding: Called in the writer's process for each image. Return False to skip encoding.
+        Images skipped aren't hashed for near duplicates either.
+    :param workers: Number of encoding processes. 1 encodes in-process with no pool.
+    :param max_pending: Maximum number of images submitted but not yet handed back to the writer. This bounds
+        the queues between the stages, so memory stays flat no matter how far ahead the workers could get.
+        Defaults to twice the number of workers, times detect_batch.
+    :param detection: How faces are found, one of FaceRecognizer.detection_modes
+    :param detect_size: Size faces are looked for at, or None for the detection mode's own
+    :param gate: Face-presence gate preset, one of FaceRecognizer.gate_presets, or None for no gate
+    :param detect_batch: Over 1, images are sent to workers up to this many at a time, and the faces of those the
+        same size found together with FaceRecognizer.encode_batch. Batches are always found like standard detection.
+    :param batch_model: Detector batches use, one of FaceRecognizer.batch_models
+    :param near_duplicate_distance: Most bits a picture's perceptual hash can differ from the hash of one the same size
+        for it to be a near duplicate, whose faces aren't looked for. None to look for faces in every picture.
+        Each worker only knows of scanned_hashes and the pictures it hashed itself, so with several workers, up to
+        one near duplicate per worker can still be encoded.
+    :param scanned_hashes: Hashes of pictures already scanned, as Database.get_perceptual_hashes returns them
+    :return: Generator of (image, encodings, regions, size faces were looked for at, seconds spent encoding).
+        Encodings, regions and size are None for skipped images and near duplicates. The image's phash, dimensions
+        and duplicate_of are set when near duplicates are looked for.
+        Results come back in completion order, not input order, but a near duplicate found from another image in
+        the same scan always comes after it.
+    """
+    if detect_batch > 1:
+        encode = partial(timed_encode_batch, model=batch_model, gate=gate)
+    else:
+        encode = partial(timed_encode_each, detection=detection, detect_size=detect_size, gate=gate)
+    groups = group_images(images, needs_encoding, detect_batch)
+    near_duplicate_setup = (list(scanned_hashes), near_duplicate_distance)
+
+    if workers <= 1:
+        init_near_duplicates(*near_duplicate_setup)
+        for group, encoding in groups:
+            if encoding:
+                for image, result in zip(group, encode([image.filepath for image in group])):
+                    yield received(image, *result)
+            else:
+                yield group[0], None, None, None, 0.0
+        return
+
+    max_pending = max_pending or workers * 2 * max(1, detect_batch)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_near_duplicates,
+                             initargs=near_duplicate_setup) as pool:
+        pending = {}
+        pending_images = 0
+
+        def finished(futures) -> Iterator[EncodedImage]:
+            nonlocal pending_images
+            # In the order submitted, so an image a worker found a near duplicate of reaches the writer first
+            for future in [future for future in pending if future in futures]:
+                group = pending.pop(future)
+                pending_images -= len(group)
+                for image, result in zip(group, future.result()):
+                    yield received(image, *result)
+
+        for group, encoding in groups:
+            if not encoding:
+                yield group[0], None, None, None, 0.0
+                continue
+
+            # Backpressure: don't submit more work until the writer has caught up
+            while pending and pending_images + len(group) > max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                yield from finished(done)
+
+            pending[pool.submit(encode, [image.filepath for image in group])] = group
+            pending_images += len(group)
+
+        # Drain whatever is still in flight
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            yield from finished(done)
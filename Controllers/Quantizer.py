@@ -0,0 +1,76 @@
+"""
+Storage precisions for face encodings. face_recognition produces float64 encodings, but distances between faces
+only need to be right to a few decimal places, so encodings can be stored as float32 (half the size) or as int8
+with one scale per encoding (an eighth of the size, plus the scale).
+
+An int8 encoding's value is defined as float32(q) * float32(scale), so every stored encoding, whatever its
+precision, is exactly representable in float32. KnownFaceIndex relies on that to match in float32.
+"""
+# Builtins
+from typing import Optional, Tuple
+
+# External modules
+import numpy
+from numpy import ndarray
+
+precisions = ["float64", "float32", "int8"]
+width = 128  # Values per encoding
+# Size of a stored BLOB in bytes: its precision, so a database can hold a mix while it's being converted
+blob_precisions = {width * numpy.dtype(precision).itemsize: precision for precision in precisions}
+
+
+def quantize(encodings, precision: str) -> Tuple[ndarray, Optional[ndarray]]:
+    """
+    :param encodings: Encodings to store, one per row
+    :param precision: One of precisions
+    :return: The encodings in the storage dtype, and for int8 the scale of each encoding (None otherwise)
+    """
+    if precision not in precisions:
+        raise ValueError(f"Unknown encoding precision '{precision}', expected one of {precisions}")
+    matrix = numpy.asarray(encodings, dtype="float64").reshape(-1, width)
+    if precision != "int8":
+        return matrix.astype(precision), None
+
+    scales = (numpy.abs(matrix).max(axis=1) / 127).astype("float32")
+    scales[scales == 0] = 1  # All zeros, any scale will do
+    values = numpy.clip(numpy.rint(matrix / scales[:, None]), -127, 127).astype("int8")
+    return values, scales
+
+
+def dequantize(values: ndarray, scales: Optional[ndarray] = None, dtype: str = "float64") -> ndarray:
+    """
+    :param values: Stored encodings, one per row, in any of the precisions
+    :param scales: Scale of each encoding. Only used for int8.
+    :param dtype: dtype of the output. float32 loses nothing, since every stored encoding fits in it.
+    :return: The encodings, as a new array unless values was already dtype
+    """
+    if values.dtype == "int8":
+        values = values.astype("float32") * numpy.asarray(scales, dtype="float32").reshape(-1, 1)
+    return values.astype(dtype, copy=False)
+
+
+def decode_blobs(blobs, scales=None) -> ndarray:
+    """
+    Decodes encodings stored as BLOBs, which can be a mix of precisions, into one float64 matrix.
+    :param blobs: Raw bytes of each encoding
+    :param scales: Scale of each encoding, None where it isn't int8
+    :return: Matrix of shape (len(blobs), width)
+    """
+    sizes = numpy.fromiter((len(blob) for blob in blobs), dtype="int64", count=len(blobs))
+    if len(blobs) > 0 and (sizes == sizes[0]).all() and blob_precisions[int(sizes[0])] == "float64":
+        return numpy.frombuffer(b"".join(blobs), dtype="float64").reshape(len(blobs), width)  # No conversion needed
+
+    matrix = numpy.empty((len(blobs), width), dtype="float64")
+    for size in numpy.unique(sizes):
+        rows = numpy.flatnonzero(sizes == size)
+        values = numpy.frombuffer(b"".join(blobs[i] for i in rows), dtype=blob_precisions[int(size)])
+        row_scales = [scales[i] for i in rows] if scales is not None else None
+        matrix[rows] = dequantize(values.reshape(len(rows), width), row_scales)
+    return matrix
+
+
+def exact_in_float32(matrix: ndarray) -> bool:
+    """
+    :return: Whether converting matrix to float32 loses nothing, as for anything stored at float32 or int8
+    """
+    return matrix.dtype == "float32" or numpy.array_equal(matrix.astype("float32"), matrix)
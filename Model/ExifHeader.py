@@ -0,0 +1,114 @@
+"""
+Reads the EXIF fields LITS stores straight from a JPEG's APP1 segment, without pyexiv2 and without reading any
+image data. Segments are skipped with seeks, and reading stops at the start of scan, so only the first few KB of
+a file are read.
+Values are formatted the way pyexiv2 formats them, so ImageFile.parse_salient_exif can parse either.
+"""
+# Builtins
+import struct
+from typing import Dict, BinaryIO, Optional
+
+EXIF_IFD_POINTER = 0x8769
+# Tag number: pyexiv2 key, for the tags in the Exif sub-IFD that LITS uses
+salient_tags = {
+    0x829D: "Exif.Photo.FNumber",
+    0x829A: "Exif.Photo.ExposureTime",
+    0x8827: "Exif.Photo.ISOSpeedRatings",
+    0x9003: "Exif.Photo.DateTimeOriginal",
+}
+# TIFF type: (struct format, size in bytes)
+tiff_types = {1: ("B", 1), 2: ("s", 1), 3: ("H", 2), 4: ("L", 4), 5: ("LL", 8), 7: ("B", 1), 9: ("l", 4),
+              10: ("ll", 8)}
+
+SOI, SOS, EOI, APP1 = 0xD8, 0xDA, 0xD9, 0xE1
+standalone_markers = {0x01} | set(range(0xD0, 0xD8))  # TEM and RSTn have no length
+
+
+def read_exif_header(filepath: str) -> Dict[str, str]:
+    """
+    :param filepath: Path to a JPEG
+    :return: The salient EXIF fields that are present, keyed like pyexiv2's read_exif. Empty if the file has no EXIF.
+    :raises ValueError: If the file isn't a JPEG
+    """
+    with open(filepath, "rb") as file:
+        tiff = find_exif_segment(file)
+    return parse_tiff(tiff) if tiff else {}
+
+
+def find_exif_segment(file: BinaryIO) -> Optional[bytes]:
+    """
+    Walks the JPEG's marker segments up to the start of scan.
+    :return: The TIFF structure inside the EXIF APP1 segment, or None if there isn't one
+    """
+    if file.read(2) != bytes([0xFF, SOI]):
+        raise ValueError("Not a JPEG")
+    while True:
+        marker = file.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None  # Truncated or corrupt. Either way, no EXIF to be found.
+        if marker[1] == 0xFF:  # Fill byte, the marker is the next byte
+            file.seek(-1, 1)
+            continue
+        if marker[1] in standalone_markers:
+            continue
+        if marker[1] in (SOS, EOI):
+            return None
+
+        length_bytes = file.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = struct.unpack(">H", length_bytes)[0] - 2
+        if marker[1] == APP1:
+            payload = file.read(length)
+            if payload.startswith(b"Exif\x00\x00"):
+                return payload[6:]
+        else:
+            file.seek(length, 1)
+
+
+def parse_tiff(tiff: bytes) -> Dict[str, str]:
+    """
+    Follows IFD0 to the Exif sub-IFD and formats the salient tags found there.
+    """
+    order = {b"II": "<", b"MM": ">"}.get(tiff[:2])
+    if order is None:
+        return {}
+    ifd0 = struct.unpack_from(order + "L", tiff, 4)[0]
+    exif_ifd = read_ifd(tiff, order, ifd0, {EXIF_IFD_POINTER}).get(EXIF_IFD_POINTER)
+    if not exif_ifd:
+        return {}
+    values = read_ifd(tiff, order, int(exif_ifd[0]), salient_tags.keys())
+    return {salient_tags[tag]: value for tag, value in values.items()}
+
+
+def read_ifd(tiff: bytes, order: str, offset: int, wanted) -> Dict[int, object]:
+    """
+    :return: Wanted tags in the IFD at offset. Rationals and numbers are formatted like exiv2 does, except for
+        EXIF_IFD_POINTER, which is left as a tuple of numbers.
+    """
+    output = {}
+    try:
+        count = struct.unpack_from(order + "H", tiff, offset)[0]
+        for i in range(count):
+            tag, tiff_type, value_count, value_offset = struct.unpack_from(order + "HHL4s", tiff, offset + 2 + i * 12)
+            if tag not in wanted or tiff_type not in tiff_types:
+                continue
+            value_format, size = tiff_types[tiff_type]
+            data = value_offset  # Values of 4 bytes or less are stored in the entry itself
+            if size * value_count > 4:
+                start = struct.unpack(order + "L", value_offset)[0]
+                data = tiff[start:start + size * value_count]
+
+            if tiff_type == 2:
+                output[tag] = data[:value_count].split(b"\x00")[0].decode("ascii", "replace")
+                continue
+            numbers = struct.unpack_from(order + value_format * value_count, data)
+            if tag == EXIF_IFD_POINTER:
+                output[tag] = numbers
+            elif len(value_format) == 2:  # Rationals
+                output[tag] = " ".join(f"{numbers[i]}/{numbers[i + 1]}" for i in range(0, len(numbers), 2))
+            else:
+                output[tag] = " ".join(str(number) for number in numbers)
+    except struct.error:
+        pass  # Offsets pointing past the end of the segment. Keep whatever was read before that.
+    return output
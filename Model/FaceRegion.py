@@ -0,0 +1,41 @@
+from typing import Tuple, Optional
+
+import numpy
+from numpy import ndarray
+
+class FaceRegion:
+    """
+    Where a face was found in an image and how, so it can be encoded again or cropped without looking for it.
+    """
+    def __init__(self, box: Tuple[int, int, int, int], landmarks: Optional[ndarray] = None,
+                 detector: Optional[str] = None, source_scale: Optional[float] = None):
+        """
+        :param box: (top, right, bottom, left), like face_recognition's locations
+        :param landmarks: The 68 (x, y) landmark points the face was encoded from, one per row
+        :param detector: Detector that found the face, one of FaceRecognizer.batch_models
+        :param source_scale: Pixels of this region per pixel of the image the face was found in
+        """
+        self.box = box
+        self.landmarks = landmarks
+        self.detector = detector
+        self.source_scale = source_scale
+
+    def __repr__(self):
+        return f"FaceRegion({self.box}, {self.detector} at {self.source_scale})"
+
+    def scaled(self, factor: float) -> "FaceRegion":
+        """
+        :return: This region in an image factor times the size of the one it's in now
+        """
+        box = tuple(int(round(side * factor)) for side in self.box)
+        landmarks = None if self.landmarks is None else numpy.round(self.landmarks * factor).astype("int64")
+        source_scale = None if self.source_scale is None else self.source_scale * factor
+        return FaceRegion(box, landmarks, self.detector, source_scale)
+
+    def moved(self, x: int, y: int) -> "FaceRegion":
+        """
+        :return: This region with x added to its horizontal and y to its vertical coordinates
+        """
+        top, right, bottom, left = self.box
+        landmarks = None if self.landmarks is None else self.landmarks + (x, y)
+        return FaceRegion((top + y, right + x, bottom + y, left + x), landmarks, self.detector, self.source_scale)
@@ -1,44 +1,56 @@
 # Builtins
 from glob import glob
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, Tuple, Optional, Union
 from os import path
+import os
 import logging
 
 # External modules
 from numpy.core.multiarray import ndarray
 import pyexiv2 as pe2
 
+# Custom code
+from Model.Sidecar import XmpSidecar
+
 
 class ImageFile:
     """
     Represents an image file of some kind and some of its metadata. May or may not be in the database.
+    Metadata is read the first time it's needed, and only the fields LITS uses are kept.
     """
+    __slots__ = ("filepath", "dbid", "encodings_in_image", "matched_people", "in_database",
+                 "md_init_complete", "iptc", "exif", "phash", "dimensions", "duplicate_of")
+
     encoding_store_field_name = "Xmp.dc.Description"  # TODO: Extend pyexiv2 to support custom namespaces
     keyword_field_name = "Iptc.Application2.Keywords"
     normal_encoding = "ISO-8859-1"  # Single-byte unicode approximation
     exif_timestamp_format = "%Y:%m:%d %H:%M:%S"
+    salient_exif_fields = ("Exif.Photo.FNumber", "Exif.Photo.ExposureTime", "Exif.Photo.ISOSpeedRatings",
+                           "Exif.Photo.DateTimeOriginal")
+    use_sidecar = False  # Keep keywords in <name>.xmp instead of changing the image file itself
 
-    def __init__(self, filepath: str, skip_md_init: bool = False):
+    def __init__(self, filepath: str, skip_md_init: bool = True):
         """
         :param filepath: Path to an image file
-        :param skip_md_init: Skip initializing metadata. Mostly for unit tests.
+        :param skip_md_init: Wait until metadata is first used to read it. Pass False to read it immediately.
         """
         # Parameters
         self.filepath = filepath
 
         # Other fields
-        self.extension = self.filepath.split(".")[-1]
         self.dbid: int = -1
         self.encodings_in_image: List[ndarray] = []  # Not a list of FaceEncoding instances because it might not be in the DB yet
         self.matched_people: List[Person] = []
         self.in_database = False
+        self.phash: Optional[int] = None  # Perceptual hash, only worked out for near-duplicate detection
+        self.dimensions: Optional[Tuple[int, int]] = None  # (width, height), found along with phash
+        self.duplicate_of = None  # Id or, if it's from the same scan, path of the image this is a near duplicate of
 
         # Metadata fields
         self.md_init_complete = False
-        self.iptc: Dict = {}
-        self.exif: Dict = {}
-        self.xmp: Dict = {}
+        self.iptc: Dict = {}  # Only keyword_field_name
+        self.exif: Dict = {}  # Only salient_exif_fields
         if not skip_md_init:
             self.init_metadata()
 
@@ -49,7 +61,11 @@ class ImageFile:
         return self.filepath
 
     def __repr__(self):
-        f"Image ({str(self)})"
+        return f"Image ({str(self)})"
+
+    @property
+    def extension(self) -> str:
+        return self.filepath.split(".")[-1]
 
     def is_tracked(self) -> bool:
         """
@@ -57,32 +73,53 @@ class ImageFile:
         """
         return self.dbid is not None
 
-    def init_metadata(self):
+    def stat_key(self) -> Tuple[str, int, int]:
+        """
+        Identifies this version of the file using only the file system, without opening it.
+        :return: Path, modified time in nanoseconds and size in bytes
+        """
+        stat = os.stat(self.filepath)
+        return self.filepath, stat.st_mtime_ns, stat.st_size
+
+    def init_metadata(self, data: Optional[bytes] = None):
         """
-        Load IPTC metadata for this image.
-        :return: Fields with data in them.
+        Load IPTC and EXIF metadata for this image, keeping only the fields LITS uses.
+        :param data: The file's contents, if they've already been read. Otherwise the file is opened.
         """
-        file = pe2.Image(self.filepath)
-        self.iptc = file.read_iptc(encoding=self.normal_encoding)
-        self.exif = file.read_exif(encoding=self.normal_encoding)
-        self.xmp = file.read_xmp(encoding=self.normal_encoding)
+        file = pe2.ImageData(data) if data is not None else pe2.Image(self.filepath)
+        iptc = file.read_iptc(encoding=self.normal_encoding)
+        exif = file.read_exif(encoding=self.normal_encoding)
         file.close()
+
+        self.iptc = {key: iptc[key] for key in [self.keyword_field_name] if key in iptc}
+        self.exif = {key: exif[key] for key in self.salient_exif_fields if key in exif}
         self.md_init_complete = True
 
     def clear_keywords(self):
-        patch = {self.keyword_field_name: ""}
+        if self.use_sidecar:
+            XmpSidecar(self.filepath).set_keywords([])
+            return
+
+        patch = {self.keyword_field_name: []}
         loaded = pe2.Image(self.filepath)
         loaded.modify_iptc(patch, encoding=ImageFile.normal_encoding)
         loaded.close()
 
-        self.iptc[self.keyword_field_name] = ""
+        self.iptc[self.keyword_field_name] = []
 
     def get_keywords(self, force_refresh: bool = False) -> List[str]:
+        """
+        :return: Keywords from the sidecar if using sidecars and there is one, otherwise from the image's IPTC
+        """
+        if self.use_sidecar:
+            sidecar_keywords = XmpSidecar(self.filepath).get_keywords()
+            if sidecar_keywords is not None:
+                return sidecar_keywords
+
         if not self.md_init_complete or force_refresh:
             self.init_metadata()
 
-        field_data = self.iptc.get("Iptc.Application2.Keywords", "")
-        return field_data.split(",") if len(field_data) > 0 else []
+        return self.split_keywords(self.iptc.get(self.keyword_field_name, ""))
 
 
     def append_keywords(self, to_append: List[str]) -> int:
@@ -91,65 +128,129 @@ class ImageFile:
         :param to_append: Keywords to append
         :return: Number of keywords that were appended.
         """
-        if not self.md_init_complete:
-            self.init_metadata()
+        return self.update_keywords(to_append=to_append)
 
-        initial_kw: List[str] = self.get_keywords()
-        current = initial_kw.copy()
+    def remove_keywords(self, to_remove: List[str]) -> int:
+        """
+        Removes keywords from the keyword list, leaving any others alone.
+        :param to_remove: Keywords to remove
+        :return: Number of keywords that were removed.
+        """
+        return self.update_keywords(to_remove=to_remove)
 
-        new_kws = 0
-        for keyword in to_append:
-            if keyword not in current:
-                current.append(keyword)
-                new_kws += 1
-        if current == initial_kw:
-            return 0
+    def update_keywords(self, to_append: List[str] = (), to_remove: List[str] = ()) -> int:
+        """
+        Appends and removes keywords in one read-modify-write of the file. The file is opened once, only IPTC is
+        read, and only the keyword field is written, and only if it changed.
+        :param to_append: Keywords to append, skipping duplicates
+        :param to_remove: Keywords to remove
+        :return: Number of keywords that were appended or removed.
+        """
+        if self.use_sidecar:
+            return self.update_sidecar_keywords(to_append, to_remove)
 
-        current_string: str = ",".join(current)
+        with pe2.Image(self.filepath) as loaded:
+            initial_field = loaded.read_iptc(encoding=self.normal_encoding).get(self.keyword_field_name, "")
+            initial_kw: List[str] = self.split_keywords(initial_field)
 
-        patch = {self.keyword_field_name: current_string}
-        loaded = pe2.Image(self.filepath)
-        loaded.modify_iptc(patch, encoding=ImageFile.normal_encoding)
-        loaded.close()
+            current, changes = self.merge_keywords(initial_kw, to_append, to_remove)
+            if current == initial_kw:
+                return 0
 
-        self.iptc[self.keyword_field_name] = current_string
+            # One IPTC value per keyword, as the field is repeatable
+            loaded.modify_iptc({self.keyword_field_name: current}, encoding=self.normal_encoding)
 
-        return new_kws
+        if self.md_init_complete:  # Keep the cached copy in step. Otherwise it's read fresh when needed.
+            self.iptc[self.keyword_field_name] = current
+
+        return changes
+
+    def update_sidecar_keywords(self, to_append: List[str] = (), to_remove: List[str] = ()) -> int:
+        """
+        Like update_keywords, but changes the sidecar and leaves the image file alone. A new sidecar starts out with
+        the image's own IPTC keywords, so tags added by other programs aren't lost.
+        """
+        sidecar = XmpSidecar(self.filepath)
+        initial_kw = sidecar.get_keywords()
+        if initial_kw is None:
+            initial_kw = self.get_keywords()
+
+        current, changes = self.merge_keywords(initial_kw, to_append, to_remove)
+        if current == initial_kw and sidecar.exists():
+            return 0
+
+        sidecar.set_keywords(current)
+        return changes
+
+    @staticmethod
+    def split_keywords(field_data: Union[str, List[str]]) -> List[str]:
+        """
+        :param field_data: The IPTC keyword field as pyexiv2 reads it: a list with one value per keyword, or in older
+            pyexiv2 versions one string. Values holding several comma-joined keywords, as earlier versions of LITS
+            wrote, are split up.
+        :return: Keywords in the field
+        """
+        values = [field_data] if isinstance(field_data, str) else field_data
+        return [keyword for value in values for keyword in value.split(",") if keyword]
+
+    @staticmethod
+    def merge_keywords(initial: List[str], to_append: List[str], to_remove: List[str]) -> Tuple[List[str], int]:
+        """
+        :return: The keyword list with removals and then non-duplicate appends applied, and how many of each there were
+        """
+        current = [keyword for keyword in initial if keyword not in to_remove]
+        changes = len(initial) - len(current)
+        for keyword in to_append:
+            if keyword not in current:
+                current.append(keyword)
+                changes += 1
+        return current, changes
 
     def get_salient_exif_data(self):
         """
         Gets common exposure data from EXIF and converts them into numbers where possible.
         :return:
         """
+        if not self.md_init_complete:
+            self.init_metadata()
+        return self.parse_salient_exif(self.exif, self.filepath)
+
+    @classmethod
+    def parse_salient_exif(cls, exif: Dict[str, str], filepath: str) -> Dict:
+        """
+        Converts salient EXIF fields, formatted as pyexiv2 reads them, into numbers and dates.
+        :param exif: EXIF fields from pyexiv2 or from Model.ExifHeader
+        :param filepath: Image the fields came from, for logging
+        """
         output = {"aperture": None, "shutter_speed": None, "iso": None}
 
         # This code is repetitive, but each needs to be handled slightly different.
 
         try:
-            aperture = self.exif.get("Exif.Photo.FNumber")
-            output["aperture"] = round(self.frac_string_to_number(aperture), 1) if aperture else None
+            aperture = exif.get("Exif.Photo.FNumber")
+            output["aperture"] = round(cls.frac_string_to_number(aperture), 1) if aperture else None
         except:
-            logging.warning(f"Failed to parse EXIF 'FNumber' field for '{self.filepath}'. Expected a fraction, got '{aperture}'")
+            logging.warning(f"Failed to parse EXIF 'FNumber' field for '{filepath}'. Expected a fraction, got '{aperture}'")
 
         try:
-            ss = self.exif.get("Exif.Photo.ExposureTime")
-            output["shutter_speed"] = self.frac_string_to_number(ss) if ss else None
+            ss = exif.get("Exif.Photo.ExposureTime")
+            output["shutter_speed"] = cls.frac_string_to_number(ss) if ss else None
         except:
-            logging.warning(f"Failed to parse EXIF 'ExposureTime' field for '{self.filepath}'. Expected an fraction, got '{ss}'")
+            logging.warning(f"Failed to parse EXIF 'ExposureTime' field for '{filepath}'. Expected an fraction, got '{ss}'")
 
         try:
-            iso = self.exif.get("Exif.Photo.ISOSpeedRatings")
+            iso = exif.get("Exif.Photo.ISOSpeedRatings")
             iso = iso.split()[0]
             output["iso"] = int(iso) if iso else None
         except:
-            logging.warning(f"Failed to parse EXIF 'ISOSpeedRatings' field for '{self.filepath}'. Expected an int, got '{iso}'")
+            logging.warning(f"Failed to parse EXIF 'ISOSpeedRatings' field for '{filepath}'. Expected an int, got '{iso}'")
 
         try:
-            date_taken = self.exif.get("Exif.Photo.DateTimeOriginal")
-            date_taken = datetime.strptime(date_taken, self.exif_timestamp_format)
+            date_taken = exif.get("Exif.Photo.DateTimeOriginal")
+            date_taken = datetime.strptime(date_taken, cls.exif_timestamp_format)
             output["date_taken"] = date_taken if date_taken else None
         except:
-            logging.warning(f"Failed to parse EXIF 'DateTimeOriginal' field for '{self.filepath}'. Expected an datetime, got '{date_taken}'")
+            logging.warning(f"Failed to parse EXIF 'DateTimeOriginal' field for '{filepath}'. Expected an datetime, got '{date_taken}'")
 
         return output
 
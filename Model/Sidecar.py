@@ -0,0 +1,80 @@
+# Builtins
+from io import BytesIO
+from typing import List, Optional
+from os import path
+import os
+import xml.etree.ElementTree as ET
+
+
+class XmpSidecar:
+    """
+    An XMP sidecar file, <name>.xmp next to <name>.jpg, as used by Lightroom, darktable, digiKam and others.
+    Only dc:subject (keywords) is read or written. Anything else already in the sidecar is kept.
+    """
+    namespaces = {
+        "x": "adobe:ns:meta/",
+        "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+        "dc": "http://purl.org/dc/elements/1.1/",
+    }
+
+    def __init__(self, image_path: str):
+        """
+        :param image_path: Path to the image this sidecar describes. The sidecar may or may not exist yet.
+        """
+        self.filepath = path.splitext(image_path)[0] + ".xmp"
+
+    def __str__(self):
+        return self.filepath
+
+    def exists(self) -> bool:
+        return path.exists(self.filepath)
+
+    def tag(self, prefix: str, name: str) -> str:
+        return f"{{{self.namespaces[prefix]}}}{name}"
+
+    def get_keywords(self) -> Optional[List[str]]:
+        """
+        :return: Keywords in dc:subject, or None if there's no sidecar
+        """
+        if not self.exists():
+            return None
+        root = ET.parse(self.filepath).getroot()
+        return [li.text or "" for subject in root.iter(self.tag("dc", "subject"))
+                for li in subject.iter(self.tag("rdf", "li"))]
+
+    def set_keywords(self, keywords: List[str]) -> None:
+        """
+        Replaces the keywords in dc:subject, creating the sidecar if it doesn't exist.
+        The new sidecar is written alongside and then swapped in, so a crash never leaves half a file behind.
+        """
+        if self.exists():
+            with open(self.filepath, "rb") as file:
+                data = file.read()
+            for event, (prefix, uri) in ET.iterparse(BytesIO(data), events=["start-ns"]):
+                ET.register_namespace(prefix, uri)  # Keep the file's own prefixes instead of ns0, ns1...
+            root = ET.fromstring(data)
+        else:
+            root = ET.Element(self.tag("x", "xmpmeta"))
+        for prefix, uri in self.namespaces.items():
+            ET.register_namespace(prefix, uri)
+
+        rdf = root.find(self.tag("rdf", "RDF"))
+        if rdf is None:
+            rdf = ET.SubElement(root, self.tag("rdf", "RDF"))
+        descriptions = rdf.findall(self.tag("rdf", "Description"))
+        description = next((d for d in descriptions if d.find(self.tag("dc", "subject")) is not None),
+                           descriptions[0] if descriptions else None)
+        if description is None:
+            description = ET.SubElement(rdf, self.tag("rdf", "Description"), {self.tag("rdf", "about"): ""})
+
+        subject = description.find(self.tag("dc", "subject"))
+        if subject is None:
+            subject = ET.SubElement(description, self.tag("dc", "subject"))
+        subject.clear()
+        bag = ET.SubElement(subject, self.tag("rdf", "Bag"))
+        for keyword in keywords:
+            ET.SubElement(bag, self.tag("rdf", "li")).text = keyword
+
+        temp_path = self.filepath + ".tmp"
+        ET.ElementTree(root).write(temp_path, encoding="utf-8", xml_declaration=True)
+        os.replace(temp_path, self.filepath)
@@ -1,5 +1,6 @@
 # Builtins
-from typing import Optional
+from collections import Counter
+from typing import Optional, List, Dict
 import math
 import numpy as np
 import argparse
@@ -12,17 +13,22 @@ from matplotlib import style
 from matplotlib.ticker import ScalarFormatter
 
 from Controllers.Database import Database
+from Controllers.FaceRecognizer import assign_in_order
 
 
-def show_dashboard(db: Database):
+def show_dashboard(db: Database, tolerance: Optional[float] = None):
     #style.use('fivethirtyeight')
     fig, axes = plt.subplots(2, 3)
     fig.canvas.set_window_title("LITS Data Dashboard")
     fig.set_size_inches(15, 10)
     fig.set_dpi(100)
 
-    graph2d_from_query(db, axes[0][0], "People per Picture", "Number of People", "Number of Pictures",
-                       graph_type="bar")
+    if tolerance is None:
+        graph2d_from_query(db, axes[0][0], "People per Picture", "Number of People", "Number of Pictures",
+                           graph_type="bar")
+    else:  # Based on recorded match distances, so any tolerance can be shown without re-matching
+        graph2d(axes[0][0], f"People per Picture at Tolerance {tolerance}", "Number of People", "Number of Pictures",
+                people_per_picture_at_tolerance(db, tolerance), graph_type="bar")
     graph2d_from_query(db, axes[0][1], "Pictures per Known Person", "Person", "Number of Pictures",
                        graph_type="bar", rotation=30)
     graph2d_from_query(db, axes[0][2], "Picture Counts Over Time", "Date", "Number of Pictures",
@@ -53,7 +59,33 @@ def show_dashboard(db: Database):
 
 def graph2d_from_query(db: Database, plot: plt.axes,
                        title: str, x_label: str, y_label: str,
-                       graph_type: str = "plot", rotation: Optional[int] = None):
+                       graph_type: str = "plot", rotation: Optional[int] = None, params: List = ()):
+    sql = queries[title]
+
+    # Get data, without waiting on a scan that might be writing at the same time
+    with db.reader() as connection:
+        result = connection.execute(sql, params).fetchall()
+    pivot = {row["x"]: row["y"] for row in result}
+    graph2d(plot, title, x_label, y_label, pivot, graph_type, rotation)
+
+
+def people_per_picture_at_tolerance(db: Database, tolerance: float) -> Dict[int, int]:
+    """
+    Counts the people each picture would be tagged with if it were re-tagged at a tolerance. Faces are assigned
+    to people with assign_in_order, as matching and re-tagging do, so a face close to several people counts as one.
+    :return: Number of pictures keyed by number of people in them, for pictures with anyone in them
+    """
+    with db.reader() as connection:
+        result = connection.execute(queries["Face Matches at Tolerance"], [tolerance]).fetchall()
+    candidates = {}
+    for row in result:
+        candidates.setdefault(row["image_id"], []).append((row["encoding_id"], row["person_id"], row["distance"]))
+    counts = Counter(len(assign_in_order(image_candidates)) for image_candidates in candidates.values())
+    return dict(sorted(counts.items()))
+
+
+def graph2d(plot: plt.axes, title: str, x_label: str, y_label: str, pivot: Dict,
+            graph_type: str = "plot", rotation: Optional[int] = None):
     # Set up
     plot.set_title(title)
     plot.set_xlabel(x_label)
@@ -63,12 +95,6 @@ def graph2d_from_query(db: Database, plot: plt.axes,
         for label in plot.get_xticklabels():
             label.set_rotation(45)
 
-    sql = queries[title]
-
-    # Get data
-    result = db.connection.execute(sql).fetchall()
-    pivot = {row["x"]: row["y"] for row in result}
-
     if graph_type == "plot":
         plot.plot(pivot.keys(), pivot.values())
     elif graph_type == "bar":
@@ -135,6 +161,16 @@ queries["People per Picture"] = """
         ) subquery
     GROUP BY num_people
     """
+queries["Face Matches at Tolerance"] = """
+    SELECT
+        IE.image_id,
+        FM.encoding_id,
+        FM.person_id,
+        FM.distance
+    FROM ImageEncoding IE
+    INNER JOIN FaceMatch FM ON IE.encoding_id = FM.encoding_id
+    WHERE FM.distance < ?
+    """
 queries["Pictures per Known Person"] = """
     SELECT
         name as x,
@@ -201,6 +237,8 @@ queries["ISO Frequency"] = """
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--db", help="Path to the database file or where to create it", default="lits.db")
+    parser.add_argument("--tolerance", help="Count people per picture at this match tolerance", default=None,
+                        type=float)
     args = parser.parse_args()
     db = Database(args.db)
-    show_dashboard(db)
\ No newline at end of file
+    show_dashboard(db, args.tolerance)
\ No newline at end of file
@@ -3,13 +3,79 @@ Main execution module for LITS - Local Image Tagging and Search.
 Exmaple usage:
 `py lits.py --scanroot c:\pictures --known c:\pictures\lits-people [-db cache.db -tolerance 0.5]`
 Required:
---scanroot is the root of the pictures to be scanned for faces.
---known is the root of the folder structure where identified people can be found.
+--scanroot is the root of the pictures to be scanned for faces. Not needed with --rematch, --retag, --write-pending,
+    --compact-store, --cluster, --name-cluster or --reencode.
+--known is the root of the folder structure where identified people can be found. Not needed with --index-metadata.
 Optional:
 --db is the path to e SQLite database. Will be loaded if exists and created if not.
 --tolerance is optional and adjusts how strict face matches should be to be considered a match.
     Defaults to 0.6, lower numbers are stricter and will reduce false positives at the cost
     of increasing false negatives.
+--detection sets how faces are found. standard looks for them in a 1250px copy of each picture. two-stage looks in
+    a smaller copy, --detect-size px (default 500), then encodes each face from a sharper crop. At 500px it's two to
+    five times quicker, but misses faces smaller than about a twelfth of the picture's longest side, so raise
+    --detect-size for big group photos. adaptive is two-stage that starts at 800px and only looks again in a bigger
+    copy (1250, then 2000px, or up to --detect-size) when the faces it found are small or something almost looked
+    like a face. How many pictures were searched at each size is listed at the end of the scan. Where each face
+    was found is kept either way.
+--face-gate takes a quick look at each new picture with OpenCV's face detector first, and skips the much slower
+    face_recognition detector if it finds nothing face-like. Much quicker for libraries with many pictures of no
+    people, but faces it misses are never found. high-recall misses the fewest faces, fast skips the most pictures,
+    balanced is in between. Needs OpenCV (pip install opencv-python-headless).
+--detect-batch N sends pictures to workers N at a time, which find faces in those of the same size together, with
+    --batch-model's detector: hog (the default, the same one as standard detection) or cnn, the only one dlib runs on
+    a whole batch at once. Without a GPU cnn is tens of times slower, and batching hog saves little; see
+    test-scripts/bench-batch-detect.py. Batches are searched like standard detection at 1250px, so it can't be
+    combined with two-stage or adaptive detection or --detect-size.
+--workers is the number of processes that encode faces in parallel. Defaults to 1.
+    Database writes, matching and keyword writes always happen in the main process.
+--queue-size caps how many images can be waiting between the encoding workers and the main process. Defaults to twice
+    the number of workers, times --detect-batch.
+--batch-size and --batch-seconds control how often database writes are committed. Defaults to every 100 images
+    or 10 seconds, whichever comes first. Use 1 to commit every write immediately.
+--incremental skips opening files whose path, modified time and size match what's in the database, and doesn't match
+    images that were already scanned again. Use --rematch to match those against people added since.
+--rematch matches faces already in the database against people added or changed since the last rematch,
+    instead of scanning. No images are decoded. --rematch-chunk sets how many images are loaded at a time.
+--retag re-applies the closest people recorded for every face at the current --tolerance, instead of scanning.
+    No faces are compared, so trying a stricter or looser tolerance is quick.
+--top-k is how many of the closest people are recorded for each face. Defaults to 3.
+--write-threads and --write-rate control how keywords are written to files once matching is done. Keyword changes
+    are journalled in the database as faces are matched, then written by --write-threads threads (default 4), starting
+    at most --write-rate files per second (default unlimited).
+--no-write only journals keyword changes. --write-pending writes whatever is in the journal, instead of scanning.
+    An interrupted write carries on where it stopped the next time keywords are written.
+--index-metadata fills in exposure data (aperture, shutter speed, ISO, date taken) for every picture under --scanroot
+    by reading just the EXIF header of each, instead of scanning for faces. It's much faster than a scan, so the
+    dashboard can cover a whole library straight away. --known isn't needed. Pictures indexed this way are scanned
+    for faces by the next normal scan.
+--packed-store keeps face encodings in one memory-mapped file next to the database (lits.encodings.npy for lits.db)
+    instead of one BLOB per row, moving any already in the database. Once a database has one it's always used.
+    --compact-store rewrites it without space left by interrupted writes, instead of scanning.
+--precision sets how face encodings are stored: float64 (the default), float32 (half the size) or int8 (an eighth),
+    converting any already in the database. Matching results are the same as long as the lower precision doesn't
+    move a face across the tolerance. The database remembers it, so it's only needed once.
+--ann matches against an approximate index of known faces (lits.ann.npz next to lits.db) instead of comparing every
+    face with every known encoding. Much faster with tens of thousands of known people, at the cost of occasionally
+    missing a match. --ann-probe sets how much of the index is searched per face, defaults to 8; higher misses less.
+    The index is built on first use, then kept up to date as people are added.
+--cluster groups faces that didn't match anybody into clusters of faces that look like the same person, instead of
+    scanning, and lists the biggest with a picture from each. --cluster-threshold is how close faces have to be to be
+    grouped, defaults to 0.5. Clustering again replaces the previous clusters.
+--name-cluster ID NAME makes every face in cluster ID a face of NAME, adding NAME to their pictures. NAME is created
+    if they aren't a known person yet. Use --rematch afterwards to find NAME in other pictures.
+--reencode encodes every stored face again from where it was found, instead of scanning, with each face --jitter
+    times (default 1). Faces aren't looked for again, which is the slow part of a scan. Faces keep the people they were
+    matched to, and distances to their closest people are recorded again for --retag. The --ann index is trained
+    again next time it's used. Faces stored before LITS kept where they were found are skipped.
+--near-duplicates N reuses the faces of an already scanned picture the same size as a new one, instead of looking for
+    them again, if their perceptual hashes differ in no more than N of 64 bits. For bursts and re-saved copies; 4 is
+    a good start. Re-saved copies differ in 0-2 bits, different pictures in 12 or more. Hashes are kept for
+    pictures scanned with it on, and the share of new pictures that reused faces is shown at the end of the scan.
+    Workers hash pictures as they read them, and with --workers above 1 each only knows the pictures it hashed
+    itself, so up to one frame of a burst per worker is still scanned.
+--sidecar writes keywords to an XMP sidecar (<name>.xmp, dc:subject) next to each picture and never changes the
+    picture itself. Keywords already in a sidecar are used instead of the picture's own.
 
 Author: William Lockwood
 GitHub: wlockwood/lits
@@ -17,57 +83,180 @@ GitHub: wlockwood/lits
 
 # Builtins
 import argparse
-from os import path, getcwd
-from glob import glob
-from typing import List, Optional, Dict
+from os import path, getcwd, scandir
+from typing import List, Optional, Dict, Tuple, Iterator, Set
+from collections import Counter
 from time import perf_counter as pc
 from datetime import datetime
 import logging
 from numpy.core.multiarray import ndarray
 # External modules
+import numpy
 
 # Custom modules
 from Model.FaceEncoding import FaceEncoding
+from Model.FaceRegion import FaceRegion
 from Model.Person import Person
 from Model.ImageFile import ImageFile
+from Model.ExifHeader import read_exif_header
 from Controllers.Database import Database
-from Controllers.FaceRecognizer import encode_faces, match_best
+from Controllers.FaceRecognizer import KnownFaceIndex, assign_in_order, detection_modes, DETECT_SIZE, gate_presets, \
+    gate_available, batch_models, encode_crops
+from Controllers.AnnIndex import AnnIndex
+from Controllers.Clusterer import cluster_encodings
+from Controllers.Pipeline import encode_images, load_and_encode
+from Controllers.KeywordWriter import write_pending_keywords
+from Controllers.Quantizer import precisions
 import dashboard
 
 valid_extensions = [".jpg"]  # [".jpg", ".png", ".bmp", ".gif"]
 log_path = "lastrun.log"
+rematch_watermark_setting = "rematch_watermark"  # Highest PersonEncoding id already rematched
 logger = logging.getLogger(__name__)
 
 
-def main():
-    print("LITS initializing...")
-    print(f"Running from {getcwd()}, logging to {log_path}")
-    logging.basicConfig(filename=log_path, level=logging.DEBUG)
-
-    # Parse arguments and check validity
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parses and checks the command line.
+    :param argv: Arguments to parse, or None for sys.argv's
+    :return: Parsed arguments. Exits with a usage message if they can't be used together.
+    """
     parser = argparse.ArgumentParser()
-    parser.add_argument("--scanroot", help="Directory to look for taggable images", required=True)
-    parser.add_argument("--known", help="Directory of known people's faces", required=True)
+    parser.add_argument("--scanroot", help="Directory to look for taggable images. "
+                                           "Required unless rematching, re-tagging, writing pending keywords, "
+                                           "compacting or clustering")
+    parser.add_argument("--known", help="Directory of known people's faces. Required unless indexing metadata")
     parser.add_argument("--db", help="Path to the database file or where to create it", default="lits.db")
     parser.add_argument("--tolerance", help="Lower forces stricter matches", default=0.6, type=float)
+    parser.add_argument("--workers", help="Number of processes encoding faces in parallel", default=1, type=int)
+    parser.add_argument("--detection", help="How faces are found. two-stage is quicker but misses very small faces, "
+                                            "adaptive looks harder only where faces are small", choices=detection_modes,
+                        default="standard")
+    parser.add_argument("--detect-size", help="Size of the copy faces are looked for in, or the largest adaptive "
+                                              "detection goes up to. Larger finds smaller faces but is slower. "
+                                              f"Defaults to 1250 for standard, {DETECT_SIZE} for two-stage",
+                        default=None, type=int)
+    parser.add_argument("--face-gate", help="Skip face detection for pictures OpenCV finds nothing face-like in. "
+                                            "Needs OpenCV", choices=list(gate_presets), default=None)
+    parser.add_argument("--detect-batch", help="Send pictures to workers this many at a time, and find faces in those "
+                                               "the same size together",
+                        default=1, type=int)
+    parser.add_argument("--batch-model", help="Detector batches use. cnn is only practical with a GPU",
+                        choices=batch_models, default="hog")
+    parser.add_argument("--near-duplicates", help="Reuse the faces of a scanned picture the same size whose "
+                                                  "perceptual hash differs in at most this many bits", default=None,
+                        type=int, metavar="N")
+    parser.add_argument("--queue-size", help="Maximum images waiting between encoding and writing. "
+                                             "Defaults to twice the number of workers, times --detect-batch",
+                        default=None, type=int)
+    parser.add_argument("--batch-size", help="Commit to the database every this many images", default=100, type=int)
+    parser.add_argument("--batch-seconds", help="Commit to the database at least this often", default=10, type=float)
+    parser.add_argument("--incremental", help="Treat files with an unchanged path, modified time and size as "
+                                              "already indexed without opening them", action="store_true")
+    parser.add_argument("--rematch", help="Instead of scanning, match faces already in the database against people "
+                                          "added or changed since the last rematch", action="store_true")
+    parser.add_argument("--rematch-chunk", help="Images loaded at a time while rematching or re-tagging",
+                        default=1000, type=int)
+    parser.add_argument("--retag", help="Instead of scanning, re-apply recorded matches at --tolerance",
+                        action="store_true")
+    parser.add_argument("--reencode", help="Instead of scanning, encode every stored face again from where it was "
+                                           "found, without looking for faces again", action="store_true")
+    parser.add_argument("--jitter", help="Times each face is transformed while re-encoding. Higher is slower but more "
+                                         "accurate", default=1, type=int)
+    parser.add_argument("--top-k", help="Closest people to record for each face", default=3, type=int)
+    parser.add_argument("--write-threads", help="Files to write keywords to at the same time", default=4, type=int)
+    parser.add_argument("--write-rate", help="Maximum files to write keywords to per second", default=None,
+                        type=float)
+    parser.add_argument("--no-write", help="Only journal keyword changes, don't write them to files",
+                        action="store_true")
+    parser.add_argument("--sidecar", help="Write keywords to <name>.xmp sidecar files instead of the images",
+                        action="store_true")
+    parser.add_argument("--index-metadata", help="Instead of scanning for faces, quickly index exposure data from "
+                                                 "EXIF headers for the dashboard", action="store_true")
+    parser.add_argument("--packed-store", help="Keep encodings in one memory-mapped file next to the database "
+                                               "instead of in it, moving any already stored", action="store_true")
+    parser.add_argument("--compact-store", help="Instead of scanning, rewrite the packed encoding store without "
+                                                "unused rows", action="store_true")
+    parser.add_argument("--precision", help="How to store face encodings from now on, converting any already stored",
+                        choices=precisions, default=None)
+    parser.add_argument("--ann", help="Match against an approximate index of known faces, for very large known sets",
+                        action="store_true")
+    parser.add_argument("--ann-probe", help="Lists of the approximate index searched per face", default=8, type=int)
+    parser.add_argument("--cluster", help="Instead of scanning, group faces that didn't match anybody into likely "
+                                          "identities", action="store_true")
+    parser.add_argument("--cluster-threshold", help="Largest distance between faces in the same cluster", default=0.5,
+                        type=float)
+    parser.add_argument("--name-cluster", help="Instead of scanning, make a cluster's faces a person's",
+                        nargs=2, metavar=("ID", "NAME"))
+    parser.add_argument("--write-pending", help="Instead of scanning, write journalled keyword changes to files",
+                        action="store_true")
     # TODO: Add "--clear-keywords"? Would ignore pre-existing keywords when applying new
     # TODO: Add "--rescan"? Would ignore encodings cached in database
     # TODO: Add "--update-cached-metadata"? Would push new metadata from EXIF/IPTC/XMP in case the set we're caching changes
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    # Modes that don't scan
+    stored_only = args.rematch or args.retag or args.write_pending or args.compact_store or args.cluster \
+        or args.name_cluster or args.reencode
+    if not args.scanroot and not stored_only:
+        parser.error("--scanroot is required unless using --rematch, --retag, --write-pending, --compact-store, "
+                     "--cluster, --name-cluster or --reencode")
+    if args.face_gate and not gate_available():
+        parser.error("--face-gate needs OpenCV, install it with: pip install opencv-python-headless")
+    # Batches are always found like standard detection, at its own size
+    if args.detect_batch > 1 and args.detection != "standard":
+        parser.error(f"--detect-batch can't be combined with {args.detection} detection")
+    if args.detect_batch > 1 and args.detect_size:
+        parser.error("--detect-batch can't be combined with --detect-size")
+    if not args.known and not args.index_metadata:
+        parser.error("--known is required unless using --index-metadata")
+    return args
+
+
+def main():
+    print("LITS initializing...")
+    print(f"Running from {getcwd()}, logging to {log_path}")
+    logging.basicConfig(filename=log_path, level=logging.DEBUG)
+
+    args = parse_args()
+    stored_only = args.rematch or args.retag or args.write_pending or args.compact_store or args.cluster \
+        or args.name_cluster or args.reencode
 
-    assert path.exists(args.scanroot), f"'scanroot' path doesn't exist: {path.abspath(args.scanroot)}"
-    assert path.exists(args.known), f"'known' path doesn't exist: {path.abspath(args.known)}"
+    assert stored_only or path.exists(args.scanroot), f"'scanroot' path doesn't exist: {path.abspath(args.scanroot)}"
+    assert args.index_metadata or path.exists(args.known), f"'known' path doesn't exist: {path.abspath(args.known)}"
     if path.exists(args.db):
         print(f"Found pre-existing database at {path.abspath(args.db)}")
     else:
         print(f"Will create new database at {path.abspath(args.db)}")
 
+    ImageFile.use_sidecar = args.sidecar
+
     # Initialize database
-    db = Database(args.db)
+    db = Database(args.db, batch_size=args.batch_size, batch_seconds=args.batch_seconds,
+                  packed_store=args.packed_store)
+    if args.precision:
+        converted = db.set_precision(args.precision)
+        if converted:
+            print(f"Converted {converted:,} encodings to {args.precision}")
+    if args.packed_store:
+        moved = db.pack_encodings()
+        if moved:
+            print(f"Moved {moved:,} encodings into {db.store.filepath}")
+    if args.compact_store:
+        rows = db.compact_encoding_store()
+        print(f"Compacted the encoding store to {rows:,} encodings" if db.store else "No encoding store to compact")
+        if not (args.rematch or args.retag or args.write_pending or args.cluster or args.name_cluster
+                or args.reencode):
+            return
+
+    if args.index_metadata:
+        index_metadata(db, args.scanroot, exclude_dirs=[args.known] if args.known else [])
+        print("Opening dashboard...")
+        dashboard.show_dashboard(db)
+        return
 
     # Initialize list of known people
     # TODO: Add support for people folders instead of just single pictures
-    known_person_images = get_all_compatible_files(args.known)
+    known_person_images = list(find_compatible_files(args.known))
     print(f"{len(known_person_images):,} images of known people in {args.known}")
 
     for kpi in known_person_images:
@@ -98,72 +287,139 @@ def main():
                 db.get_or_associate_encoding(kpi_encoding.dbid, associate_id=found_person.dbid, person=True)
                 logging.debug(
                     f"File {kpi.filepath} already in database, but wasn't associated with person '{person_name}'.")
+        db.end_image()
+    db.flush()
+
+    if stored_only:
+        if args.reencode:
+            reencode_stored_faces(db, args.jitter, args.top_k)
+        if args.name_cluster:
+            name_cluster(db, int(args.name_cluster[0]), args.name_cluster[1])
+        if args.rematch:
+            rematch_stored_encodings(db, args.tolerance, args.rematch_chunk, args.top_k)
+        if args.retag:
+            retag_from_face_matches(db, args.tolerance, args.rematch_chunk)
+        if args.cluster:
+            cluster_unmatched(db, args.cluster_threshold)
+        write_keywords(db, args)
+        print("Opening dashboard...")
+        dashboard.show_dashboard(db)
+        return
 
     # Database now up to date, extract all known people
     known_people = db.get_all_people()
-    print(f"{len(known_people):,} known people found in database.")
-
-    # Build list of files to scan
-    images_to_scan = get_all_compatible_files(args.scanroot)
-    print(f"{len(images_to_scan):,} images in scanroot")
+    if args.ann:
+        known_index = AnnIndex.load(args.db, known_people, args.ann_probe)
+    else:
+        known_index = KnownFaceIndex(known_people)
+    print(f"{len(known_people):,} known people found in database with {len(known_index):,} face encodings.")
 
-    # Remove images that are in the known folder, if any
-    images_to_scan = [im for im in images_to_scan if path.abspath(im.filepath)
-                      not in [path.abspath(kpi.filepath) for kpi in known_person_images]]
-    print(f"{len(images_to_scan):,} images to scan after removing known-person images")
+    # Files to scan are found as the scan goes, skipping the known folder if it's inside the scanroot
+    images_to_scan = find_compatible_files(args.scanroot, exclude_dirs=[args.known])
 
     # Encoding images - the bulk of the work
     # Prep statistics for encoding
-    total = len(images_to_scan)
     scan_count = 0
-    timers = []
+    time_total = 0.0  # Running totals instead of a list so memory doesn't grow with the number of images
+    time_max = 0.0
+    searched_sizes: Counter = Counter()  # Images encoded by the size faces were looked for at
     start_time = pc()
     # Encode faces in files to scan (expensive!)
-    print(f"{len(images_to_scan):,} unscanned images")
-    print(f"Starting scan at {datetime.now()}")
+    print(f"Starting scan at {datetime.now()} with {args.workers} worker(s)")
+
+    # Incremental scans recognize unchanged files from os.stat alone, so metadata is only read for new or changed ones
+    indexed_by_stat: Dict[Tuple[str, int, int], int] = db.get_image_ids_by_stat() if args.incremental else {}
+    if args.incremental:
+        print(f"{len(indexed_by_stat):,} images indexed by path, modified time and size")
+
+    # Workers hash new images from the bytes they read anyway, and don't look for faces in near duplicates
+    scanned_hashes = db.get_perceptual_hashes() if args.near_duplicates is not None else []
+    scanned_ids: Dict[str, int] = {}  # Ids of the images hashed this scan, which workers know by path
+    new_images = 0
+    reused_images = 0
+    if args.near_duplicates is not None:
+        print(f"{len(scanned_hashes):,} images with perceptual hashes to reuse faces from")
+
+    def needs_encoding(image: ImageFile) -> bool:
+        nonlocal new_images
+        if args.incremental:
+            image_id = indexed_by_stat.get(image.stat_key())
+            if image_id:
+                image.dbid = image_id
+                return False
+        image_id = find_image_in_database(db, image)
+        if image_id and args.incremental:  # Known, but not by its current path/mtime - record it for next time
+            db.update_image_stat(image_id, image.filepath)
+        if image_id is not None:
+            return False
+        new_images += 1
+        return True
+
+    # TODO: Add error handling so single-image problems won't crash the whole run.
+    encoded = encode_images(images_to_scan, needs_encoding, workers=args.workers, max_pending=args.queue_size,
+                            detection=args.detection, detect_size=args.detect_size, gate=args.face_gate,
+                            detect_batch=args.detect_batch, batch_model=args.batch_model,
+                            near_duplicate_distance=args.near_duplicates, scanned_hashes=scanned_hashes)
+    # Encoding happens in the workers, everything else here
+    unchanged_count = 0
+    for image, new_encodings, regions, searched_size, encode_time in encoded:
+        if args.incremental and new_encodings is None and image.duplicate_of is None:
+            # Matched when it was first scanned. --rematch matches stored faces against people added since.
+            unchanged_count += 1
+            db.end_image()  # Commits stat updates for moved or touched files in step with the batch
+            continue
 
-    for image in images_to_scan:  # Iterating individually for now to make progress reporting easier
         # UI Updates
-        progress_percent = f"{scan_count / total * 100:3.1f}%"
-        matched_people_list = ", ".join(mp.name for mp in image.matched_people)
-        print(f"{progress_percent}\tProcessing '{image.filepath}'...")
+        print(f"{scan_count + 1:,}\tProcessing '{image.filepath}'...")
 
-        attribs_dirty = False # Have we modified the file?
         image_start_time = pc()
 
-        # TODO: Parallelize here on a per-image basis
-        # TODO: Add error handling so single-image problems won't crash the whole run.
-        image_id = ensure_image_in_database(db, image)
-        image.encodings_in_image = db.get_encodings_by_image_id(image_id)
+        if new_encodings is not None:
+            add_image_to_database(db, image, new_encodings, regions, searched_size)
+            searched_sizes[searched_size] += 1
+        elif image.duplicate_of is not None:  # A path if it's of an image earlier in this scan, which came first
+            source_id = scanned_ids.get(image.duplicate_of, image.duplicate_of)
+            image.dbid = db.add_near_duplicate(image, source_id)
+            reused_images += 1
+        if image.phash is not None:
+            scanned_ids[image.filepath] = image.dbid
+        image.encodings_in_image = db.get_encodings_by_image_id(image.dbid)
 
         # Match people
         if len(image.encodings_in_image) > 0:
-            found_people: Dict[Person, FaceEncoding] = match_best(known_people, image.encodings_in_image)
+            found_people = match_and_record(db, known_index, image.encodings_in_image, args.tolerance, args.top_k)
+            if len(found_people) > 0:  # A rescan only journals people who weren't in the picture already
+                already_found = db.get_person_ids_by_image_id(image.dbid)
+                found_people = {p: enc for p, enc in found_people.items() if p.dbid not in already_found}
 
-            # Write to file *prior* to storing to DB
+            # Store to database. Keywords are journalled with the matches and written to the file after the scan.
             image.matched_people = found_people.keys()
-            if len(image.matched_people) > 0:
-                append_count = image.append_keywords([mp.name for mp in image.matched_people])
-                if append_count > 0:
-                    attribs_dirty = True
-
-            # Store to database
             for person, enc in found_people.items():
                 db.get_or_associate_encoding(enc.dbid, associate_id=person.dbid, person=True)
+            db.queue_keywords(image.dbid, [mp.name for mp in image.matched_people])
 
-        # Update image attributes, just in case we tweaked them.
-        if attribs_dirty:
-            db.update_image_attributes(image)
+        db.end_image()
 
         # Stats and UI updates
         scan_count += 1
 
-        time_taken = pc() - image_start_time
-        timers.append(time_taken)
-
-
-    print(f"Image times: {sum(timers):,.1f}s, avg {sum(timers) / len(timers):.2}s, max {max(timers):.2}")
-    print(f"Done encoding {total:,} images. ({pc() - start_time:.1f}s total)")
+        time_taken = pc() - image_start_time + encode_time
+        time_total += time_taken
+        time_max = max(time_max, time_taken)
+
+    db.flush()
+    print(f"Image times: {time_total:,.1f}s, avg {time_total / max(scan_count, 1):.2}s, max {time_max:.2}")
+    print(f"Done encoding {scan_count:,} images. ({pc() - start_time:.1f}s total)")
+    if args.incremental:
+        print(f"{unchanged_count:,} unchanged images skipped, use --rematch to match them against new people")
+    if len(searched_sizes) > 1 or args.detection == "adaptive":
+        print("Faces looked for at " + ", ".join(f"{size}px in {count:,} images" if size else
+                                                 f"none in {count:,} images skipped by the face gate"
+                                                 for size, count in sorted(searched_sizes.items())))
+    if args.near_duplicates is not None:
+        print(f"Reused faces from near duplicates for {reused_images:,} of {new_images:,} new images "
+              f"({reused_images / max(new_images, 1):.0%})")
+    write_keywords(db, args)
     print("Opening dashboard...")
     dashboard.show_dashboard(db)
 
@@ -178,17 +434,295 @@ def main():
     """
 
 
+def rematch_stored_encodings(db: Database, tolerance: float, chunk_size: int = 1000, top_k: int = 3) -> None:
+    """
+    Matches faces that are already in the database but weren't matched to anybody against the encodings people have
+    gained since the last rematch, without decoding any images. Anything older was already compared when the face
+    was first matched (or on an earlier rematch), so only the new encodings can produce new matches.
+    :param db: Database to rematch
+    :param tolerance: Maximum distance for a face to match at
+    :param chunk_size: Number of images' encodings loaded at once
+    :param top_k: Number of closest people to record for each face
+    """
+    watermark = db.get_setting(rematch_watermark_setting, 0)
+    new_watermark = db.get_max_id("PersonEncoding")
+    changed_people = db.get_people(associated_after=watermark)
+    index = KnownFaceIndex(changed_people)
+    print(f"Rematching stored faces against {len(index):,} new encodings of {len(changed_people):,} people")
+
+    start_time = pc()
+    faces_matched = 0
+    images_matched = 0
+    max_image_id = db.get_max_id("Image") if len(index) > 0 else 0
+    for first_id in range(1, max_image_id + 1, chunk_size):
+        unmatched = db.get_unmatched_encodings(first_id, first_id + chunk_size - 1)
+        for image_id, encodings in unmatched.items():
+            found_people = match_and_record(db, index, encodings, tolerance, top_k)
+            if len(found_people) > 0:  # Each person can only be in a picture once, including earlier matches
+                already_found = db.get_person_ids_by_image_id(image_id)
+                found_people = {p: enc for p, enc in found_people.items() if p.dbid not in already_found}
+            if len(found_people) == 0:
+                db.end_image()
+                continue
+
+            for person, enc in found_people.items():
+                db.get_or_associate_encoding(enc.dbid, associate_id=person.dbid, person=True)
+            db.queue_keywords(image_id, [person.name for person in found_people])
+            db.end_image()
+
+            faces_matched += len(found_people)
+            images_matched += 1
+        print(f"{min(first_id + chunk_size - 1, max_image_id) / max_image_id * 100:3.1f}%\t"
+              f"{faces_matched:,} faces matched in {images_matched:,} images")
+
+    db.set_setting(rematch_watermark_setting, new_watermark)
+    db.flush()
+    print(f"Done rematching. ({pc() - start_time:.1f}s total)")
+
+
+def reencode_stored_faces(db: Database, jitter: int = 1, top_k: int = 3) -> None:
+    """
+    Encodes every stored face again from the region it was found in, from a sharp crop like two-stage detection's,
+    without looking for faces again. Encodings keep their ids, so whoever they were matched to stays matched, and
+    their landmarks are replaced with the ones they were encoded from this time. Distances to the closest people
+    are recorded again from the new encodings for faces that had them, and the approximate index is discarded to
+    be trained again from the new encodings.
+    :param db: Database to re-encode
+    :param jitter: How many times to transform each face. Higher number is slower but more accurate.
+    :param top_k: Number of closest people to record for each face
+    """
+    without_regions = db.count_faces_without_regions()
+    if without_regions:
+        print(f"Skipping {without_regions:,} faces stored before LITS kept where faces were found")
+
+    start_time = pc()
+    faces_encoded = 0
+    missing = 0
+    recorded: Dict[int, Set[int]] = {}  # Faces whose recorded distances went with their old encodings, by image
+    max_image_id = db.get_max_id("Image")
+    for image_id in range(1, max_image_id + 1):
+        regions = db.get_face_regions(image_id)
+        if not regions:
+            continue
+        filepath = db.get_image_path(image_id)
+        if not path.exists(filepath):
+            logging.warning(f"Can't re-encode the faces in {filepath}, it no longer exists")
+            missing += 1
+            continue
+
+        encoding_ids = list(regions)
+        encodings, landmarks = encode_crops(filepath, [regions[eid].box for eid in encoding_ids], jitter)
+        with_matches = db.get_encoding_ids_with_face_matches(encoding_ids)
+        if with_matches:
+            recorded[image_id] = with_matches
+        db.replace_encodings(encoding_ids, encodings)  # Deletes their recorded distances too
+        db.add_face_regions(encoding_ids, [FaceRegion(regions[eid].box, points, regions[eid].detector,
+                                                      regions[eid].source_scale)
+                                           for eid, points in zip(encoding_ids, landmarks)])
+        db.end_image()
+        faces_encoded += len(encodings)
+        print(f"{image_id / max_image_id * 100:3.1f}%\t{faces_encoded:,} faces re-encoded")
+    db.flush()
+    AnnIndex.discard(db.db_file_path)
+
+    # Only once every face is re-encoded, since known people's faces are re-encoded too
+    index = KnownFaceIndex(db.get_all_people())
+    if recorded and len(index) > 0:
+        print(f"Recording closest people again for {sum(len(ids) for ids in recorded.values()):,} faces")
+        for image_id, encoding_ids in recorded.items():
+            record_face_matches(db, index, [face for face in db.get_encodings_by_image_id(image_id)
+                                            if face.dbid in encoding_ids], top_k)
+            db.end_image()
+        db.flush()
+    missing_note = f", {missing:,} images no longer exist" if missing else ""
+    print(f"Done re-encoding {faces_encoded:,} faces{missing_note}. ({pc() - start_time:.1f}s total)")
+
+
+def index_metadata(db: Database, scanroot: str, exclude_dirs: List[str] = ()) -> None:
+    """
+    Fills in exposure data for every picture under scanroot in one streaming pass, reading only each file's EXIF
+    header. Pictures added this way are scanned for faces by the next normal scan.
+    :param db: Database to add pictures to
+    :param scanroot: Root of the pictures to index
+    :param exclude_dirs: Folders whose contents should be skipped
+    """
+    print(f"Indexing metadata under {scanroot}")
+    already_indexed = db.get_image_ids_by_stat(scanned_only=False)
+    start_time = pc()
+    found, indexed = 0, 0
+    for image in find_compatible_files(scanroot, exclude_dirs):
+        found += 1
+        if image.stat_key() not in already_indexed:
+            try:
+                exif = read_exif_header(image.filepath)
+            except (OSError, ValueError) as e:
+                logging.warning(f"Couldn't read the header of '{image.filepath}': {e}")
+                continue
+            db.add_indexed_image(image.filepath, ImageFile.parse_salient_exif(exif, image.filepath))
+            db.end_image()
+            indexed += 1
+        if found % 1000 == 0:
+            print(f"{found:,} pictures found, {indexed:,} indexed ({found / (pc() - start_time):,.0f}/s)")
+
+    db.flush()
+    print(f"Done indexing {indexed:,} of {found:,} pictures. ({pc() - start_time:.1f}s total)")
+
+
+def cluster_unmatched(db: Database, threshold: float, min_size: int = 2, show: int = 20) -> None:
+    """
+    Groups the faces that aren't associated with anybody into clusters of likely identities, replacing any
+    clusters from before, and lists the biggest.
+    :param db: Database to cluster
+    :param threshold: Largest distance between two faces of the same person
+    :param min_size: Smallest number of faces worth recording as a cluster
+    :param show: Number of clusters to list
+    """
+    start_time = pc()
+    encoding_ids, matrix = db.get_encoding_matrix(unmatched_only=True)
+    print(f"Clustering {len(encoding_ids):,} unmatched faces at threshold {threshold}")
+    clusters = cluster_encodings(matrix, threshold)
+    in_cluster = numpy.flatnonzero(numpy.bincount(clusters, minlength=len(clusters))[clusters] >= min_size)
+    db.replace_face_clusters(encoding_ids[in_cluster].tolist(), encoding_ids[clusters[in_cluster]].tolist())
+    db.flush()
+
+    biggest = db.get_face_clusters(show)
+    print(f"{len(numpy.unique(clusters[in_cluster])):,} clusters of {min_size} or more faces, covering "
+          f"{len(in_cluster):,} faces. ({pc() - start_time:.1f}s total)")
+    for cluster_id, faces, example in biggest:
+        print(f"Cluster {cluster_id}:\t{faces:,} faces, including in '{example}'")
+    if biggest:
+        print("Name one with --name-cluster ID NAME")
+
+
+def name_cluster(db: Database, cluster_id: int, name: str) -> None:
+    """
+    Associates the faces in a cluster with a person, creating them if needed, and queues the person's name as a
+    keyword for the cluster's pictures. A picture that already has the person, or has more than one of the
+    cluster's faces, only gets one of them associated.
+    """
+    faces_by_image = db.get_face_cluster(cluster_id)
+    if not faces_by_image:
+        print(f"No cluster {cluster_id}, run --cluster to see the current clusters")
+        return
+    person = db.get_person_by_name(name)
+    person_id = person.dbid if person else db.add_person(name)
+    for image_id, encoding_ids in faces_by_image.items():
+        if person_id not in db.get_person_ids_by_image_id(image_id):
+            db.get_or_associate_encoding(encoding_ids[0], associate_id=person_id, person=True)
+            db.queue_keywords(image_id, [name])
+        db.end_image()
+    db.delete_face_cluster(cluster_id)
+    db.flush()
+    print(f"Cluster {cluster_id} is now {name}, in {len(faces_by_image):,} pictures")
+
+
+def write_keywords(db: Database, args: argparse.Namespace) -> None:
+    """
+    Writes keyword changes journalled by this run, or left over from an earlier one, to the image files.
+    """
+    if args.no_write:
+        print(f"{db.count_pending_keywords():,} keyword changes left in the journal, run with --write-pending to "
+              f"write them")
+        return
+    written, failed = write_pending_keywords(db, args.write_threads, args.write_rate, args.rematch_chunk)
+    if written + failed > 0:
+        print(f"Wrote keywords to {written:,} files" + (f", {failed:,} failed (see {log_path})" if failed else ""))
+
+
+def match_and_record(db: Database, index: KnownFaceIndex, encodings: List[FaceEncoding], tolerance: float,
+                     top_k: int = 3) -> Dict[Person, FaceEncoding]:
+    """
+    Matches the faces in one picture, and records each face's closest people in the database whether they matched
+    or not, so the picture can be re-tagged at a different tolerance later without comparing faces again.
+    :return: People objects that are the best matches for the faces
+    """
+    if len(index) == 0:
+        return {}
+    distances = index.person_distances(numpy.array([face.encoding for face in encodings]), tolerance, top_k)
+    record_face_matches(db, index, encodings, top_k, distances)
+    return index.match(encodings, tolerance, distances)
+
+
+def record_face_matches(db: Database, index: KnownFaceIndex, encodings: List[FaceEncoding], top_k: int = 3,
+                        distances: Optional[ndarray] = None) -> None:
+    """
+    Records the top_k closest people to each face in the database.
+    :param distances: Result of index.person_distances for these faces for at least top_k people, if it's already
+        been computed
+    """
+    if len(encodings) == 0:
+        return
+    if distances is None:
+        distances = index.person_distances(numpy.array([face.encoding for face in encodings]), k=top_k)
+    closest = index.closest_people(encodings, top_k, distances)
+    db.add_face_matches([(face.dbid, person.dbid, distance)
+                         for face, face_closest in zip(encodings, closest) for person, distance in face_closest])
+
+
+def retag_from_face_matches(db: Database, tolerance: float, chunk_size: int = 1000) -> None:
+    """
+    Re-applies matches at a new tolerance using the distances recorded when faces were matched, without comparing
+    any faces. People who now match are added to pictures, and people who no longer match are removed. Faces are
+    assigned to people with assign_in_order, as matching does, so re-tagging at the tolerance faces were matched at
+    changes nothing. Faces matched before distances were recorded aren't affected.
+    :param db: Database to re-tag
+    :param tolerance: Maximum distance for a face to match at
+    :param chunk_size: Number of images loaded at once
+    """
+    print(f"Re-tagging at tolerance {tolerance}")
+    names = db.get_person_names()
+    start_time = pc()
+    images_changed = 0
+    max_image_id = db.get_max_id("Image")
+    for first_id in range(1, max_image_id + 1, chunk_size):
+        last_id = first_id + chunk_size - 1
+        candidates = db.get_face_matches(first_id, last_id, tolerance)
+        current = db.get_matched_associations(first_id, last_id)
+        for image_id in sorted(set(candidates) | set(current)):
+            wanted = assign_in_order(candidates.get(image_id, []))
+            have = current.get(image_id, set())
+            if wanted == have:
+                continue
+
+            people_before = db.get_person_ids_by_image_id(image_id)
+            for encoding_id, person_id in have - wanted:
+                db.remove_person_encoding(encoding_id, person_id)
+            for encoding_id, person_id in wanted - have:
+                db.get_or_associate_encoding(encoding_id, associate_id=person_id, person=True)
+            # Only people who came or went are journalled. Someone also in the picture another way stays.
+            people_after = db.get_person_ids_by_image_id(image_id)
+            db.queue_keywords(image_id, [names[person_id] for person_id in sorted(people_after - people_before)],
+                              [names[person_id] for person_id in sorted(people_before - people_after)])
+            db.end_image()
+            images_changed += 1
+        print(f"{min(last_id, max_image_id) / max_image_id * 100:3.1f}%\t{images_changed:,} images re-tagged")
+
+    db.flush()
+    print(f"Done re-tagging. ({pc() - start_time:.1f}s total)")
+
+
 def ensure_image_in_database(db: Database, image: ImageFile) -> int:
-    image_id = db.get_image_id_by_attributes(image)
+    image_id = find_image_in_database(db, image)
+    if not image_id:  # Encode and save
+        image_id = add_image_to_database(db, image, *load_and_encode(image))
+    return image_id
+
+
+def find_image_in_database(db: Database, image: ImageFile) -> Optional[int]:
+    image_id = db.get_image_id_by_attributes(image, scanned_only=True)
     if image_id:
         encodings: List[FaceEncoding] = db.get_encodings_by_image_id(image_id)
         logging.debug(
             f"File {image.filepath} already in database (image_id: {image_id}) with {len(encodings)} faces(s).")
-    else:  # Encode and save
-        new_encodings: List[ndarray] = encode_faces(image.filepath)
-        image_id = db.add_image(image, new_encodings)
-        logging.debug(
-            f"File {image.filepath} added to database (image_id: {image_id}) with {len(new_encodings)} face(s).")
+        image.dbid = image_id
+    return image_id
+
+
+def add_image_to_database(db: Database, image: ImageFile, new_encodings: List[ndarray],
+                          regions: Optional[List[FaceRegion]] = None, searched_size: Optional[int] = None) -> int:
+    image_id = db.add_image(image, new_encodings, regions, searched_size)
+    logging.debug(
+        f"File {image.filepath} added to database (image_id: {image_id}) with {len(new_encodings)} face(s).")
     image.dbid = image_id
     return image_id
 
@@ -200,13 +734,27 @@ def validate_path_exists(check_path: str, name: str):
         soft_exit(f"'{name}' path doesn't exist or is inaccessible. Evaluated to:\n\t{path.abspath(check_path)}")
 
 
-def get_all_compatible_files(folderpath: str) -> List[ImageFile]:
-    all_matching: List[str] = []
-    extensions = ["*" + ext for ext in valid_extensions]
-    for extension in extensions:
-        all_matching.extend(glob(folderpath + "/**/" + extension, recursive=True))
-    wrapped = [ImageFile(file) for file in all_matching]
-    return wrapped
+def find_compatible_files(folderpath: str, exclude_dirs: List[str] = ()) -> Iterator[ImageFile]:
+    """
+    Walks a folder tree and yields every file with a valid extension as it's found, so memory use doesn't grow
+    with the size of the tree. Like glob, hidden files and folders are skipped.
+    :param folderpath: Root of the tree to search
+    :param exclude_dirs: Folders whose contents should be skipped
+    :return: Generator of ImageFiles. Their metadata isn't read until it's used.
+    """
+    excluded = {path.normcase(path.abspath(folder)) for folder in exclude_dirs}
+    extensions = tuple(ext.lower() for ext in valid_extensions)
+    folders = [folderpath]
+    while folders:
+        with scandir(folders.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    if path.normcase(path.abspath(entry.path)) not in excluded:
+                        folders.append(entry.path)
+                elif entry.name.lower().endswith(extensions):
+                    yield ImageFile(entry.path)
 
 
 def just_filename(in_path: str):
@@ -222,5 +770,8 @@ def soft_exit(message: str = ""):
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        Database.close_all()  # Commits whatever finished, even if the run was interrupted
     soft_exit()
@@ -0,0 +1,77 @@
+"""
+Compares standard, two-stage and adaptive detection: time per picture, faces found, and which size adaptive detection
+settled on for each picture.
+Run from the repository root: `py test-scripts/bench-adaptive.py [--images <folder>] [--grids 2 3 4]`
+
+Besides the pictures in --images, people.jpg is tiled into an n x n grid for each of --grids and saved as one
+picture, so a grid of 3 is a 36 face group photo whose faces are a third as big. "Same" is how many of the standard
+mode's faces each mode found too, by encoding within 0.3. Use a folder with pictures of nobody as well as people,
+since how much adaptive detection saves depends on the mix.
+"""
+import argparse
+import os
+import tempfile
+from collections import Counter
+from time import perf_counter as pc
+
+import numpy
+from PIL import Image as pilmage
+
+from Controllers.FaceRecognizer import find_and_encode, DETECT_SIZE
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--images", help="Folder of pictures to compare on", default="unittest-images")
+parser.add_argument("--grids", help="Sizes of people.jpg grids to add", default=[2, 3, 4], type=int, nargs="+")
+parser.add_argument("--group", help="Picture to tile into grids", default="unittest-images/people.jpg")
+args = parser.parse_args()
+
+work_dir = tempfile.mkdtemp()
+pictures = [os.path.join(args.images, name) for name in sorted(os.listdir(args.images))
+            if name.lower().endswith(".jpg")]
+group = pilmage.open(args.group)
+for grid in args.grids:
+    if grid < 2:
+        continue
+    tiled = pilmage.new("RGB", group.size)
+    tile_size = (group.size[0] // grid, group.size[1] // grid)
+    tile = group.resize(tile_size)
+    for x in range(grid):
+        for y in range(grid):
+            tiled.paste(tile, (x * tile_size[0], y * tile_size[1]))
+    pictures.append(os.path.join(work_dir, f"people grid {grid}.jpg"))
+    tiled.save(pictures[-1], quality=92)
+
+modes = [("standard", None), (f"two-stage {DETECT_SIZE}", DETECT_SIZE), ("adaptive", None)]
+print(f"{'':<24}" + "".join(f"{name:>23}" for name, size in modes))
+totals = numpy.zeros(len(modes))
+found = numpy.zeros(len(modes), dtype=int)
+same_total = numpy.zeros(len(modes), dtype=int)
+levels = Counter()
+for filepath in pictures:
+    line = f"{os.path.basename(filepath):<24}"
+    standard = None
+    for m, (name, size) in enumerate(modes):
+        start = pc()
+        encodings, regions, searched_size = find_and_encode(filepath, detection=name.split()[0], detect_size=size)
+        elapsed = pc() - start
+        if standard is None:
+            standard = encodings
+        same = sum(len(encodings) > 0 and numpy.linalg.norm(numpy.array(encodings) - encoding, axis=1).min() < 0.3
+                   for encoding in standard)
+        totals[m] += elapsed
+        found[m] += len(encodings)
+        same_total[m] += same
+        line += f"{elapsed:9.2f}s {len(encodings):>3} same {same:>3}"
+        if name == "adaptive":
+            levels[searched_size] += 1
+            line += f" @{searched_size}"
+    print(line)
+print(f"{'Average':<24}" + "".join(f"{total / len(pictures):9.2f}s {count:>3} same {same:>3}"
+                                    for total, count, same in zip(totals, found, same_total)))
+print("Adaptive looked for faces at " + ", ".join(f"{size}px in {count} pictures"
+                                                  for size, count in sorted(levels.items())))
+
+for filepath in pictures:
+    if filepath.startswith(work_dir):
+        os.remove(filepath)
+os.rmdir(work_dir)
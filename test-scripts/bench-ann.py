@@ -0,0 +1,69 @@
+"""
+Recall and latency of AnnIndex at different n_probe, against exact matching with KnownFaceIndex.
+Run from the repository root: `py test-scripts/bench-ann.py [--people 20000] [--per-person 5]`
+
+Known people are random points spread like face encodings are (different people about 0.9 apart, photos of the
+same person about 0.4 apart). Half the faces searched for are new photos of known people and half are strangers.
+Random points have no structure for k-means to find, so this is a pessimistic case for the index.
+"Closest known person" is how often the closest person found is the right one, for photos of known people.
+"Matches found" is how many of the exact matches at --tolerance were also found.
+"""
+import argparse
+from time import perf_counter as pc
+
+import numpy
+
+from Controllers.AnnIndex import AnnIndex
+from Controllers.FaceRecognizer import KnownFaceIndex
+from Model.FaceEncoding import FaceEncoding
+from Model.Person import Person
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--people", help="Number of known people", default=20000, type=int)
+parser.add_argument("--per-person", help="Encodings per known person", default=5, type=int)
+parser.add_argument("--faces", help="Number of faces to search for", default=1000, type=int)
+parser.add_argument("--per-picture", help="Faces searched for together, as if in one picture", default=3, type=int)
+parser.add_argument("--tolerance", default=0.6, type=float)
+parser.add_argument("--probes", help="n_probe values to try", default=[1, 2, 4, 8, 16, 32, 64], type=int, nargs="+")
+args = parser.parse_args()
+
+rng = numpy.random.default_rng(0)
+between, within = 0.9 / numpy.sqrt(2 * 128), 0.4 / numpy.sqrt(2 * 128)  # Standard deviations per value
+centers = rng.normal(0, between, (args.people, 128))
+known = centers[:, None, :] + rng.normal(0, within, (args.people, args.per_person, 128))
+people = [Person(p, f"Person {p}", [FaceEncoding(p * args.per_person + i, enc) for i, enc in enumerate(known[p])])
+          for p in range(args.people)]
+sources = numpy.concatenate([centers[rng.integers(0, args.people, args.faces // 2)],
+                             rng.normal(0, between, (args.faces - args.faces // 2, 128))])
+faces = [FaceEncoding(-1, enc) for enc in sources + rng.normal(0, within, sources.shape)]
+
+
+def search(index: KnownFaceIndex):
+    """ Matches the faces a picture at a time. :return: Seconds per face, and the closest person and match of each """
+    closest, matched = [], []
+    start = pc()
+    for first in range(0, len(faces), args.per_picture):
+        picture = faces[first:first + args.per_picture]
+        distances = index.person_distances(numpy.array([face.encoding for face in picture]), args.tolerance, 1)
+        closest += [face_closest[0][0].dbid if face_closest else None
+                    for face_closest in index.closest_people(picture, 1, distances)]
+        found = {face: person.dbid for person, face in index.match(picture, args.tolerance, distances).items()}
+        matched += [found.get(face) for face in picture]
+    return (pc() - start) / len(faces), closest, matched
+
+
+exact_time, exact_closest, exact_matched = search(KnownFaceIndex(people))
+print(f"{args.people:,} people, {args.people * args.per_person:,} encodings, {args.faces:,} faces "
+      f"({sum(m is not None for m in exact_matched):,} match exactly)")
+print(f"{'exact':>10} {exact_time * 1000:8.2f} ms/face")
+
+start = pc()
+ann = AnnIndex(people)
+print(f"Trained {len(ann.centroids):,} lists in {pc() - start:.1f}s")
+for n_probe in args.probes:
+    ann.n_probe = n_probe
+    ann_time, ann_closest, ann_matched = search(ann)
+    recall = numpy.mean([a == e for a, e in zip(ann_closest[:args.faces // 2], exact_closest)])
+    match_recall = numpy.mean([a == e for a, e in zip(ann_matched, exact_matched) if e is not None])
+    print(f"n_probe {n_probe:>2} {ann_time * 1000:8.2f} ms/face   closest known person {recall:6.1%}   "
+          f"matches found {match_recall:6.1%}   {n_probe / len(ann.centroids):5.1%} of lists searched")
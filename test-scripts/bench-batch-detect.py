@@ -0,0 +1,66 @@
+"""
+Time per picture of finding and encoding faces with FaceRecognizer.FindFaces at different batch sizes, on the CPU.
+Run from the repository root: `py test-scripts/bench-batch-detect.py [--models hog cnn] [--batch-sizes 1 4 16 32]`
+
+The pictures in --images are decoded at --size, padded to one size and repeated until there are --frames of them.
+For each model, the frames are run through FindFaces a batch at a time at each of --batch-sizes, so every batch size
+does the same work and any difference is what batching saves. "Pipeline" runs the same pictures through
+Pipeline.encode_images with --detect-batch set to each batch size (1 being the normal one at a time path), including
+decoding, metadata and --workers processes, to show what batching saves around detection.
+"""
+import argparse
+import os
+import tempfile
+from time import perf_counter as pc
+
+import numpy
+
+from Controllers.FaceRecognizer import FindFaces, load_resized, stack_frames, GOAL_SIZE
+from Controllers.Pipeline import encode_images
+from Model.ImageFile import ImageFile
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--images", help="Folder of pictures to detect faces in", default="unittest-images")
+parser.add_argument("--models", help="Detectors to compare", default=["hog"], nargs="+")
+parser.add_argument("--batch-sizes", default=[1, 4, 16, 32], type=int, nargs="+")
+parser.add_argument("--frames", help="Pictures detected per batch size", default=32, type=int)
+parser.add_argument("--size", help="Longest side pictures are decoded at", default=GOAL_SIZE, type=int)
+parser.add_argument("--workers", help="Workers for the pipeline run", default=1, type=int)
+parser.add_argument("--no-pipeline", help="Skip the pipeline run", action="store_true")
+args = parser.parse_args()
+
+pictures = [os.path.join(args.images, name) for name in sorted(os.listdir(args.images))
+            if name.lower().endswith(".jpg")]
+decoded = [numpy.array(load_resized(filepath, args.size)) for filepath in pictures]
+frames = stack_frames([decoded[i % len(decoded)] for i in range(args.frames)])
+print(f"{args.frames} frames of {frames.shape[2]}x{frames.shape[1]} from {len(pictures)} pictures")
+
+for model in args.models:
+    for batch_size in args.batch_sizes:
+        start = pc()
+        faces = 0
+        for first in range(0, len(frames), batch_size):
+            faces += sum(len(encodings) for encodings, regions in FindFaces(frames[first:first + batch_size],
+                                                                             model=model))
+        elapsed = pc() - start
+        print(f"FindFaces {model:<4} batch {batch_size:>3}: {elapsed / len(frames):6.3f}s/frame, {faces} faces")
+
+if not args.no_pipeline:
+    # Copies, so every picture is a new file to the pipeline and there are as many as there are frames
+    work_dir = tempfile.mkdtemp()
+    copies = []
+    for i in range(args.frames):
+        copies.append(os.path.join(work_dir, f"{i} {os.path.basename(pictures[i % len(pictures)])}"))
+        with open(pictures[i % len(pictures)], "rb") as source, open(copies[-1], "wb") as copy:
+            copy.write(source.read())
+    for batch_size in args.batch_sizes:
+        start = pc()
+        faces = sum(len(encodings) for image, encodings, regions, searched_size, seconds in
+                    encode_images((ImageFile(copy) for copy in copies), lambda image: True, workers=args.workers,
+                                  detect_batch=batch_size))
+        elapsed = pc() - start
+        print(f"Pipeline  hog  batch {batch_size:>3}: {elapsed / len(copies):6.3f}s/picture, {faces} faces, "
+              f"{args.workers} worker(s)")
+    for copy in copies:
+        os.remove(copy)
+    os.rmdir(work_dir)
@@ -0,0 +1,66 @@
+"""
+Runtime, peak memory and quality of clustering unmatched faces, on synthetic encodings.
+Run from the repository root: `py test-scripts/bench-cluster.py [--encodings 1000000]`
+
+Faces are random points spread like face encodings are (different people about 0.9 apart, photos of the same person
+about 0.4 apart). --identities people have --per-identity photos each, and the rest of the faces are strangers seen
+once. "Pure" is how many clusters hold only one person; "complete" is how many people ended up in a single cluster.
+"Working memory" is the most clustering had allocated at once on top of the encodings, measured with tracemalloc;
+"process peak" is the whole process's, including generating the encodings.
+"""
+import argparse
+import resource
+import tracemalloc
+from time import perf_counter as pc
+
+import numpy
+
+from Controllers.Clusterer import cluster_encodings
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--encodings", help="Number of faces to cluster", default=1000000, type=int)
+parser.add_argument("--identities", help="Number of people with several photos", default=50000, type=int)
+parser.add_argument("--per-identity", help="Photos of each of those people", default=10, type=int)
+parser.add_argument("--threshold", default=0.5, type=float)
+parser.add_argument("--probes", help="n_probe, lists each list is compared with", default=8, type=int)
+args = parser.parse_args()
+
+
+def peak_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+
+
+rng = numpy.random.default_rng(0)
+between, within = 0.9 / numpy.sqrt(2 * 128), 0.4 / numpy.sqrt(2 * 128)  # Standard deviations per value
+repeated = args.identities * args.per_identity
+identity = rng.permutation(numpy.concatenate([numpy.repeat(numpy.arange(args.identities), args.per_identity),
+                                              numpy.arange(args.identities, args.identities + args.encodings - repeated)]))
+centers = numpy.empty((identity.max() + 1, 128), dtype="float32")
+matrix = numpy.empty((args.encodings, 128), dtype="float32")  # What get_encoding_matrix gives for a float32 store
+chunk = 100000  # Generated a chunk at a time, so float64 temporaries stay small
+for start in range(0, len(centers), chunk):
+    centers[start:start + chunk] = rng.normal(0, between, (len(centers[start:start + chunk]), 128))
+for start in range(0, args.encodings, chunk):
+    rows = identity[start:start + chunk]
+    matrix[start:start + len(rows)] = centers[rows] + rng.normal(0, within, (len(rows), 128))
+del centers
+print(f"{args.encodings:,} encodings, {args.identities:,} people with {args.per_identity} photos each, "
+      f"{args.encodings - repeated:,} strangers. {matrix.nbytes / 2**20:.0f}MB of encodings")
+
+tracemalloc.start()
+start = pc()
+clusters = cluster_encodings(matrix, args.threshold, n_probe=args.probes)
+elapsed = pc() - start
+working = tracemalloc.get_traced_memory()[1]
+tracemalloc.stop()
+
+sizes = numpy.bincount(clusters, minlength=len(clusters))
+multi = sizes[clusters] >= 2
+cluster_ids, first = numpy.unique(clusters, return_index=True)
+people_per_cluster = numpy.array([len(numpy.unique(identity[clusters == c])) for c in cluster_ids[:2000]])
+clusters_per_person = numpy.array([len(numpy.unique(clusters[identity == i]))
+                                   for i in rng.choice(args.identities, min(2000, args.identities), replace=False)])
+print(f"{elapsed:.1f}s, working memory {working / 2**20:.0f}MB, process peak {peak_mb():.0f}MB")
+print(f"{len(cluster_ids):,} clusters, {len(numpy.unique(clusters[multi])):,} of them with 2 or more faces. "
+      f"Pure {numpy.mean(people_per_cluster == 1):.1%}, complete {numpy.mean(clusters_per_person == 1):.1%}, "
+      f"strangers left alone {numpy.mean(~multi[identity >= args.identities]):.1%} (from samples of 2,000)")
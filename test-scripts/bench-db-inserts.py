@@ -0,0 +1,68 @@
+"""
+Measures how fast images and their encodings can be added to the database, committing every statement versus
+committing in batches.
+Run from the repository root: `py test-scripts/bench-db-inserts.py [--images 2000] [--faces 3] [--batch-size 100]`
+"""
+import argparse
+import os
+import shutil
+import tempfile
+from time import perf_counter as pc
+
+import numpy
+from PIL import Image as pilmage
+
+from Controllers.Database import Database
+from Model.ImageFile import ImageFile
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--images", help="Number of images to insert", default=2000, type=int)
+parser.add_argument("--faces", help="Encodings per image", default=3, type=int)
+parser.add_argument("--batch-size", help="Images per commit in batched mode", default=100, type=int)
+parser.add_argument("--dir", help="Where to put the test images and databases. Defaults to a temp folder",
+                    default=None)
+args = parser.parse_args()
+
+work_dir = args.dir or tempfile.mkdtemp()
+image_dir = os.path.join(work_dir, "images")
+os.makedirs(image_dir, exist_ok=True)
+
+# Tiny, distinct JPEGs, with metadata read up front so only database time is measured
+print(f"Creating {args.images:,} images in {image_dir}...")
+images = []
+for i in range(args.images):
+    image_path = os.path.join(image_dir, f"{i:07}.jpg")
+    pilmage.new("RGB", (8 + i % 64, 8)).save(image_path)
+    image = ImageFile(image_path)
+    image.init_metadata()
+    images.append(image)
+rng = numpy.random.default_rng(0)
+encodings = [[rng.normal(0, 0.1, 128) for f in range(args.faces)] for i in range(args.images)]
+
+
+def run(batch_size: int) -> float:
+    db_path = os.path.join(work_dir, f"bench-{batch_size}.db")
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    db = Database(db_path, batch_size=batch_size)
+    person_id = db.add_person("Benchmark")
+
+    start = pc()
+    for image, image_encodings in zip(images, encodings):
+        db.add_image(image, image_encodings)
+        # One matched face per image, like the scan loop
+        first_encoding = db.get_encodings_by_image_id(image.dbid)[0]
+        db.get_or_associate_encoding(first_encoding.dbid, associate_id=person_id, person=True)
+        db.end_image()
+    db.close()
+    return pc() - start
+
+
+rows_per_image = 1 + args.faces * 2 + 1  # Image, Encoding + ImageEncoding per face, PersonEncoding
+for batch_size in (1, args.batch_size):
+    elapsed = run(batch_size)
+    print(f"batch size {batch_size:>5}: {elapsed:6.2f}s, {args.images / elapsed:8,.0f} images/s, "
+          f"{args.images * rows_per_image / elapsed:9,.0f} rows/s")
+
+if not args.dir:
+    shutil.rmtree(work_dir)
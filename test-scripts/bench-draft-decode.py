@@ -0,0 +1,63 @@
+"""
+Compares full decoding against reduced-resolution (draft) JPEG decoding in encode_faces.
+Run from the repository root: `py test-scripts/bench-draft-decode.py [--upscale 3]`
+
+The unit test images are small, so by default each one is also saved upscaled to roughly camera resolution,
+which is where draft decoding matters.
+"""
+import argparse
+import os
+import tempfile
+from time import perf_counter as pc
+
+import face_recognition as fr
+from PIL import Image as pilmage
+
+from Controllers.FaceRecognizer import encode_faces, load_resized, GOAL_SIZE
+
+test_data_path = "unittest-images"
+known_name = "known.jpg"
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--upscale", help="Also test each image upscaled by this factor", default=3, type=int)
+parser.add_argument("--repeats", help="Times to decode each image", default=5, type=int)
+args = parser.parse_args()
+
+# Build the set of images: originals plus camera-sized copies
+temp_dir = tempfile.mkdtemp()
+images = []
+for name in sorted(os.listdir(test_data_path)):
+    original = os.path.join(test_data_path, name)
+    images.append(original)
+    if args.upscale > 1:
+        big = pilmage.open(original)
+        big = big.resize((big.size[0] * args.upscale, big.size[1] * args.upscale))
+        big_path = os.path.join(temp_dir, f"x{args.upscale} {name}")
+        big.save(big_path, quality=92)
+        images.append(big_path)
+
+known_full = encode_faces(os.path.join(test_data_path, known_name), draft=False)[0]
+known_draft = encode_faces(os.path.join(test_data_path, known_name), draft=True)[0]
+
+print(f"{'Image':<30}{'Pixels':>12}{'Full ms':>10}{'Draft ms':>10}{'Speedup':>9}"
+      f"{'Faces':>8}{'Distance to known (full/draft)':>34}")
+for image_path in images:
+    with pilmage.open(image_path) as im:
+        pixels = im.size[0] * im.size[1]
+
+    decode_times = {}
+    for draft in (False, True):
+        start = pc()
+        for i in range(args.repeats):
+            load_resized(image_path, GOAL_SIZE, draft)
+        decode_times[draft] = (pc() - start) / args.repeats * 1000
+
+    faces_full = encode_faces(image_path, draft=False)
+    faces_draft = encode_faces(image_path, draft=True)
+    best_full = min(fr.face_distance(faces_full, known_full)) if faces_full else None
+    best_draft = min(fr.face_distance(faces_draft, known_draft)) if faces_draft else None
+    distances = f"{best_full or 0:.3f} / {best_draft or 0:.3f}" if faces_full or faces_draft else "-"
+
+    print(f"{os.path.basename(image_path):<30}{pixels:>12,}{decode_times[False]:>10.1f}{decode_times[True]:>10.1f}"
+          f"{decode_times[False] / decode_times[True]:>8.1f}x"
+          f"{len(faces_full):>4}/{len(faces_draft):<3}{distances:>34}")
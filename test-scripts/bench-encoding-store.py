@@ -0,0 +1,53 @@
+"""
+Compares loading every encoding from BLOBs against loading them from the packed EncodingStore.
+Run from the repository root: `py test-scripts/bench-encoding-store.py [--encodings 200000]`
+"""
+import argparse
+import shutil
+import tempfile
+import os
+from time import perf_counter as pc
+
+import numpy
+
+from Controllers.Database import Database
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--encodings", help="Number of encodings in the database", default=200000, type=int)
+parser.add_argument("--people", help="Number of people the encodings belong to", default=1000, type=int)
+parser.add_argument("--dir", help="Where to put the databases. Defaults to a temp folder", default=None)
+args = parser.parse_args()
+
+work_dir = tempfile.mkdtemp(dir=args.dir)
+rng = numpy.random.default_rng(0)
+per_person = args.encodings // args.people
+
+
+def build(packed: bool) -> Database:
+    db = Database(os.path.join(work_dir, f"{'packed' if packed else 'blobs'}.db"), batch_size=1000,
+                  packed_store=packed)
+    for p in range(args.people):
+        person_id = db.add_person(f"Person {p}")
+        db.add_encodings(list(rng.normal(0, 0.1, (per_person, 128))), person_id, person=True)
+        db.end_image()
+    db.flush()
+    return db
+
+
+for packed in (False, True):
+    db = build(packed)
+    start = pc()
+    ids, matrix = db.get_encoding_matrix()
+    matrix_sum = float(matrix.sum())  # Touch every value, so the memory map is actually read
+    matrix_time = pc() - start
+
+    start = pc()
+    people = db.get_all_people()
+    people_time = pc() - start
+
+    print(f"{'EncodingStore' if packed else 'BLOBs':<14} all encodings as a matrix: {matrix_time * 1000:8.0f}ms   "
+          f"get_all_people: {people_time * 1000:8.0f}ms   ({len(ids):,} encodings, "
+          f"{sum(len(p.encodings) for p in people):,} loaded by person)")
+    db.close()
+
+shutil.rmtree(work_dir)
@@ -0,0 +1,66 @@
+"""
+Throughput and miss rate of the face-presence gate (FaceRecognizer.might_have_faces) at each preset.
+Run from the repository root: `py test-scripts/bench-face-gate.py --images <folder> [--faceless-share 0.6]`
+
+Every .jpg in --images is labelled by whether face_recognition finds a face in it without the gate, so any mix of
+pictures with and without people will do. "Missed" is how many pictures with faces the gate skipped, "let through"
+how many without faces it didn't. Time per picture is for the whole of encode_faces_with_locations. Since the share
+of pictures without people in a sample rarely matches a real library's, the time is also given for a library where
+--faceless-share of the pictures have no faces.
+"""
+import argparse
+import os
+from time import perf_counter as pc
+
+import numpy
+
+from Controllers.FaceRecognizer import encode_faces_with_locations, gate_presets, might_have_faces, load_resized, \
+    GOAL_SIZE, DETECT_SIZE
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--images", help="Folder of pictures, with and without faces", default="unittest-images")
+parser.add_argument("--faceless-share", help="Share of pictures without faces to project times for", default=0.6,
+                    type=float)
+parser.add_argument("--detection", help="Detection mode, as for lits.py", default="standard")
+args = parser.parse_args()
+
+pictures = [os.path.join(args.images, name) for name in sorted(os.listdir(args.images))
+            if name.lower().endswith(".jpg")]
+
+
+def timed(filepath: str, gate=None):
+    start = pc()
+    encodings, locations = encode_faces_with_locations(filepath, detection=args.detection, gate=gate)
+    return pc() - start, len(encodings)
+
+
+baseline = [timed(filepath) for filepath in pictures]
+has_faces = numpy.array([faces > 0 for seconds, faces in baseline])
+print(f"{len(pictures)} pictures, {has_faces.sum()} with faces, {(~has_faces).sum()} without")
+
+
+def summary(name: str, seconds: numpy.ndarray, found: numpy.ndarray, passed: numpy.ndarray) -> str:
+    """
+    :param seconds: Time taken for each picture
+    :param found: Whether faces were found in each picture
+    :param passed: Whether the gate let each picture through
+    """
+    missed = has_faces & ~found
+    projected = args.faceless_share * seconds[~has_faces].mean() + (1 - args.faceless_share) * seconds[has_faces].mean()
+    line = (f"{name:<12} missed {missed.sum():>2}/{has_faces.sum():<3} let through {(passed & ~has_faces).sum():>2}/"
+            f"{(~has_faces).sum():<3} {seconds.mean():5.2f}s/picture   {projected:5.2f}s/picture at "
+            f"{args.faceless_share:.0%} without faces")
+    if missed.any():
+        line += f"   missed {', '.join(os.path.basename(p) for p, m in zip(pictures, missed) if m)}"
+    return line
+
+
+baseline_seconds = numpy.array([seconds for seconds, faces in baseline])
+print(summary("no gate", baseline_seconds, has_faces, numpy.ones(len(pictures), dtype=bool)))
+gate_size = GOAL_SIZE if args.detection == "standard" else DETECT_SIZE
+decoded = [numpy.array(load_resized(filepath, gate_size)) for filepath in pictures]
+for preset in gate_presets:
+    results = [timed(filepath, preset) for filepath in pictures]
+    print(summary(preset, numpy.array([seconds for seconds, faces in results]),
+                  numpy.array([faces > 0 for seconds, faces in results]),
+                  numpy.array([might_have_faces(pixels, preset) for pixels in decoded])))
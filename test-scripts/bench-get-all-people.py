@@ -0,0 +1,45 @@
+"""
+Times loading every known person from the database: one query per person versus a single joined query.
+Run from the repository root: `py test-scripts/bench-get-all-people.py [--people 10000] [--encodings 3]`
+"""
+import argparse
+import os
+import tempfile
+from time import perf_counter as pc
+
+import numpy
+
+from Controllers.Database import Database
+from Model.Person import Person
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--people", help="Number of known people", default=10000, type=int)
+parser.add_argument("--encodings", help="Encodings per person", default=3, type=int)
+args = parser.parse_args()
+
+db_path = os.path.join(tempfile.mkdtemp(), "bench-people.db")
+db = Database(db_path, batch_size=1000)
+rng = numpy.random.default_rng(0)
+print(f"Creating {args.people:,} people with {args.encodings} encodings each...")
+for i in range(args.people):
+    person_id = db.add_person(f"Person {i}")
+    db.add_encodings([rng.normal(0, 0.1, 128) for e in range(args.encodings)], person_id, person=True)
+    db.end_image()
+db.flush()
+
+
+def one_query_per_person():
+    # How get_all_people used to work
+    results = db.connection.execute("SELECT * from Person").fetchall()
+    return [Person(row["id"], row["name"], db.get_encodings_by_person_id(row["id"])) for row in results]
+
+
+for name, load in [("one query per person", one_query_per_person), ("single join", db.get_all_people)]:
+    start = pc()
+    people = load()
+    elapsed = pc() - start
+    total_encodings = sum(len(p.encodings) for p in people)
+    print(f"{name:<22}{elapsed * 1000:8.0f}ms  {len(people):,} people, {total_encodings:,} encodings")
+
+db.close()
+os.remove(db_path)
@@ -0,0 +1,57 @@
+"""
+Compares reading exposure data with pyexiv2 against reading only the EXIF header (Model.ExifHeader), as
+--index-metadata does, and checks that both give the same values.
+Run from the repository root: `py test-scripts/bench-header-index.py [--copies 250] [--dir D:\\slow]`
+"""
+import argparse
+import os
+import shutil
+import tempfile
+from time import perf_counter as pc
+
+from Model.ExifHeader import read_exif_header
+from Model.ImageFile import ImageFile
+
+test_data_path = "unittest-images"
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--copies", help="Copies of each unit test image to index", default=250, type=int)
+parser.add_argument("--dir", help="Where to put the copies. Defaults to a temp folder", default=None)
+args = parser.parse_args()
+
+
+def bytes_read() -> int:
+    """ Bytes this process has read, where the OS reports it (Linux) """
+    try:
+        with open("/proc/self/io") as io:
+            return int(next(line for line in io if line.startswith("rchar")).split()[1])
+    except OSError:
+        return 0
+
+
+work_dir = tempfile.mkdtemp(dir=args.dir)
+paths = []
+for name in sorted(os.listdir(test_data_path)):
+    for i in range(args.copies):
+        paths.append(os.path.join(work_dir, f"{i:05} {name}"))
+        shutil.copyfile(os.path.join(test_data_path, name), paths[-1])
+total_size = sum(os.path.getsize(p) for p in paths)
+print(f"Indexing {len(paths):,} files, {total_size / 2**20:,.0f}MB")
+
+
+def pyexiv2_exif(filepath: str) -> dict:
+    image = ImageFile(filepath)
+    image.init_metadata()
+    return image.exif
+
+
+results = {}
+for name, read in (("pyexiv2", pyexiv2_exif), ("Header only", read_exif_header)):
+    start_bytes, start = bytes_read(), pc()
+    results[name] = [ImageFile.parse_salient_exif(read(p), p) for p in paths]
+    elapsed = pc() - start
+    read_mb = (bytes_read() - start_bytes) / 2**20
+    print(f"{name:<14}{elapsed:7.2f}s {len(paths) / elapsed:9,.0f} files/s {read_mb:9,.1f}MB read")
+
+print("Same values:", results["pyexiv2"] == results["Header only"])
+shutil.rmtree(work_dir)
@@ -0,0 +1,73 @@
+"""
+Compares tagging images the old way (read all metadata, then open the file again to write) against
+ImageFile.append_keywords, which reads and writes the keyword field in one session.
+Run from the repository root: `py test-scripts/bench-keyword-write.py [--images 10000] [--dir D:\\slow]`
+
+To see what it's like on a NAS or slow disk, point --dir at slow storage. On Linux a throttled loop device works:
+    truncate -s 2G /tmp/slow.img && mkfs.ext4 -q /tmp/slow.img
+    sudo losetup /dev/loop9 /tmp/slow.img
+    echo "0 $(sudo blockdev --getsz /dev/loop9) delay /dev/loop9 0 5" | sudo dmsetup create slow  # 5ms per I/O
+    sudo mount -o sync /dev/mapper/slow /mnt/slow
+then `py test-scripts/bench-keyword-write.py --dir /mnt/slow`. Add --cold (Linux, as root) so the files aren't
+already in the page cache when they're tagged, like a library on a NAS.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+from time import perf_counter as pc
+
+import pyexiv2 as pe2
+
+from Model.ImageFile import ImageFile
+
+test_image = os.path.join("unittest-images", "known.jpg")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--images", help="Number of images to tag", default=10000, type=int)
+parser.add_argument("--dir", help="Where to put the test images. Defaults to a temp folder", default=None)
+parser.add_argument("--cold", help="Drop the OS file cache before tagging (Linux, root only)", action="store_true")
+args = parser.parse_args()
+
+
+def legacy_append_keywords(image: ImageFile, to_append) -> int:
+    """ How append_keywords used to work: read IPTC, EXIF and XMP, then open the file a second time to write. """
+    file = pe2.Image(image.filepath)
+    iptc = file.read_iptc(encoding=ImageFile.normal_encoding)
+    file.read_exif(encoding=ImageFile.normal_encoding)
+    file.read_xmp(encoding=ImageFile.normal_encoding)
+    file.close()
+
+    current = ImageFile.split_keywords(iptc.get(ImageFile.keyword_field_name, ""))
+    new_kws = [keyword for keyword in to_append if keyword not in current]
+    if not new_kws:
+        return 0
+
+    loaded = pe2.Image(image.filepath)
+    loaded.modify_iptc({ImageFile.keyword_field_name: current + new_kws}, encoding=ImageFile.normal_encoding)
+    loaded.close()
+    return len(new_kws)
+
+
+def run(name: str, append) -> None:
+    work_dir = tempfile.mkdtemp(dir=args.dir)
+    paths = []
+    for i in range(args.images):
+        paths.append(os.path.join(work_dir, f"{i:07}.jpg"))
+        shutil.copyfile(test_image, paths[-1])
+    if args.cold:
+        os.sync()
+        with open("/proc/sys/vm/drop_caches", "w") as drop_caches:
+            drop_caches.write("3")
+
+    start = pc()
+    for image_path in paths:
+        append(ImageFile(image_path), ["Benchmark Person"])
+    elapsed = pc() - start
+    shutil.rmtree(work_dir)
+    print(f"{name:<22}{elapsed:8.2f}s {args.images / elapsed:8,.0f} images/s {elapsed / args.images * 1000:7.2f} ms/image")
+
+
+print(f"Tagging {args.images:,} copies of {test_image} in {args.dir or tempfile.gettempdir()}")
+run("Read, then reopen", legacy_append_keywords)
+run("Single session", ImageFile.append_keywords)
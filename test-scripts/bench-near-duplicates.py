@@ -0,0 +1,70 @@
+"""
+How well perceptual hashes (NearDuplicates.perceptual_hash) tell near duplicates from different pictures, and what
+reusing faces saves. Run from the repository root: `py test-scripts/bench-near-duplicates.py [--images <folder>]`
+
+For every picture in --images, a re-saved copy (JPEG quality 80) and a burst-like frame (shifted by 1% and 3%
+brighter) are made in memory. For each --distances, "copies" and "bursts" are the share of those whose hash is within
+that many bits of their picture's, and "false" the number of pairs of different pictures of the same size that are.
+The time taken to hash a picture is compared with the time taken to find and encode its faces, which is what a near
+duplicate saves.
+"""
+import argparse
+import itertools
+import os
+from io import BytesIO
+from time import perf_counter as pc
+
+import numpy
+from PIL import Image as pilmage
+
+from Controllers.FaceRecognizer import find_and_encode
+from Controllers.NearDuplicates import perceptual_hash, hamming_distances
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--images", help="Folder of different pictures", default="unittest-images")
+parser.add_argument("--distances", help="Bits hashes can differ in to compare", default=[2, 4, 6, 8], type=int,
+                    nargs="+")
+args = parser.parse_args()
+
+pictures = [os.path.join(args.images, name) for name in sorted(os.listdir(args.images))
+            if name.lower().endswith(".jpg")]
+
+
+def saved(image: pilmage.Image, quality: int) -> BytesIO:
+    file = BytesIO()
+    image.save(file, "JPEG", quality=quality)
+    return file
+
+
+hashes, copies, bursts = [], [], []
+hash_time = encode_time = 0.0
+for filepath in pictures:
+    start = pc()
+    hashes.append(perceptual_hash(filepath))
+    hash_time += pc() - start
+    start = pc()
+    find_and_encode(filepath)
+    encode_time += pc() - start
+
+    image = pilmage.open(filepath).convert("RGB")
+    width, height = image.size
+    shift = max(1, width // 100)
+    frame = image.crop((shift, 0, width, height)).resize(image.size).point(lambda value: min(255, int(value * 1.03)))
+    copies.append(perceptual_hash(saved(image, 80))[0])
+    bursts.append(perceptual_hash(saved(frame, 90))[0])
+
+copy_distances = numpy.array([hamming_distances(phash, numpy.array([copy]))[0]
+                              for (phash, size), copy in zip(hashes, copies)])
+burst_distances = numpy.array([hamming_distances(phash, numpy.array([burst]))[0]
+                               for (phash, size), burst in zip(hashes, bursts)])
+pair_distances = numpy.array([hamming_distances(a, numpy.array([b]))[0]
+                              for (a, a_size), (b, b_size) in itertools.combinations(hashes, 2) if a_size == b_size])
+
+print(f"{len(pictures)} pictures, {len(pair_distances)} pairs of different pictures the same size")
+print(f"Hashing {hash_time / len(pictures) * 1000:.1f}ms/picture, finding and encoding faces "
+      f"{encode_time / len(pictures):.2f}s/picture")
+print(f"Bits different: copies at most {copy_distances.max()}, bursts at most {burst_distances.max()}, "
+      f"different pictures at least {pair_distances.min() if len(pair_distances) else '-'}")
+for distance in args.distances:
+    print(f"Within {distance:>2} bits: copies {(copy_distances <= distance).mean():4.0%}, "
+          f"bursts {(burst_distances <= distance).mean():4.0%}, false {(pair_distances <= distance).sum()}")
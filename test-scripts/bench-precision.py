@@ -0,0 +1,101 @@
+"""
+Stores encodings at each precision and compares database size, index memory, matching speed and tagging results
+against float64.
+Run from the repository root: `py test-scripts/bench-precision.py [--encodings 100000]`
+
+Tagging results come from the faces in unittest-images: known.jpg and "woman right.jpg" are the known people, and
+every face in every test image is matched against them from the database, like --rematch does. Sizes and timings
+use --encodings extra known encodings, noisy copies of the test faces, so there's enough data to measure.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+from time import perf_counter as pc
+
+import numpy
+
+from Controllers.Database import Database
+from Controllers.FaceRecognizer import encode_faces, KnownFaceIndex
+from Controllers.Quantizer import precisions
+from Model.ImageFile import ImageFile
+
+test_dir = "unittest-images"
+known_files = {"Will": "known.jpg", "Woman": "woman right.jpg"}
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--encodings", help="Number of extra known encodings, for sizes and timings", default=100000,
+                    type=int)
+parser.add_argument("--faces", help="Number of unknown faces to time matching with", default=1000, type=int)
+parser.add_argument("--tolerance", default=0.6, type=float)
+parser.add_argument("--packed", help="Use an EncodingStore instead of BLOBs", action="store_true")
+args = parser.parse_args()
+
+work_dir = tempfile.mkdtemp()
+test_images = sorted(name for name in os.listdir(test_dir) if name.lower().endswith(".jpg"))
+test_encodings = {name: encode_faces(os.path.join(test_dir, name)) for name in test_images}
+all_faces = numpy.array([enc for encodings in test_encodings.values() for enc in encodings])
+rng = numpy.random.default_rng(0)
+crowd = all_faces[rng.integers(0, len(all_faces), args.encodings)] + rng.normal(0, 0.05, (args.encodings, 128))
+unknown = all_faces[rng.integers(0, len(all_faces), args.faces)] + rng.normal(0, 0.05, (args.faces, 128))
+
+
+def file_size(db: Database) -> int:
+    db.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    size = os.path.getsize(db.db_file_path)
+    if db.store:
+        db.store.flush()
+        size += db.store.rows * db.store.memmap.itemsize * db.store.width  # Spare capacity isn't counted
+    return size
+
+
+def run(precision: str):
+    db = Database(os.path.join(work_dir, f"{precision}.db"), batch_size=1000, packed_store=args.packed)
+    db.set_precision(precision)
+    for name, filename in known_files.items():
+        db.add_encodings(test_encodings[filename], db.add_person(name), person=True)
+    image_ids = {name: db.add_image(ImageFile(os.path.join(test_dir, name)), encodings)
+                 for name, encodings in test_encodings.items()}
+    db.flush()
+
+    # Tagging the test images, from stored encodings
+    index = KnownFaceIndex(db.get_all_people())
+    tags, distances = {}, []
+    for name, image_id in image_ids.items():
+        encodings = db.get_encodings_by_image_id(image_id)
+        person_distances = index.person_distances(numpy.array([e.encoding for e in encodings]), args.tolerance, 3)
+        tags[name] = sorted(p.name for p in index.match(encodings, args.tolerance, person_distances))
+        distances.extend(person_distances.ravel())
+
+    # Size and speed with a crowd of known people
+    small_size = file_size(db)
+    for start in range(0, args.encodings, 5):
+        db.add_encodings(crowd[start:start + 5], db.add_person(f"Crowd {start // 5}"), person=True)
+        db.end_image()
+    db.flush()
+    size = file_size(db) - small_size
+
+    start = pc()
+    crowd_index = KnownFaceIndex(db.get_all_people())
+    load_time = pc() - start
+    start = pc()
+    for face in range(0, args.faces, 10):  # Ten faces to a picture
+        crowd_index.person_distances(unknown[face:face + 10], args.tolerance, 3)
+    match_time = pc() - start
+    db.close()
+    return tags, numpy.array(distances), size, crowd_index.matrix.nbytes, load_time, match_time
+
+
+print(f"{len(all_faces)} faces in {len(test_images)} test images, {args.encodings:,} extra known encodings, "
+      f"{'EncodingStore' if args.packed else 'BLOBs'}")
+baseline = None
+for precision in precisions:
+    tags, distances, size, index_bytes, load_time, match_time = run(precision)
+    if baseline is None:
+        baseline = tags, distances
+        print(f"Tags at float64: {tags}")
+    print(f"{precision:<8} {size / args.encodings:7.0f} bytes/encoding on disk   index {index_bytes / 2**20:6.1f}MB   "
+          f"load {load_time * 1000:6.0f}ms   match {match_time / args.faces * 1e6:6.0f}us/face   "
+          f"same tags: {tags == baseline[0]}   largest distance change {numpy.abs(distances - baseline[1]).max():.5f}")
+
+shutil.rmtree(work_dir)
@@ -1,21 +1,44 @@
 # Builtins
+import contextlib
 import os
+import shutil
+import tempfile
+import threading
 import unittest
+import unittest.mock
 import uuid
 from copy import deepcopy
+from io import BytesIO, StringIO
 from os import path
 import numpy
+import face_recognition as fr
+import pyexiv2 as pe2
+from PIL import Image as pilmage
 from datetime import datetime
 # Custom modules
 
 
 from Controllers.Database import Database
-from Controllers.FaceRecognizer import encode_faces, match_best
+from Controllers.FaceRecognizer import encode_faces, encode_faces_with_locations, match_best, KnownFaceIndex, \
+    assign_in_order, load_resized, might_have_faces, gate_presets, gate_available, GOAL_SIZE, FindFaces, encode_batch, \
+    stack_frames, encode_faces_with_regions, encode_crops, find_and_encode, ADAPTIVE_LEVELS
+from Controllers.AnnIndex import AnnIndex
+from Controllers.Clusterer import cluster_encodings
+from Controllers.KeywordWriter import net_changes, write_pending_keywords
+from Controllers.NearDuplicates import perceptual_hash, NearDuplicateIndex
+from Controllers.Pipeline import encode_images, group_images, timed_encode_batch
+from Controllers.Quantizer import quantize, dequantize
 from Model.FaceEncoding import FaceEncoding
+from Model.FaceRegion import FaceRegion
 from Model.ImageFile import ImageFile
+from Model.Sidecar import XmpSidecar
+from Model.ExifHeader import read_exif_header
 from Model.Person import Person
+from lits import retag_from_face_matches, rematch_stored_encodings, parse_args, match_and_record, \
+    reencode_stored_faces
+from dashboard import people_per_picture_at_tolerance
 
-test_data_path = "unittest-images\\"
+test_data_path = path.join("unittest-images", "")  # Ends in a separator, so file names can be appended
 class TestFaceRecognizer(unittest.TestCase):
     my_dir = path.dirname(__file__)
 
@@ -63,6 +86,149 @@ class TestFaceRecognizer(unittest.TestCase):
         best_matches = match_best([self.test_person], unknown_faces)
         self.assertEqual(0, len(best_matches), "face matched against a different face")
 
+    # Finding faces small and encoding them from crops should give nearly the same faces
+    def test_two_stage_detection(self):
+        standard, standard_locations = encode_faces_with_locations(self.multiple_people.filepath)
+        two_stage, locations = encode_faces_with_locations(self.multiple_people.filepath, detection="two-stage")
+        self.assertEqual(len(standard), len(two_stage), "two-stage detection found a different number of faces")
+        for encoding, location in zip(two_stage, locations):
+            distances = numpy.linalg.norm(numpy.array(standard) - encoding, axis=1)
+            closest = int(numpy.argmin(distances))
+            self.assertLess(distances[closest], 0.2, "face encoded from a crop is too far from the standard encoding")
+            self.assertLess(numpy.abs(numpy.subtract(location, standard_locations[closest])).max(), 20)
+        best_matches = match_best([self.test_person], [FaceEncoding(-1, fe) for fe in two_stage])
+        self.assertEqual(1, len(best_matches), "face didn't match with itself after two-stage detection")
+
+    def test_batched_detection(self):
+        filepaths = [self.multiple_people.filepath, self.known_image.filepath, self.different_person.filepath]
+        for (encodings, regions, searched_size), filepath in zip(encode_batch(filepaths), filepaths):
+            locations = [region.box for region in regions]
+            standard, standard_locations = encode_faces_with_locations(filepath)
+            self.assertEqual(sorted(standard_locations), sorted(locations), f"different faces found in {filepath}")
+            for encoding, location in zip(encodings, locations):
+                standard_encoding = standard[standard_locations.index(location)]
+                self.assertLess(numpy.linalg.norm(standard_encoding - encoding), 0.01)
+        self.assertEqual([], FindFaces(stack_frames([])))
+
+    def test_adaptive_detection(self):
+        standard, standard_locations = encode_faces_with_locations(self.multiple_people.filepath)
+        adaptive, regions, searched_size = find_and_encode(self.multiple_people.filepath, detection="adaptive")
+        self.assertEqual(len(standard), len(adaptive), "adaptive detection found a different number of faces")
+        for encoding in adaptive:
+            self.assertLess(numpy.linalg.norm(numpy.array(standard) - encoding, axis=1).min(), 0.2)
+        self.assertEqual(ADAPTIVE_LEVELS[0], searched_size, "a group with big faces shouldn't need a second look")
+        encodings, regions, searched_size = find_and_encode(self.multiple_people.filepath, detection="adaptive",
+                                                            detect_size=ADAPTIVE_LEVELS[0] - 100)
+        self.assertEqual(ADAPTIVE_LEVELS[0] - 100, searched_size, "adaptive detection went past detect_size")
+        encodings, regions, searched_size = find_and_encode(self.known_image.filepath, detect_size=600)
+        self.assertEqual(600, searched_size, "detect_size wasn't used by standard detection")
+        self.assertEqual(1, len(encodings))
+
+    def test_reencode_from_regions(self):
+        standard, regions = encode_faces_with_regions(self.multiple_people.filepath)
+        for region in regions:
+            top, right, bottom, left = region.box
+            self.assertEqual((68, 2), region.landmarks.shape)
+            self.assertTrue(left - 20 < region.landmarks[:, 0].mean() < right + 20, "landmarks aren't in the face")
+            self.assertTrue(top - 20 < region.landmarks[:, 1].mean() < bottom + 20, "landmarks aren't in the face")
+            self.assertEqual("hog", region.detector)
+        encodings, landmarks = encode_crops(self.multiple_people.filepath, [region.box for region in regions])
+        for encoding, points, original, region in zip(encodings, landmarks, standard, regions):
+            self.assertLess(numpy.linalg.norm(original - encoding), 0.2, "re-encoded face is too far from the original")
+            self.assertLess(numpy.abs(points - region.landmarks).mean(), 10)
+
+    @unittest.skipUnless(gate_available(), "OpenCV isn't installed")
+    def test_face_gate(self):
+        pixels = numpy.array(load_resized(self.known_image.filepath, GOAL_SIZE))
+        blank = numpy.full_like(pixels, 128)
+        for preset in gate_presets:
+            self.assertTrue(might_have_faces(pixels, preset), f"{preset} gate missed a portrait")
+            self.assertFalse(might_have_faces(blank, preset), f"{preset} gate found a face in a blank picture")
+        encodings, locations = encode_faces_with_locations(self.known_image.filepath, gate="fast")
+        self.assertEqual(1, len(encodings))
+
+    # Prebuilt index should give the same answers as matching from a list of people
+    def test_known_face_index(self):
+        unknown_faces = [FaceEncoding(-1, fe) for fe in encode_faces(self.multiple_people.filepath)]
+        other_person = Person(-2, "not will", [FaceEncoding(-1, fe) for fe in encode_faces(self.different_person.filepath)])
+        known_people = [other_person, self.test_person]
+        index = KnownFaceIndex(known_people)
+        self.assertEqual(2, len(index))
+        self.assertEqual(match_best(known_people, unknown_faces), index.match(unknown_faces))
+
+        flat_known = [enc.encoding for kp in known_people for enc in kp.encodings]
+        for face, distances in zip(unknown_faces, index.distances(numpy.array([f.encoding for f in unknown_faces]))):
+            numpy.testing.assert_allclose(fr.face_distance(flat_known, face.encoding), distances)
+
+        closest = index.closest_people(unknown_faces, k=1)
+        self.assertEqual(len(unknown_faces), len(closest))
+        for face, face_closest in zip(unknown_faces, closest):
+            self.assertEqual(1, len(face_closest))
+            self.assertAlmostEqual(min(index.person_distances(numpy.array([face.encoding]))[0]), face_closest[0][1])
+
+    # Encodings stored at a lower precision go through the float32 index, and should match the same way
+    def test_compact_index(self):
+        unknown_faces = [FaceEncoding(-1, fe) for fe in encode_faces(self.multiple_people.filepath)]
+        other_person = Person(-2, "not will", [FaceEncoding(-1, fe) for fe in encode_faces(self.different_person.filepath)])
+        known_people = [other_person, self.test_person]
+        expected = {p.dbid: unknown_faces.index(face) for p, face in match_best(known_people, unknown_faces).items()}
+
+        for precision in ["float32", "int8"]:
+            stored_people = [Person(kp.dbid, kp.name, [FaceEncoding(-1, dequantize(*quantize(enc.encoding, precision))[0])
+                                                       for enc in kp.encodings]) for kp in known_people]
+            index = KnownFaceIndex(stored_people)
+            self.assertTrue(index.compact)
+            matched = {p.dbid: unknown_faces.index(face) for p, face in index.match(unknown_faces).items()}
+            self.assertEqual(expected, matched, f"matches changed when stored as {precision}")
+
+            unknown = numpy.array([face.encoding for face in unknown_faces])
+            numpy.testing.assert_allclose(index.person_distances(unknown),
+                                          index.person_distances(unknown, tolerance=0.6, k=1), rtol=1e-5)
+
+    def test_ann_index(self):
+        rng = numpy.random.default_rng(0)
+        people = [Person(p, str(p), [FaceEncoding(p * 10 + i, enc)
+                                     for i, enc in enumerate(rng.normal(0, 0.05, (3, 128)))]) for p in range(200)]
+        unknown = numpy.array([people[7].encodings[1].encoding, rng.normal(0, 0.05, 128)])
+        exact = KnownFaceIndex(people).person_distances(unknown)
+
+        ann = AnnIndex(people, n_probe=1, centroids=numpy.array(rng.normal(0, 0.05, (20, 128))))
+        distances = ann.person_distances(unknown)
+        self.assertAlmostEqual(0, distances[0][7], 6, "a known encoding should be in the list closest to it")
+        self.assertTrue((distances >= exact - 1e-9).all(), "only encodings that were searched can be closer")
+        ann.n_probe = 20
+        numpy.testing.assert_allclose(exact, ann.person_distances(unknown))
+
+        # Saved, then loaded with a new person, whose encodings are added without retraining
+        ann_db_path = "test-ann.db"
+        ann.trained_size = len(ann)
+        ann.save(AnnIndex.path_for(ann_db_path))
+        try:
+            newcomer = Person(1000, "new", [FaceEncoding(10000, unknown[1])])
+            loaded = AnnIndex.load(ann_db_path, people + [newcomer], n_probe=1)
+            self.assertEqual(1, loaded.newly_assigned)
+            self.assertTrue(numpy.array_equal(ann.centroids, loaded.centroids))
+            self.assertAlmostEqual(0, loaded.person_distances(unknown[1])[0][-1], 6)
+        finally:
+            os.remove(AnnIndex.path_for(ann_db_path))
+
+    def test_assign_in_order(self):
+        # Faces go in order, so face 1 gets person 20 even though face 3 is closer to them
+        candidates = [(3, 20, 0.1), (1, 10, 0.3), (1, 20, 0.2), (2, 10, 0.4), (2, 20, 0.5)]
+        self.assertEqual({(1, 20), (2, 10)}, assign_in_order(candidates))
+        self.assertEqual(set(), assign_in_order([]))
+
+        # The same as matching faces from scratch
+        axes = numpy.eye(128)
+        faces = [FaceEncoding(1, 0.3 * axes[0] + 0.2 * axes[2]), FaceEncoding(2, 0.3 * axes[1])]
+        people = [Person(10, "P", [FaceEncoding(-1, 0.3 * axes[0])]), Person(20, "Q", [FaceEncoding(-1, axes[3])])]
+        index = KnownFaceIndex(people)
+        distances = index.person_distances(numpy.array([face.encoding for face in faces]))
+        candidates = [(face.dbid, person.dbid, distance) for face, face_distances in zip(faces, distances)
+                      for person, distance in zip(index.people, face_distances) if distance < 1.2]
+        self.assertEqual({(face.dbid, person.dbid) for person, face in index.match(faces, 1.2).items()},
+                         assign_in_order(candidates))
+
     # Shouldn't match on a mushroom
     def test_not_a_person(self):
         unknown_faces = [FaceEncoding(-1, fe) for fe in encode_faces(self.mushroom.filepath)]
@@ -103,6 +269,32 @@ class TestImage(unittest.TestCase):
         readout = self.test_image.get_keywords()
         self.assertEqual(1, len(readout), "Adding the same keyword multiple times wasn't de-duplicated.")
 
+    def test_keywords_stored_separately(self):
+        rand_keywords = [str(uuid.uuid4()) for i in range(2)]
+        self.test_image.append_keywords(rand_keywords)
+        with pe2.Image(self.test_image.filepath) as loaded:
+            stored = loaded.read_iptc(encoding=ImageFile.normal_encoding)[ImageFile.keyword_field_name]
+        self.assertListEqual(rand_keywords, stored, "keywords weren't stored as one value each")
+        self.assertListEqual(rand_keywords, ImageFile(self.test_image.filepath).get_keywords())
+        self.assertListEqual(["a", "b", "c"], ImageFile.split_keywords(["a,b", "c"]), "comma-joined keywords weren't split")
+        self.assertListEqual(["a", "b"], ImageFile.split_keywords("a,b"))
+
+    def test_sidecar(self):
+        embedded_keyword, rand_keyword = str(uuid.uuid4()), str(uuid.uuid4())
+        self.test_image.append_keywords([embedded_keyword])
+        modified = os.stat(self.test_image.filepath).st_mtime_ns
+        sidecar = XmpSidecar(self.test_image.filepath)
+        try:
+            ImageFile.use_sidecar = True
+            self.test_image.append_keywords([rand_keyword])
+            self.assertEqual(modified, os.stat(self.test_image.filepath).st_mtime_ns, "Image changed in sidecar mode")
+            self.assertTrue(sidecar.exists())
+            self.assertListEqual([embedded_keyword, rand_keyword], ImageFile(self.test_image.filepath).get_keywords())
+        finally:
+            ImageFile.use_sidecar = False
+            if sidecar.exists():
+                os.remove(sidecar.filepath)
+
     def test_exif_extract(self):
         exif_data = self.test_image.get_salient_exif_data()
         self.assertEqual(1.8, exif_data["aperture"])
@@ -110,6 +302,12 @@ class TestImage(unittest.TestCase):
         self.assertEqual(100, exif_data["iso"])
         self.assertEqual(datetime.strptime("2020:07:23 07:47:08", ImageFile.exif_timestamp_format), exif_data["date_taken"])
 
+    def test_exif_header(self):
+        for name in os.listdir(test_data_path):
+            image = ImageFile(path.join(test_data_path, name))
+            header_exif = ImageFile.parse_salient_exif(read_exif_header(image.filepath), image.filepath)
+            self.assertEqual(image.get_salient_exif_data(), header_exif, f"Header-only EXIF differs for {name}")
+
 
 
 class TestDatabase(unittest.TestCase):
@@ -136,6 +334,10 @@ class TestDatabase(unittest.TestCase):
         self.test_db.connection.executescript("DELETE FROM Encoding")
         self.test_db.connection.executescript("DELETE FROM PersonEncoding")
         self.test_db.connection.executescript("DELETE FROM ImageEncoding")
+        self.test_db.connection.executescript("DELETE FROM KeywordJournal")
+        self.test_db.connection.executescript("DELETE FROM FaceCluster")
+        self.test_db.connection.executescript("DELETE FROM FaceRegion")
+        self.test_db.connection.executescript("DELETE FROM FaceMatch")
 
         # Clone the test image to reduce time spent encoding
         self.this_test_image: ImageFile = deepcopy(self.base_test_image)
@@ -152,6 +354,384 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(new_image_id, second_image_id, "Inserted same file twice, got different Ids")
         self.assertEqual(os.path.getsize(self.this_test_image.filepath), test_row["size_bytes"])
 
+    def test_face_regions(self):
+        encodings = [enc.encoding for enc in self.this_test_image.encodings_in_image]
+        landmarks = numpy.arange(136).reshape(68, 2) + 300
+        image_id = self.test_db.add_image(self.this_test_image, encodings,
+                                          [FaceRegion((300, 540, 609, 232), landmarks, "hog", 2.5)])
+        encoding_id = self.test_db.get_encodings_by_image_id(image_id)[0].dbid
+        regions = self.test_db.get_face_regions(image_id)
+        self.assertEqual([encoding_id], list(regions))
+        self.assertEqual((300, 540, 609, 232), regions[encoding_id].box)
+        self.assertTrue(numpy.array_equal(landmarks, regions[encoding_id].landmarks))
+        self.assertEqual(("hog", 2.5), (regions[encoding_id].detector, regions[encoding_id].source_scale))
+        self.assertEqual(0, self.test_db.count_faces_without_regions())
+
+        # Re-encoding keeps the encoding's id
+        new_encoding = encodings[0] + 0.01
+        self.test_db.replace_encodings([encoding_id], [new_encoding])
+        stored = self.test_db.get_encodings_by_image_id(image_id)
+        self.assertEqual([encoding_id], [enc.dbid for enc in stored])
+        self.assertTrue(numpy.allclose(new_encoding, stored[0].encoding))
+
+    def test_near_duplicates(self):
+        phash, size = perceptual_hash(self.this_test_image.filepath)
+        copy = BytesIO()
+        pilmage.open(self.this_test_image.filepath).save(copy, "JPEG", quality=80)
+        copy_hash, copy_size = perceptual_hash(copy)
+        other_hash, other_size = perceptual_hash(test_data_path + "man.jpg")
+        self.assertEqual(size, copy_size)
+
+        self.this_test_image.phash, self.this_test_image.dimensions = phash, size
+        encodings = [enc.encoding for enc in self.this_test_image.encodings_in_image]
+        source_id = self.test_db.add_image(self.this_test_image, encodings, [FaceRegion((300, 540, 609, 232))], 1250)
+        index = NearDuplicateIndex(self.test_db.get_perceptual_hashes())
+        self.assertEqual(source_id, index.find(copy_hash, copy_size, 2), "re-saved copy wasn't a near duplicate")
+        self.assertIsNone(index.find(copy_hash, (size[0] + 1, size[1]), 64), "images of different sizes matched")
+        self.assertIsNone(index.find(other_hash, size, 4), "a different picture was a near duplicate")
+        # Hashes added one at a time, past several times the index has to grow, are all still found
+        hashes = [int(h) for h in numpy.random.default_rng(0).integers(-2 ** 63, 2 ** 63 - 1, 100, dtype="int64")]
+        for i, extra_hash in enumerate(hashes):
+            index.add(f"extra {i}", extra_hash, size)
+        self.assertEqual(["extra 0", "extra 99"], [index.find(hashes[0], size, 0), index.find(hashes[99], size, 0)])
+        self.assertEqual(source_id, index.find(copy_hash, copy_size, 2))
+        self.assertEqual(101, len(index))
+
+        duplicate = ImageFile(test_data_path + "man.jpg")
+        duplicate_id = self.test_db.add_near_duplicate(duplicate, source_id)
+        copied = self.test_db.get_encodings_by_image_id(duplicate_id)
+        self.assertTrue(numpy.allclose(encodings, [enc.encoding for enc in copied]))
+        self.assertEqual([(300, 540, 609, 232)], [r.box for r in self.test_db.get_face_regions(duplicate_id).values()])
+        source_ids = [enc.dbid for enc in self.test_db.get_encodings_by_image_id(source_id)]
+        self.assertNotEqual(source_ids, [enc.dbid for enc in copied], "faces were shared instead of copied")
+
+    def test_batched_close_keeps_only_whole_images(self):
+        self.test_db.close()
+        self.test_db = Database(self.test_db_path, batch_size=10)
+        kept_id = self.test_db.add_image(self.this_test_image, [])
+        self.test_db.end_image()
+
+        self.test_db.write("DELETE FROM Image")  # Stand-in for an image interrupted part way through
+        self.test_db.close()
+
+        self.test_db = Database(self.test_db_path)
+        result = self.test_db.connection.execute("SELECT id FROM Image").fetchall()
+        self.assertEqual([kept_id], [row["id"] for row in result], "Close should keep ended images and drop the rest")
+
+    def test_read_while_writing(self):
+        self.test_db.close()
+        self.test_db = Database(self.test_db_path, batch_size=10)
+        self.test_db.add_image(self.this_test_image, [])
+        self.test_db.end_image()  # Still inside the uncommitted batch, like a scan in progress
+
+        image_counts = []
+
+        def count_images():
+            with self.test_db.reader() as connection:
+                image_counts.append(connection.execute("SELECT count(*) FROM Image").fetchone()[0])
+
+        reader_thread = threading.Thread(target=count_images)
+        reader_thread.start()
+        reader_thread.join(timeout=5)
+        self.assertFalse(reader_thread.is_alive(), "Reader was blocked by the open write transaction")
+        self.assertEqual([0], image_counts, "Reader should only see committed data")
+
+        self.test_db.flush()
+        count_images()
+        self.assertEqual([0, 1], image_counts, "Reader should see data once it's committed")
+
+    def test_image_ids_by_stat(self):
+        new_image_id = self.test_db.add_image(self.this_test_image, [])
+        by_stat = self.test_db.get_image_ids_by_stat()
+        self.assertEqual({self.this_test_image.stat_key(): new_image_id}, by_stat)
+
+    def test_get_people(self):
+        test_encoding = self.this_test_image.encodings_in_image[0].encoding
+        will_id = self.test_db.add_person("Will")
+        self.test_db.add_encodings([test_encoding, test_encoding * 2], will_id, person=True)
+        nobody_id = self.test_db.add_person("Nobody")
+
+        people = self.test_db.get_all_people()
+        self.assertEqual([will_id, nobody_id], [p.dbid for p in people])
+        self.assertEqual(2, len(people[0].encodings))
+        self.assertTrue(numpy.array_equal(test_encoding * 2, people[0].encodings[1].encoding))
+        self.assertEqual(0, len(people[1].encodings))
+
+        found = self.test_db.get_person_by_name("Will")
+        self.assertEqual(will_id, found.dbid)
+        self.assertEqual([e.dbid for e in people[0].encodings], [e.dbid for e in found.encodings])
+        self.assertIsNone(self.test_db.get_person_by_name("Somebody else"))
+
+    def test_encoding_store(self):
+        packed_db_path = "test-packed.db"
+        test_encoding = self.this_test_image.encodings_in_image[0].encoding
+        packed_db = Database(packed_db_path, batch_size=10, packed_store=True)
+        try:
+            person_id = packed_db.add_person("Will")
+            encoding_ids = packed_db.add_encodings([test_encoding, test_encoding * 2], person_id, person=True)
+            packed_db.end_image()
+            packed_db.add_encodings([test_encoding * 3], person_id, person=True)  # Unfinished, so rolled back
+            packed_db.discard_unfinished_image()
+            packed_db.add_encodings([test_encoding * 4], person_id, person=True)
+            packed_db.flush()
+
+            self.assertEqual(3, packed_db.store.rows, "Rolled-back rows weren't reused")
+            self.assertEqual(3, packed_db.compact_encoding_store())
+            ids, matrix = packed_db.get_encoding_matrix()
+            self.assertEqual(encoding_ids, list(ids[:2]))
+            self.assertTrue(numpy.array_equal([test_encoding, test_encoding * 2, test_encoding * 4], matrix))
+            found = packed_db.get_person_by_name("Will")
+            self.assertTrue(numpy.array_equal(test_encoding * 2, found.encodings[1].encoding))
+        finally:
+            store_path = packed_db.store.filepath
+            packed_db.close()
+            os.remove(packed_db_path)
+            os.remove(store_path)
+
+    def test_encoding_store_row_count(self):
+        packed_db_path = "test-packed.db"
+        test_encoding = self.this_test_image.encodings_in_image[0].encoding
+        packed_db = Database(packed_db_path, packed_store=True)  # Not batched, so every add commits on its own
+        try:
+            person_id = packed_db.add_person("Will")
+            packed_db.add_encodings([test_encoding, test_encoding * 2], person_id, person=True)
+            self.assertFalse(packed_db.connection.in_transaction, "encodings weren't committed with the row count")
+            self.assertEqual(2, int(packed_db.get_setting(Database.store_rows_setting)))
+
+            # As if a crash had lost the row count but not the rows pointing at the store
+            packed_db.connection.execute("UPDATE Setting SET value = 0 WHERE name = ?", [Database.store_rows_setting])
+            packed_db.close()
+            packed_db = Database(packed_db_path)
+            packed_db.add_encodings([test_encoding * 5], person_id, person=True)
+            stored = packed_db.get_person_by_name("Will").encodings
+            self.assertTrue(numpy.array_equal([test_encoding, test_encoding * 2, test_encoding * 5],
+                                              [enc.encoding for enc in stored]), "stored encodings were written over")
+        finally:
+            store_path = packed_db.store.filepath
+            packed_db.close()
+            os.remove(packed_db_path)
+            os.remove(store_path)
+
+    def test_encoding_precision(self):
+        compact_db_path = "test-compact.db"
+        test_encoding = self.this_test_image.encodings_in_image[0].encoding
+        compact_db = Database(compact_db_path)
+        try:
+            person_id = compact_db.add_person("Will")
+            compact_db.add_encodings([test_encoding], person_id, person=True)
+            self.assertEqual(1, compact_db.set_precision("int8"), "Stored encoding wasn't converted")
+            compact_db.add_encodings([test_encoding * 2], person_id, person=True)
+            sizes = [row[0] for row in compact_db.connection.execute("SELECT length(encoding) FROM Encoding")]
+            self.assertEqual([128, 128], sizes)
+
+            found = compact_db.get_person_by_name("Will")
+            step = numpy.abs(test_encoding).max() / 127
+            numpy.testing.assert_allclose(test_encoding, found.encodings[0].encoding, rtol=0, atol=step)
+            numpy.testing.assert_allclose(test_encoding * 2, found.encodings[1].encoding, rtol=0, atol=step * 2)
+
+            # Packed into a store, then converted to float32 without losing anything more
+            self.assertEqual(2, compact_db.pack_encodings())
+            self.assertEqual("int8", compact_db.store.dtype)
+            self.assertEqual(2, compact_db.set_precision("float32"))
+            ids, matrix = compact_db.get_encoding_matrix()
+            self.assertEqual("float32", matrix.dtype)
+            self.assertTrue(numpy.array_equal([e.encoding for e in found.encodings], matrix))
+        finally:
+            store_path = compact_db.store.filepath if compact_db.store else None
+            compact_db.close()
+            os.remove(compact_db_path)
+            if store_path:
+                os.remove(store_path)
+
+    def test_face_clusters(self):
+        rng = numpy.random.default_rng(0)
+        # A chain of faces each 0.4 from the next is one cluster, even though its ends are 0.8 apart
+        chain = numpy.zeros((3, 128))
+        chain[1, 0], chain[2, 0] = 0.4, 0.8
+        stranger = numpy.full((1, 128), 0.1)
+        matrix = numpy.concatenate([chain, stranger, chain[:1] + 0.01])
+        self.assertEqual([0, 0, 0, 3, 0], cluster_encodings(matrix, 0.5).tolist())
+        # Large enough to use k-means lists: tight groups of 5 are still found
+        centers = rng.normal(0, 0.06, (500, 128))
+        crowd = numpy.repeat(centers, 5, axis=0) + rng.normal(0, 0.01, (2500, 128))
+        clusters = cluster_encodings(crowd, 0.3, exhaustive_size=1000)
+        self.assertTrue((clusters == numpy.repeat(numpy.arange(0, 2500, 5), 5)).all())
+
+        image_id = self.test_db.add_image(self.this_test_image, [chain[0], chain[1], stranger[0]])
+        ids, found = self.test_db.get_encoding_matrix(unmatched_only=True)
+        self.assertEqual(3, len(ids))
+        ids = ids.tolist()
+        self.test_db.replace_face_clusters(ids[:2], [ids[0]] * 2)
+        self.assertEqual([(ids[0], 2, self.this_test_image.filepath)], self.test_db.get_face_clusters(10))
+        self.assertEqual({image_id: ids[:2]}, self.test_db.get_face_cluster(ids[0]))
+        self.test_db.get_or_associate_encoding(ids[0], self.test_db.add_person("Will"), person=True)
+        self.assertEqual(2, len(self.test_db.get_encoding_matrix(unmatched_only=True)[0]))
+        self.test_db.delete_face_cluster(ids[0])
+        self.assertEqual([], self.test_db.get_face_clusters(10))
+
+    def test_keyword_journal(self):
+        image_id = self.test_db.add_image(self.this_test_image, [])
+        self.test_db.queue_keywords(image_id, ["Will", "Nobody"])
+        self.test_db.queue_keywords(image_id, ["Somebody"], ["Nobody"])
+        self.assertEqual(4, self.test_db.count_pending_keywords())
+
+        pending = self.test_db.get_pending_keywords(0, 10)
+        filepath, entries = pending[image_id]
+        self.assertEqual(self.this_test_image.filepath, filepath)
+        self.assertEqual((["Will", "Somebody"], ["Nobody"]), net_changes(entries))
+        self.assertEqual({}, self.test_db.get_pending_keywords(image_id, 10))
+
+        self.test_db.remove_applied_keywords([journal_id for journal_id, keyword, action in entries])
+        self.assertEqual(0, self.test_db.count_pending_keywords())
+        self.assertEqual(0, self.test_db.connection.execute("SELECT COUNT(*) FROM KeywordJournal").fetchone()[0])
+        self.test_db.queue_keywords(image_id, [], [])
+        self.assertEqual(0, self.test_db.count_pending_keywords(), "nothing to change was journalled")
+
+    def test_write_pending_keywords(self):
+        work_dir = tempfile.mkdtemp()
+        copy = path.join(work_dir, "known.jpg")
+        shutil.copyfile(self.this_test_image.filepath, copy)
+        ImageFile(copy).clear_keywords()  # Other tests tag the original
+        try:
+            image_id = self.test_db.add_image(ImageFile(copy), [])
+            self.test_db.queue_keywords(image_id, ["Will", "Nobody"])
+            self.test_db.queue_keywords(image_id, [], ["Nobody"])
+            self.test_db.flush()
+            self.assertEqual((1, 0), write_pending_keywords(self.test_db, threads=2))
+            self.assertListEqual(["Will"], ImageFile(copy).get_keywords())
+            self.assertEqual(0, self.test_db.connection.execute("SELECT COUNT(*) FROM KeywordJournal").fetchone()[0],
+                             "written entries were left in the journal")
+            self.assertEqual((0, 0), write_pending_keywords(self.test_db), "a file was written again")
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_retag(self):
+        encodings = [enc.encoding for enc in self.this_test_image.encodings_in_image]
+        image_id = self.test_db.add_image(self.this_test_image, encodings + [encodings[0] + 0.1])
+        matched_id, named_id = [enc.dbid for enc in self.test_db.get_encodings_by_image_id(image_id)]
+        bob, alice = self.test_db.add_person("Bob"), self.test_db.add_person("Alice")
+        # Bob was matched at 0.4. Alice was named by hand, on a face whose closest recorded match was Bob at 0.7.
+        self.test_db.add_face_matches([(matched_id, bob, 0.4), (named_id, bob, 0.7)])
+        self.test_db.get_or_associate_encoding(matched_id, bob, person=True)
+        self.test_db.get_or_associate_encoding(named_id, alice, person=True)
+        self.test_db.flush()
+
+        retag_from_face_matches(self.test_db, 0.6)
+        self.assertEqual({bob, alice}, self.test_db.get_person_ids_by_image_id(image_id))
+        self.assertEqual(0, self.test_db.count_pending_keywords(), "retagging at the same tolerance changed keywords")
+
+        retag_from_face_matches(self.test_db, 0.3)
+        self.assertEqual({alice}, self.test_db.get_person_ids_by_image_id(image_id), "Bob should be gone, Alice kept")
+        filepath, entries = self.test_db.get_pending_keywords(0, 10)[image_id]
+        self.assertEqual(([], ["Bob"]), net_changes(entries))
+
+        retag_from_face_matches(self.test_db, 0.8)
+        self.assertEqual({bob, alice}, self.test_db.get_person_ids_by_image_id(image_id))
+        self.assertEqual([(matched_id, bob), (named_id, alice)],
+                         sorted(tuple(row) for row in
+                                self.test_db.connection.execute("SELECT encoding_id, person_id FROM PersonEncoding")))
+
+    def test_rematch(self):
+        tolerance = 0.6
+        image_ids = {}
+        for name in ["known.jpg", "man.jpg", "people.jpg", "woman right.jpg"]:
+            encodings, regions, searched_size = find_and_encode(test_data_path + name)
+            image = ImageFile(test_data_path + name)
+            image_ids[name] = self.test_db.add_image(image, encodings, regions, searched_size)
+        self.test_db.flush()
+
+        def add_person_and_rematch(name: str, encoding_id: int):
+            # People are added after the scan, from a face it found, as known person images are
+            self.test_db.get_or_associate_encoding(encoding_id, associate_id=self.test_db.add_person(name), person=True)
+            self.test_db.flush()
+            rematch_stored_encodings(self.test_db, tolerance)
+
+            # The same people as matching every stored face against everyone from scratch
+            index = KnownFaceIndex(self.test_db.get_people())
+            for image_name, image_id in image_ids.items():
+                fresh = {person.dbid for person in
+                         index.match(self.test_db.get_encodings_by_image_id(image_id), tolerance)}
+                self.assertEqual(fresh, self.test_db.get_person_ids_by_image_id(image_id),
+                                 f"rematching after adding {name} differs from a fresh scan for {image_name}")
+
+        add_person_and_rematch("Will", self.test_db.get_encodings_by_image_id(image_ids["known.jpg"])[0].dbid)
+        matched = sum(len(self.test_db.get_person_ids_by_image_id(image_id)) for image_id in image_ids.values())
+        self.assertGreater(matched, 1, "no other picture was matched to Will")
+
+        # Only faces nobody matched are compared, and only with people added since the last rematch
+        unmatched = self.test_db.get_unmatched_encodings(min(image_ids.values()), max(image_ids.values()))
+        image_id, faces = next(iter(unmatched.items()))
+        add_person_and_rematch("Someone", faces[0].dbid)
+
+    def test_retag_at_matched_tolerance(self):
+        # Face 1 is matched first, so it gets P even though face 2 is closer to P. Picking the closest pair first
+        # would swap them, giving face 1 Q instead.
+        axes = numpy.eye(128)
+        image_id = self.test_db.add_image(self.this_test_image, [numpy.zeros(128), 0.3 * axes[0] + 0.2 * axes[2]])
+        p_id, q_id = self.test_db.add_person("P"), self.test_db.add_person("Q")
+        self.test_db.add_encoding(0.3 * axes[0], p_id, person=True)
+        self.test_db.add_encoding(0.35 * axes[1], q_id, person=True)
+        self.test_db.flush()
+        index = KnownFaceIndex(self.test_db.get_people())
+        found = match_and_record(self.test_db, index, self.test_db.get_encodings_by_image_id(image_id), 0.6)
+        for person, face in found.items():
+            self.test_db.get_or_associate_encoding(face.dbid, associate_id=person.dbid, person=True)
+        self.test_db.flush()
+        sql = "SELECT encoding_id, person_id FROM PersonEncoding WHERE encoding_id IN " \
+              "(SELECT encoding_id FROM ImageEncoding WHERE image_id = ?)"
+        matched = sorted(tuple(row) for row in self.test_db.connection.execute(sql, [image_id]))
+        first_id, second_id = [face.dbid for face in self.test_db.get_encodings_by_image_id(image_id)]
+        self.assertEqual(sorted([(first_id, p_id), (second_id, q_id)]), matched)
+
+        retag_from_face_matches(self.test_db, 0.6)
+        self.assertEqual(matched, sorted(tuple(row) for row in self.test_db.connection.execute(sql, [image_id])),
+                         "re-tagging at the tolerance faces were matched at moved people between faces")
+        self.assertEqual(0, self.test_db.count_pending_keywords())
+        self.assertEqual({2: 1}, people_per_picture_at_tolerance(self.test_db, 0.6))
+
+    def test_reencode_face_matches(self):
+        image_ids = []
+        for name in ["known.jpg", "man.jpg"]:
+            encodings, regions, searched_size = find_and_encode(test_data_path + name)
+            image = ImageFile(test_data_path + name)
+            image_ids.append(self.test_db.add_image(image, encodings, regions, searched_size))
+        face, = self.test_db.get_encodings_by_image_id(image_ids[0])
+        will = self.test_db.add_person("Will")
+        will_encoding = face.encoding + 0.02
+        self.test_db.add_encoding(will_encoding, will, person=True)
+        self.test_db.add_face_matches([(face.dbid, will, 0.123)])  # Stands in for a distance to an older encoding
+        self.test_db.flush()
+        ann_path = AnnIndex.path_for(self.test_db_path)
+        open(ann_path, "wb").close()
+
+        reencode_stored_faces(self.test_db, jitter=2)
+        reencoded, = self.test_db.get_encodings_by_image_id(image_ids[0])
+        self.assertFalse(numpy.array_equal(face.encoding, reencoded.encoding), "the face wasn't re-encoded")
+        matches = [tuple(row) for row in self.test_db.connection.execute(
+            "SELECT encoding_id, person_id, distance FROM FaceMatch")]
+        self.assertEqual([(face.dbid, will)], [(encoding_id, person_id) for encoding_id, person_id, _ in matches],
+                         "only the face that had recorded distances should have them again")
+        self.assertAlmostEqual(numpy.linalg.norm(reencoded.encoding - will_encoding), matches[0][2], 6,
+                               "the recorded distance wasn't to the new encoding")
+        self.assertFalse(path.exists(ann_path), "the approximate index wasn't discarded")
+
+    def test_people_per_picture_at_tolerance(self):
+        encodings = [enc.encoding for enc in self.this_test_image.encodings_in_image]
+        image_id = self.test_db.add_image(self.this_test_image, encodings + [encodings[0] + 0.1])
+        first_id, second_id = [enc.dbid for enc in self.test_db.get_encodings_by_image_id(image_id)]
+        bob, alice = self.test_db.add_person("Bob"), self.test_db.add_person("Alice")
+        # Both faces are closest to Bob, but only one of them can be him
+        self.test_db.add_face_matches([(first_id, bob, 0.3), (first_id, alice, 0.5), (second_id, bob, 0.4)])
+        self.test_db.flush()
+
+        self.assertEqual({1: 1}, people_per_picture_at_tolerance(self.test_db, 0.45),
+                         "a face close to several people was counted as all of them")
+        self.assertEqual({}, people_per_picture_at_tolerance(self.test_db, 0.2))
+        # Alice is only in the picture once Bob's taken by the other face
+        self.test_db.add_face_matches([(second_id, alice, 0.35)])
+        self.test_db.flush()
+        self.assertEqual({2: 1}, people_per_picture_at_tolerance(self.test_db, 0.45))
+
     def test_encoding_ops(self):
         self.test_db.connection.executescript("DELETE FROM Encoding")
         self.assertRaises(Exception,
@@ -176,3 +756,108 @@ class TestDatabase(unittest.TestCase):
 
         self.assertTrue(numpy.array_equal(test_encoding, retrieved_encoding),
                         "Encoding didn't survive being stored and retrieved")
+
+
+class TestPipeline(unittest.TestCase):
+    filepaths = [test_data_path + name for name in ["known.jpg", "man.jpg", "people.jpg", "woman right.jpg"]]
+    skipped = test_data_path + "man.jpg"
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def needs_encoding(self, image: ImageFile) -> bool:
+        return image.filepath != self.skipped
+
+    def test_group_images(self):
+        images = [ImageFile(filepath) for filepath in self.filepaths + [test_data_path + "known.jpg"]]
+        opened = []
+        with unittest.mock.patch("Controllers.Pipeline.open_image", side_effect=opened.append):
+            groups = list(group_images(images, self.needs_encoding, 2))
+        self.assertEqual([], opened, "images were opened by the writer")
+        # Skipped images come alone, as soon as they're seen. The rest come in order, up to detect_batch at a time.
+        self.assertEqual([([images[1]], False), ([images[0], images[2]], True), ([images[3], images[4]], True)],
+                         groups)
+
+    def test_batches_by_size(self):
+        # known.jpg and man.jpg are the same size once shrunk, people.jpg isn't
+        filepaths = [test_data_path + name for name in ["known.jpg", "people.jpg", "man.jpg"]]
+        with unittest.mock.patch("Controllers.Pipeline.encode_batch", wraps=encode_batch) as batched:
+            results = timed_encode_batch(filepaths)
+        self.assertEqual([2, 1], sorted((len(call.args[0]) for call in batched.call_args_list), reverse=True),
+                         "pictures of different sizes were batched together")
+        self.assertEqual([len(find_and_encode(filepath)[0]) for filepath in filepaths],
+                         [len(encodings) for encodings, *_ in results], "results came back in the wrong order")
+
+    def test_workers_with_backpressure(self):
+        expected = {filepath: len(find_and_encode(filepath)[0]) for filepath in self.filepaths
+                    if filepath != self.skipped}
+        max_pending = 1
+        for detect_batch in [1, 2]:
+            pulled = 0
+
+            def images():
+                nonlocal pulled
+                for filepath in self.filepaths * 2:
+                    pulled += 1
+                    yield ImageFile(filepath)
+
+            results = []
+            for image, encodings, regions, searched_size, seconds in encode_images(
+                    images(), self.needs_encoding, workers=2, max_pending=max_pending, detect_batch=detect_batch):
+                results.append((image.filepath, None if encodings is None else len(encodings)))
+                if detect_batch == 1:  # Batches also hold back images until their bucket fills
+                    self.assertLessEqual(pulled, len(results) + max_pending, "read too far ahead of the writer")
+                self.assertIsNotNone(image.iptc, "metadata read by the worker wasn't kept")
+            self.assertEqual(sorted(self.filepaths * 2), sorted(filepath for filepath, count in results),
+                             f"each image should come back once with detect_batch {detect_batch}")
+            self.assertEqual({**expected, self.skipped: None}, dict(results))
+
+    def test_near_duplicates(self):
+        original = path.join(self.folder, "original.jpg")
+        copy = path.join(self.folder, "copy.jpg")
+        shutil.copy(test_data_path + "man.jpg", original)
+        pilmage.open(original).save(copy, "JPEG", quality=90)
+
+        images = [ImageFile(original), ImageFile(copy)]
+        results = list(encode_images(images, lambda image: True, near_duplicate_distance=4))
+        self.assertEqual([original, copy], [image.filepath for image, *_ in results])
+        (_, encodings, _, _, _), (_, copy_encodings, _, _, _) = results
+        self.assertEqual(1, len(encodings))
+        self.assertIsNone(copy_encodings, "faces were looked for in a near duplicate")
+        self.assertIsNone(images[0].duplicate_of)
+        self.assertEqual(original, images[1].duplicate_of, "the copy wasn't found from the image scanned before it")
+        self.assertEqual(images[0].dimensions, images[1].dimensions)
+
+        # Hashes from earlier scans are known by their image id
+        scanned = [(7, images[0].phash, *images[0].dimensions)]
+        image = ImageFile(copy)
+        (_, encodings, _, _, _), = encode_images([image], lambda image: True, near_duplicate_distance=4,
+                                                 scanned_hashes=scanned)
+        self.assertIsNone(encodings)
+        self.assertEqual(7, image.duplicate_of)
+
+        # Off unless asked for
+        image = ImageFile(copy)
+        (_, encodings, _, _, _), = encode_images([image], lambda image: True, scanned_hashes=scanned)
+        self.assertEqual(1, len(encodings))
+        self.assertIsNone(image.phash)
+        self.assertIsNone(image.duplicate_of)
+
+
+class TestArguments(unittest.TestCase):
+    scan = ["--scanroot", "pictures", "--known", "known"]
+
+    def assertRejected(self, argv):
+        with contextlib.redirect_stderr(StringIO()), self.assertRaises(SystemExit, msg=f"{argv} was accepted"):
+            parse_args(argv)
+
+    def test_detect_batch(self):
+        self.assertEqual(4, parse_args(self.scan + ["--detect-batch", "4"]).detect_batch)
+        self.assertEqual(600, parse_args(self.scan + ["--detection", "adaptive", "--detect-size", "600"]).detect_size)
+        # Batches are always searched like standard detection, so anything else would be silently ignored
+        self.assertRejected(self.scan + ["--detect-batch", "2", "--detection", "adaptive"])
+        self.assertRejected(self.scan + ["--detect-batch", "2", "--detection", "two-stage"])
+        self.assertRejected(self.scan + ["--detect-batch", "2", "--detect-size", "2000"])